@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+"""بنچمارک آفلاین ربات: یوتیوب جعلی، سرور Bot API جعلی و کاربران همزمان
+
+اجرا:
+    python benchmark.py --users 50 --quality 360 --file-size-mb 5
+    python benchmark.py --compare-stream --upload-mbps 20
+    python benchmark.py --local-bot-api --quality 720 --file-size-mb 80
+    python benchmark.py --audio --audio-seconds 600
+"""
+import os
+import sys
+import json
+import time
+import types
+import socket
+import asyncio
+import argparse
+import shutil
+import resource
+import tempfile
+import itertools
+import subprocess
+import urllib.parse
+
+# نمونه ضبط‌شده از لیست فرمت‌های یک ویدیوی یوتیوب (۱۰ دقیقه‌ای)
+RECORDED_FORMATS = [
+    {'format_id': 'sb0', 'ext': 'mhtml', 'vcodec': 'none', 'acodec': 'none', 'protocol': 'mhtml'},
+    {'format_id': '139', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a.40.5', 'abr': 48.8, 'filesize': 3671000, 'protocol': 'https'},
+    {'format_id': '140', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a.40.2', 'abr': 129.5, 'filesize': 9721000, 'protocol': 'https'},
+    {'format_id': '251', 'ext': 'webm', 'vcodec': 'none', 'acodec': 'opus', 'abr': 135.2, 'filesize': 10153000, 'protocol': 'https'},
+    {'format_id': '17', 'ext': '3gp', 'vcodec': 'mp4v.20.3', 'acodec': 'mp4a.40.2', 'height': 144, 'tbr': 78.3, 'protocol': 'https'},
+    {'format_id': '18', 'ext': 'mp4', 'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2', 'height': 360, 'tbr': 512.6, 'filesize_approx': 38445000, 'protocol': 'https'},
+    {'format_id': '22', 'ext': 'mp4', 'vcodec': 'avc1.64001F', 'acodec': 'mp4a.40.2', 'height': 720, 'tbr': 1189.4, 'filesize_approx': 89205000, 'protocol': 'https'},
+    {'format_id': '160', 'ext': 'mp4', 'vcodec': 'avc1.4d400c', 'acodec': 'none', 'height': 144, 'filesize': 4120000, 'protocol': 'https'},
+    {'format_id': '134', 'ext': 'mp4', 'vcodec': 'avc1.4d401e', 'acodec': 'none', 'height': 360, 'filesize': 17230000, 'protocol': 'https'},
+    {'format_id': '136', 'ext': 'mp4', 'vcodec': 'avc1.4d401f', 'acodec': 'none', 'height': 720, 'filesize': 61870000, 'protocol': 'https'},
+]
+
+def free_port():
+    """پیدا کردن یک پورت آزاد محلی"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def install_fake_config(args, workdir, api_port):
+    """ساخت ماژول config برای اجرای ربات روی سرور Bot API جعلی"""
+    config = types.ModuleType('config')
+    config.BOT_TOKEN = '123456:BENCHMARK'
+    config.CHANNEL_USERNAME = '@benchmark_channel'
+    config.CHANNEL_LINK = 'https://t.me/benchmark_channel'
+    config.DOWNLOAD_DIR = os.path.join(workdir, 'downloads')
+    config.UPLOAD_TIMEOUT = 300
+    config.MAX_FILE_SIZE = 50
+    config.YT_DLP_OPTIONS = {'quiet': True}
+    config.BOT_API_URL = f'http://127.0.0.1:{api_port}'
+    config.FILE_ID_DB = os.path.join(workdir, 'file_ids.db')
+    # کارگرهای پردازه‌ای YoutubeDL جعلی را نمی‌بینند، پس دانلود در thread اجرا می‌شود
+    config.DOWNLOAD_EXECUTOR = 'thread'
+    config.DOWNLOAD_WORKERS = args.download_workers
+    config.QUEUE_MAX_JOBS = max(args.users * 2, 50)
+    config.API_CHAT_RATE = args.chat_rate
+    config.API_CHAT_BURST = max(args.chat_rate, 3)
+    config.METRICS_PORT = 0
+    config.STREAM_UPLOADS = args.stream
+    config.LOCAL_BOT_API = args.local_bot_api
+    sys.modules['config'] = config
+    return config
+
+def make_fake_youtube_dl(args):
+    """کلاس جایگزین yt_dlp.YoutubeDL با فرمت‌های ضبط‌شده و فایل‌های مصنوعی"""
+    class FakeYoutubeDL:
+        def __init__(self, params=None):
+            self.params = params or {}
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def close(self):
+            pass
+
+        @staticmethod
+        def sanitize_info(info, remove_private_keys=False):
+            return json.loads(json.dumps(info))
+
+        def extract_info(self, url, download=False):
+            time.sleep(args.extract_delay)
+            video_id = url.rsplit('=', 1)[-1][:11]
+            info = {
+                'id': video_id, 'title': f'Benchmark video {video_id}', 'duration': 600,
+                'uploader': 'benchmark', 'thumbnail': None, 'formats': RECORDED_FORMATS,
+            }
+            if download:
+                return self.process_ie_result(info, download=True)
+            return info
+
+        def process_ie_result(self, info, download=True):
+            format_id = str(self.params.get('format', '18')).split('/')[0].split('[')[0]
+            fmt = next((f for f in info['formats'] if f['format_id'] == format_id), info['formats'][-1])
+            result = dict(info, format_id=fmt['format_id'], ext=fmt['ext'])
+            filename = self.prepare_filename(result)
+            tmpfilename = filename + '.part'
+            chunk = b'\0' * (256 * 1024)
+            total = int(args.file_size_mb * 1024 * 1024)
+            chunks = max(total // len(chunk), 1)
+            with open(tmpfilename, 'wb') as f:
+                for i in range(chunks):
+                    f.write(chunk)
+                    time.sleep(args.download_delay / chunks)
+                    for hook in self.params.get('progress_hooks', []):
+                        hook({'status': 'downloading', 'filename': filename, 'tmpfilename': tmpfilename,
+                              'downloaded_bytes': (i + 1) * len(chunk)})
+            os.replace(tmpfilename, filename)
+            for hook in self.params.get('progress_hooks', []):
+                hook({'status': 'finished', 'filename': filename, 'downloaded_bytes': total})
+            return result
+
+        def prepare_filename(self, info):
+            return self.params['outtmpl'] % info
+
+    return FakeYoutubeDL
+
+async def start_fake_bot_api(port, upload_mbps=0):
+    """سرور Bot API جعلی که پاسخ‌های معتبر و حداقلی برمی‌گرداند
+
+    با upload_mbps بیشتر از صفر، فایل‌های multipart با همان سرعت خوانده می‌شوند تا زمان آپلود
+    مثل یک شبکه واقعی در تأخیر کاربر دیده شود. مثل سرور محلی Bot API، مسیرهای file:// هم
+    از روی دیسک خوانده می‌شوند.
+    """
+    from aiohttp import web
+
+    message_ids = itertools.count(1000)
+    file_ids = itertools.count(1)
+    # آخرین دکمه‌های هر چت تا کاربر جعلی همان callback_data واقعی را بفرستد
+    counters = {'requests': 0, 'uploaded_bytes': 0, 'buttons': {}, 'media': {}, 'streamed': 0,
+                'file_uploads': 0, 'local_uploads': 0, 'local_bytes': 0}
+    upload_rate = upload_mbps * 1024 * 1024 / 8
+
+    def message(chat_id, **extra):
+        return dict({
+            'message_id': next(message_ids), 'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+        }, **extra)
+
+    def media(kind):
+        file_id = next(file_ids)
+        return {'file_id': f'{kind}-{file_id}', 'file_unique_id': f'u{file_id}', 'duration': 600,
+                'width': 640, 'height': 360}
+
+    async def handle(request):
+        counters['requests'] += 1
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            body = await request.read()
+            counters['uploaded_bytes'] += len(body)
+            params = json.loads(body or b'{}')
+        elif request.content_type == 'multipart/form-data':
+            # خواندن جریانی بخش‌ها تا محدودیت سرعت روی بایت‌های واقعی فایل اعمال شود
+            params = {}
+            if request.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                counters['streamed'] += 1
+            async for part in await request.multipart():
+                if part.filename:
+                    counters['file_uploads'] += 1
+                    while chunk := await part.read_chunk(64 * 1024):
+                        counters['uploaded_bytes'] += len(chunk)
+                        if upload_rate:
+                            await asyncio.sleep(len(chunk) / upload_rate)
+                else:
+                    value = await part.text()
+                    counters['uploaded_bytes'] += len(value)
+                    params[part.name] = value
+        else:
+            # post() خودش بدنه را می‌خواند؛ read() پیش از آن جریان multipart را مصرف می‌کند
+            params = {}
+            for name, value in (await request.post()).items():
+                if isinstance(value, web.FileField):
+                    counters['file_uploads'] += 1
+                    counters['uploaded_bytes'] += value.file.seek(0, os.SEEK_END)
+                else:
+                    counters['uploaded_bytes'] += len(value)
+                    params[name] = value
+        chat_id = params.get('chat_id', 1)
+        if params.get('reply_markup'):
+            markup = params['reply_markup']
+            markup = json.loads(markup) if isinstance(markup, str) else markup
+            counters['buttons'][int(chat_id)] = [
+                button['callback_data'] for row in markup.get('inline_keyboard', [])
+                for button in row if 'callback_data' in button
+            ]
+        for kind in ('video', 'audio', 'voice', 'document'):
+            value = params.get(kind)
+            if isinstance(value, str) and value.startswith('file://'):
+                path = urllib.parse.unquote(urllib.parse.urlsplit(value).path)
+                if not os.path.isfile(path):
+                    return web.json_response({'ok': False, 'error_code': 400,
+                                              'description': 'Bad Request: file not found'}, status=400)
+                counters['local_uploads'] += 1
+                counters['local_bytes'] += os.path.getsize(path)
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot',
+                      'can_join_groups': False, 'can_read_all_group_messages': False,
+                      'supports_inline_queries': False}
+        elif method == 'getChatMember':
+            result = {'status': 'member', 'user': {'id': int(params.get('user_id', 1)), 'is_bot': False,
+                                                   'first_name': 'user'}}
+        elif method in ('sendMessage', 'editMessageText'):
+            result = message(chat_id, text=params.get('text', ''))
+        elif method == 'getUpdates':
+            # long polling بدون آپدیت؛ کاربران بنچمارک آپدیت‌ها را مستقیم به Application می‌دهند
+            await asyncio.sleep(min(float(params.get('timeout') or 0), 1))
+            result = []
+        elif method == 'sendVideo':
+            result = message(chat_id, video=media('video'))
+        elif method == 'sendAudio':
+            result = message(chat_id, audio=media('audio'))
+        elif method == 'sendVoice':
+            result = message(chat_id, voice=media('voice'))
+        else:
+            result = True
+        if method in ('sendVideo', 'sendAudio', 'sendVoice', 'sendDocument'):
+            counters['media'][int(chat_id)] = counters['media'].get(int(chat_id), 0) + 1
+        return web.json_response({'ok': True, 'result': result})
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_post('/bot{token}/{method}', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner, counters
+
+def user_updates(user_index, video_id, quality, buttons):
+    """سه آپدیت یک کاربر: /start، ارسال لینک و انتخاب کیفیت (با callback_data دکمه‌ای که ربات فرستاده)"""
+    user_id = 100000 + user_index
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_index}'}
+    chat = {'id': user_id, 'type': 'private'}
+    url = f'https://www.youtube.com/watch?v={video_id}'
+    base_update_id = user_index * 10
+    return [
+        {'update_id': base_update_id + 1, 'message': {
+            'message_id': 1, 'date': int(time.time()), 'chat': chat, 'from': user, 'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}},
+        {'update_id': base_update_id + 2, 'message': {
+            'message_id': 2, 'date': int(time.time()), 'chat': chat, 'from': user, 'text': url}},
+        {'update_id': base_update_id + 3, 'callback_query': {
+            'id': str(base_update_id + 3), 'from': user, 'chat_instance': str(user_id),
+            'data': next((data for data in buttons.get(user_id, []) if data.startswith(f'{quality}_')),
+                         f'{quality}_{url}'),
+            'message': {'message_id': 3, 'date': int(time.time()), 'chat': chat,
+                        'from': {'id': 1, 'is_bot': True, 'first_name': 'bench'}, 'text': 'choose'}}},
+    ]
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+async def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='ytbot-bench-')
+    api_port = free_port()
+    install_fake_config(args, workdir, api_port)
+
+    import new2
+    from telegram import Update
+    new2.load_yt_dlp().YoutubeDL = make_fake_youtube_dl(args)
+
+    api_runner, api_counters = await start_fake_bot_api(api_port, args.upload_mbps)
+    application = new2.build_application(with_updater=False)
+    handler_errors = []
+
+    async def record_error(update, context):
+        handler_errors.append(context.error)
+
+    application.add_error_handler(record_error)
+    await application.initialize()
+
+    async def simulate_user(user_index):
+        video_id = 'benchVideo0' if args.same_video else f'bench{user_index:06d}'[:11]
+        started = time.monotonic()
+        # آپدیت‌ها به ترتیب ساخته می‌شوند تا دکمه‌های پاسخ لینک پیش از انتخاب کیفیت ثبت شده باشند
+        for step in range(3):
+            payload = user_updates(user_index, video_id, args.quality, api_counters['buttons'])[step]
+            await application.process_update(Update.de_json(payload, application.bot))
+        return time.monotonic() - started
+
+    started = time.monotonic()
+    latencies = await asyncio.gather(*(simulate_user(i) for i in range(args.users)))
+    elapsed = time.monotonic() - started
+
+    await application.shutdown()
+    await api_runner.cleanup()
+    new2.shutdown_executors()
+
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    mode = 'stream' if args.stream else 'regular'
+    print(f"users: {args.users}, quality: {args.quality}, file size: {args.file_size_mb}MB, "
+          f"upload mode: {mode}, upload bandwidth: {args.upload_mbps or 'unlimited'}Mbps, "
+          f"local Bot API: {args.local_bot_api}")
+    print(f"requests/sec: {args.users * 3 / elapsed:.2f} ({args.users} users in {elapsed:.2f}s)")
+    print(f"latency p50: {percentile(latencies, 0.5):.3f}s, p99: {percentile(latencies, 0.99):.3f}s")
+    print(f"peak RSS: {peak_rss_mb:.1f}MB")
+    print(f"Bot API calls: {api_counters['requests']}, bytes received: {api_counters['uploaded_bytes']}, "
+          f"streamed uploads: {api_counters['streamed']}, "
+          f"local path uploads: {api_counters['local_uploads']} ({api_counters['local_bytes']} bytes)")
+    print(new2.metrics.summary())
+
+    # هر خطا در مسیر اصلی نتیجه بنچمارک را بی‌اعتبار می‌کند
+    failures = {dict(labels)['type']: value for (name, labels), value in new2.metrics.counters.items()
+                if name == 'failures_total'}
+    missing = [i for i in range(args.users) if not api_counters['media'].get(100000 + i)]
+    # در حالت جریانی، برگشت بی‌صدا به آپلود عادی هم شکست حساب می‌شود
+    not_streamed = args.stream and api_counters['streamed'] < (1 if args.same_video else args.users)
+    # در حالت محلی هیچ بایتی از فایل نباید از پایتون عبور کند
+    not_local = args.local_bot_api and (api_counters['file_uploads'] or not api_counters['local_uploads'])
+    if failures or handler_errors or missing or not_streamed or not_local:
+        print(f"FAILED: failures={failures}, handler errors={len(handler_errors)}, "
+              f"users without media={len(missing)}, streamed uploads={api_counters['streamed']}, "
+              f"multipart file uploads={api_counters['file_uploads']}")
+        return 1
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'elapsed': elapsed, 'p50': percentile(latencies, 0.5),
+                       'p99': percentile(latencies, 0.99), 'peak_rss_mb': peak_rss_mb}, f)
+    return 0
+
+def compare_stream(argv):
+    """اجرای بنچمارک در دو پردازه جدا (آپلود عادی و آپلود هم‌زمان با دانلود) و مقایسه تأخیرها
+
+    new2 تنظیمات را هنگام import می‌خواند، پس هر حالت پردازه خودش را لازم دارد.
+    """
+    results = {}
+    for mode in ('regular', 'stream'):
+        with tempfile.NamedTemporaryFile(suffix='.json') as report:
+            command = [sys.executable, os.path.abspath(__file__), *argv, '--report', report.name]
+            if mode == 'stream':
+                command.append('--stream')
+            print(f"== {mode} ==", flush=True)
+            if subprocess.run(command).returncode:
+                print(f"FAILED: {mode} run did not complete")
+                return 1
+            with open(report.name) as f:
+                results[mode] = json.load(f)
+    print("== regular vs stream ==")
+    for key in ('elapsed', 'p50', 'p99'):
+        regular, stream = results['regular'][key], results['stream'][key]
+        print(f"{key}: regular {regular:.3f}s, stream {stream:.3f}s ({(stream - regular) / regular * 100:+.1f}%)")
+    return 0
+
+def run_audio_benchmark(args):
+    """مقایسه زمان CPU و تأخیر پس‌پردازش صدا: remux (کپی جریان) در برابر تبدیل به MP3
+
+    نمونه‌ها با ffmpeg ساخته می‌شوند (نویز صورتی تا رمزگذار کار واقعی داشته باشد) و همان
+    پس‌پردازش‌های yt-dlp که ربات استفاده می‌کند روی آن‌ها اجرا می‌شود.
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        print("SKIPPED: ffmpeg not found in PATH, the audio benchmark needs ffmpeg")
+        return 0
+
+    workdir = tempfile.mkdtemp(prefix='ytbot-audio-bench-')
+    install_fake_config(args, workdir, 0)
+    import new2
+    YoutubeDL = new2.load_yt_dlp().YoutubeDL
+
+    # نمونه‌ها مثل فرمت‌های 140 (AAC در m4a) و 251 (Opus در webm) یوتیوب
+    samples = {
+        '140': ('m4a', 'mp4a.40.2', ['-c:a', 'aac', '-b:a', '128k']),
+        '251': ('webm', 'opus', ['-c:a', 'libopus', '-b:a', '128k']),
+    }
+    failed = False
+    print(f"audio length: {args.audio_seconds}s, ffmpeg: {ffmpeg}")
+    for format_id, (ext, acodec, codec_args) in samples.items():
+        sample = os.path.join(workdir, f'sample-{format_id}.{ext}')
+        subprocess.run([
+            ffmpeg, '-loglevel', 'error', '-y', '-f', 'lavfi',
+            '-i', f'anoisesrc=color=pink:amplitude=0.3:sample_rate=48000:duration={args.audio_seconds}',
+            '-ac', '2', *codec_args, sample,
+        ], check=True)
+        info = {'formats': [{'format_id': format_id, 'ext': ext, 'acodec': acodec}]}
+        results = {}
+        for mode, postprocessors in (('remux', new2.audio_postprocessors(info, format_id)),
+                                     ('mp3', [new2.MP3_POSTPROCESSOR])):
+            target = os.path.join(workdir, mode, f'{format_id}.{ext}')
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy(sample, target)
+            with YoutubeDL({'quiet': True, 'postprocessors': postprocessors,
+                            'ffmpeg_location': os.path.dirname(ffmpeg)}) as ydl:
+                before = resource.getrusage(resource.RUSAGE_CHILDREN)
+                started = time.monotonic()
+                try:
+                    result = ydl.post_process(target, {'id': format_id, 'ext': ext, 'title': format_id})
+                except Exception as e:
+                    print(f"FAILED: {mode} of {format_id}.{ext}: {e}")
+                    failed = True
+                    continue
+                wall = time.monotonic() - started
+                after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+            output = result['filepath']
+            results[mode] = (wall, cpu)
+            print(f"{format_id}.{ext} {mode}: {'no postprocessing, ' if not postprocessors else ''}"
+                  f"latency {wall:.3f}s, CPU {cpu:.3f}s, output {os.path.basename(output)} "
+                  f"{os.path.getsize(output) / 1024 / 1024:.1f}MB")
+        if len(results) == 2:
+            (remux_wall, remux_cpu), (mp3_wall, mp3_cpu) = results['remux'], results['mp3']
+            print(f"{format_id}.{ext} mp3 vs remux: latency +{mp3_wall - remux_wall:.3f}s, "
+                  f"CPU +{mp3_cpu - remux_cpu:.3f}s")
+    shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if failed else 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test for the YouTube downloader bot')
+    parser.add_argument('--users', type=int, default=20, help='number of concurrent users')
+    parser.add_argument('--quality', default='360', help='quality button each user presses')
+    parser.add_argument('--file-size-mb', type=float, default=5, help='size of generated downloads')
+    parser.add_argument('--extract-delay', type=float, default=0.5, help='seconds per fake extraction')
+    parser.add_argument('--download-delay', type=float, default=2, help='seconds per fake download')
+    parser.add_argument('--download-workers', type=int, default=4, help='download thread pool size')
+    parser.add_argument('--chat-rate', type=float, default=1, help='per-chat Bot API rate limit')
+    parser.add_argument('--same-video', action='store_true', help='all users request the same video')
+    parser.add_argument('--upload-mbps', type=float, default=0, help='fake Bot API upload bandwidth (0 = unlimited)')
+    parser.add_argument('--stream', action='store_true', help='upload while downloading (STREAM_UPLOADS)')
+    parser.add_argument('--compare-stream', action='store_true',
+                        help='run the regular and streaming upload paths and compare their latency')
+    parser.add_argument('--local-bot-api', action='store_true',
+                        help='path-based uploads and the raised size limit of a local Bot API server')
+    parser.add_argument('--audio', action='store_true',
+                        help='compare CPU time and latency of audio remux and MP3 conversion (needs ffmpeg)')
+    parser.add_argument('--audio-seconds', type=int, default=600, help='length of generated audio samples')
+    parser.add_argument('--report', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.audio:
+        sys.exit(run_audio_benchmark(args))
+    if args.compare_stream:
+        argv = [arg for arg in sys.argv[1:] if arg not in ('--compare-stream', '--stream')]
+        sys.exit(compare_stream(argv))
+    sys.exit(asyncio.run(run_benchmark(args)))
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,123 @@
 #!/usr/bin/env python3
+import time
+# زمان شروع برای اندازه‌گیری زمان راه‌اندازی (پیش از import کتابخانه‌های سنگین)
+STARTUP_STARTED = time.monotonic()
 import os
 import logging
 import asyncio
 import re
+import json
+import sqlite3
+import copy
 import datetime
 import signal
 import sys
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
-import yt_dlp
+import functools
+import threading
+import multiprocessing
+import concurrent.futures
+import secrets
+import contextlib
+import contextvars
+import atexit
+import queue
+import shutil
+import httpx
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from collections import OrderedDict, deque
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, Chat
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, ChatMemberHandler, BaseRateLimiter
+from telegram.request import BaseRequest, HTTPXRequest
+import config
 from config import *
 
-# تنظیمات لاگ
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# تنظیمات لاگ: نوشتن روی دیسک و کنسول در thread جدا، با چرخش فایل، نمونه‌برداری و خروجی JSON
+LOG_FILE = getattr(config, 'LOG_FILE', 'bot.log')
+LOG_MAX_BYTES = getattr(config, 'LOG_MAX_BYTES', 10 * 1024 * 1024)
+LOG_BACKUPS = getattr(config, 'LOG_BACKUPS', 5)
+LOG_JSON = getattr(config, 'LOG_JSON', True)
+# از هر N پیام زیر سطح WARNING این loggerها فقط یکی نوشته می‌شود
+LOG_SAMPLE_RATES = getattr(config, 'LOG_SAMPLE_RATES', {'httpx': 20, 'yt_dlp': 10, 'ytbot.stages': 5})
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_CONTEXT_FIELDS = ('job_id', 'user_id', 'stage', 'seconds', 'sampled')
+
+# شناسه کار و کاربر جاری؛ taskهای ساخته‌شده در همان درخواست آن را به ارث می‌برند
+log_context = contextvars.ContextVar('log_context', default={})
+
+class ContextFilter(logging.Filter):
+    """نمونه‌برداری پیام‌های پرتکرار و افزودن job_id و user_id کار جاری به رکورد"""
+    
+    def __init__(self, sample_rates):
+        super().__init__()
+        self.sample_rates = sample_rates
+        self.counters = {}
+        self.lock = threading.Lock()
+    
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            rate = self.sample_rates.get(record.name) or self.sample_rates.get(record.name.split('.')[0])
+            if rate and rate > 1:
+                with self.lock:
+                    count = self.counters.get(record.name, 0)
+                    self.counters[record.name] = count + 1
+                if count % rate:
+                    return False
+                record.sampled = rate
+        for key, value in log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """یک شیء JSON در هر خط برای تحلیل لاگ‌ها بدون regex"""
+    
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.processName,
+            'message': record.getMessage(),
+        }
+        for key in LOG_CONTEXT_FIELDS:
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging():
+    """همه threadها فقط رکورد را در صف می‌گذارند و thread شنونده روی فایل و کنسول می‌نویسد"""
+    log_file = LOG_FILE
+    process_name = multiprocessing.current_process().name
+    if process_name != 'MainProcess':
+        # پردازه‌های کارگر فایل جدا دارند تا چرخش فایل بین پردازه‌ها تداخل نکند
+        base, ext = os.path.splitext(LOG_FILE)
+        log_file = f"{base}.{process_name}{ext}"
+    
+    file_handler = RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter() if LOG_JSON else logging.Formatter(LOG_FORMAT))
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter(LOG_SAMPLE_RATES))
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.handlers[:] = [queue_handler]
+    
+    listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
+stage_logger = logging.getLogger('ytbot.stages')
+
+# زمان مراحل راه‌اندازی (ثانیه)؛ yt-dlp جداگانه و در پس‌زمینه بارگذاری می‌شود
+startup_timings = {'imports': time.monotonic() - STARTUP_STARTED}
 
 # ایجاد دایرکتوری دانلود
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
@@ -31,9 +128,952 @@ UNICODE_NUMBERS = {
     '5': '𝟱', '6': '𝟲', '7': '𝟳', '8': '𝟴', '9': '𝟵'
 }
 
+# تنظیمات اجرای موازی (در config.py قابل بازنویسی هستند)
+EXTRACT_WORKERS = getattr(config, 'EXTRACT_WORKERS', 4)
+DOWNLOAD_WORKERS = getattr(config, 'DOWNLOAD_WORKERS', 2)
+DOWNLOAD_EXECUTOR = getattr(config, 'DOWNLOAD_EXECUTOR', 'process')  # 'thread' یا 'process'
+DOWNLOAD_PROCESSES = getattr(config, 'DOWNLOAD_PROCESSES', os.cpu_count() or 1)
+WORKER_CANCEL_GRACE = getattr(config, 'WORKER_CANCEL_GRACE', 15)
+DOWNLOAD_CAPACITY = DOWNLOAD_PROCESSES if DOWNLOAD_EXECUTOR == 'process' else DOWNLOAD_WORKERS
+STAGE_TIMEOUTS = getattr(config, 'STAGE_TIMEOUTS', {
+    'extract': 60,
+    'format': 60,
+    'download': 900,
+})
+
+# تنظیم خودکار دانلود چنداتصالی: سقف کل اتصال‌ها بین دانلودهای هم‌زمان تقسیم می‌شود
+ADAPTIVE_DOWNLOADS = getattr(config, 'ADAPTIVE_DOWNLOADS', True)
+DOWNLOAD_CONNECTIONS = getattr(config, 'DOWNLOAD_CONNECTIONS', 16)
+FRAGMENT_CONCURRENCY_MAX = getattr(config, 'FRAGMENT_CONCURRENCY_MAX', 8)
+HTTP_CHUNK_MIN = getattr(config, 'HTTP_CHUNK_MIN', 1024 * 1024)
+HTTP_CHUNK_MAX = getattr(config, 'HTTP_CHUNK_MAX', 10 * 1024 * 1024)  # یوتیوب درخواست‌های بزرگ‌تر را کند می‌کند
+HTTP_CHUNK_SECONDS = getattr(config, 'HTTP_CHUNK_SECONDS', 4)  # مدت تقریبی هر درخواست chunk
+
+# نمونه‌های ماندگار YoutubeDL برای استخراج اطلاعات و بارگذاری پیش‌زمینه yt-dlp
+YDL_POOL_MAX_USES = getattr(config, 'YDL_POOL_MAX_USES', 200)
+PRELOAD_YT_DLP = getattr(config, 'PRELOAD_YT_DLP', True)
+
+# تنظیمات کش اطلاعات ویدیو (لینک‌های امضاشده یوتیوب حدود ۶ ساعت معتبرند)
+INFO_CACHE_SIZE = getattr(config, 'INFO_CACHE_SIZE', 256)
+INFO_CACHE_TTL = getattr(config, 'INFO_CACHE_TTL', 30 * 60)
+
+# جلسه‌های انتخاب کیفیت: دکمه‌ها فقط توکن کوتاه دارند و اطلاعات استخراج‌شده سمت سرور می‌ماند
+SESSION_TTL = getattr(config, 'SESSION_TTL', 30 * 60)
+SESSION_MAX_ENTRIES = getattr(config, 'SESSION_MAX_ENTRIES', 10000)
+
+# تنظیمات کش دائمی file_id تلگرام
+FILE_ID_DB = getattr(config, 'FILE_ID_DB', 'file_ids.db')
+FILE_ID_CACHE_SIZE = getattr(config, 'FILE_ID_CACHE_SIZE', 10000)
+
+# دفتر کارهای دانلود برای ادامه پس از خاموش شدن (توقف runner یا راه‌اندازی دوباره روزانه)
+JOB_JOURNAL_DB = getattr(config, 'JOB_JOURNAL_DB', 'jobs.db')
+JOURNAL_CHECKPOINT_INTERVAL = getattr(config, 'JOURNAL_CHECKPOINT_INTERVAL', 10)
+JOURNAL_MAX_RESUMES = getattr(config, 'JOURNAL_MAX_RESUMES', 3)
+DRAIN_TIMEOUT = getattr(config, 'DRAIN_TIMEOUT', 20)  # مهلت پایان کارهای در جریان هنگام SIGTERM
+
+# تنظیمات ذخیره فایل‌های دانلودشده روی دیسک
+MEDIA_STORE_DIR = os.path.join(DOWNLOAD_DIR, 'media')
+MEDIA_STORE_BYTES = getattr(config, 'MEDIA_STORE_BYTES', 2 * 1024 * 1024 * 1024)
+
+# تنظیمات کش عضویت کانال
+MEMBER_CACHE_SIZE = getattr(config, 'MEMBER_CACHE_SIZE', 50000)
+MEMBER_POSITIVE_TTL = getattr(config, 'MEMBER_POSITIVE_TTL', 10 * 60)
+MEMBER_NEGATIVE_TTL = getattr(config, 'MEMBER_NEGATIVE_TTL', 30)
+MEMBER_UPDATES = getattr(config, 'MEMBER_UPDATES', False)  # نیاز به ادمین بودن بات در کانال
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+# تنظیمات صف دانلود
+QUEUE_MAX_JOBS = getattr(config, 'QUEUE_MAX_JOBS', 50)
+QUEUE_USER_ACTIVE = getattr(config, 'QUEUE_USER_ACTIVE', 1)
+QUEUE_USER_PENDING = getattr(config, 'QUEUE_USER_PENDING', 3)
+QUEUE_POSITION_INTERVAL = getattr(config, 'QUEUE_POSITION_INTERVAL', 5)
+CHEAP_QUALITIES = ('audio', '144')
+
+# تنظیمات دانلود دسته‌ای (پلی‌لیست یا چند لینک در یک پیام)
+PLAYLIST_MAX_ITEMS = getattr(config, 'PLAYLIST_MAX_ITEMS', 25)
+# تعداد ویدیوهایی که جلوتر از آپلود دانلود می‌شوند (هر کدام یک جای صف کاربر را می‌گیرد)
+BATCH_PREFETCH = max(min(getattr(config, 'BATCH_PREFETCH', 1), QUEUE_USER_PENDING - 1), 0)
+BATCH_USER_LIMIT = getattr(config, 'BATCH_USER_LIMIT', 1)
+BATCH_SESSION_TTL = getattr(config, 'BATCH_SESSION_TTL', 30 * 60)
+BATCH_PROGRESS_INTERVAL = getattr(config, 'BATCH_PROGRESS_INTERVAL', 3)
+
+# جدول اولویت کیفیت‌ها برای هر انتخاب کاربر
+QUALITY_PRIORITY = {
+    '144': ('144', '240', '360', '480', '720', 'best'),
+    '240': ('240', '144', '360', '480', '720', 'best'),
+    '360': ('360', '480', '240', '720', '144', 'best'),
+    '480': ('480', '360', '720', '240', 'best', '144'),
+    '720': ('720', '480', 'best', '360', '240', '144'),
+    'best': ('best', '720', '480', '360', '240', '144'),
+}
+PREFERRED_VCODECS = ('avc1', 'h264')
+
+# تنظیمات صدا: 'remux' صدای m4a/opus را بدون رمزگذاری دوباره می‌فرستد و 'mp3' تبدیل به MP3 است
+AUDIO_MODE = getattr(config, 'AUDIO_MODE', 'remux')
+AUDIO_LABEL = 'MP3' if AUDIO_MODE == 'mp3' else 'M4A'
+QUALITY_NAMES = {
+    '144': '144p', '240': '240p', '360': '360p',
+    '480': '480p', '720': '720p', 'audio': f'صدا ({AUDIO_LABEL})'
+}
+MP3_POSTPROCESSOR = {
+    'key': 'FFmpegExtractAudio',
+    'preferredcodec': 'mp3',
+    'preferredquality': '192',
+}
+# با preferredcodec='best' فقط container عوض می‌شود (کپی جریان)
+REMUX_POSTPROCESSOR = {
+    'key': 'FFmpegExtractAudio',
+    'preferredcodec': 'best',
+}
+
+# تنظیمات سرور Bot API (در حالت محلی فایل با مسیر ارسال می‌شود و سقف حجم ۲۰۰۰MB است)
+BOT_API_URL = getattr(config, 'BOT_API_URL', 'https://api.telegram.org')
+LOCAL_BOT_API = getattr(config, 'LOCAL_BOT_API', False)
+LOCAL_MAX_FILE_SIZE = getattr(config, 'LOCAL_MAX_FILE_SIZE', 2000)
+if LOCAL_BOT_API:
+    MAX_FILE_SIZE = LOCAL_MAX_FILE_SIZE
+
+# تنظیمات آپلود هم‌زمان با دانلود (فقط فرمت‌های تک‌فایلی بدون پس‌پردازش)
+STREAM_UPLOADS = getattr(config, 'STREAM_UPLOADS', False)
+STREAM_CHUNK_SIZE = getattr(config, 'STREAM_CHUNK_SIZE', 256 * 1024)
+STREAM_POLL_INTERVAL = getattr(config, 'STREAM_POLL_INTERVAL', 0.2)
+# فایل‌های کوچک‌تر از این حجم (MB) سریع‌تر با آپلود عادی پس از دانلود می‌رسند
+STREAM_MIN_SIZE = getattr(config, 'STREAM_MIN_SIZE', 20)
+
+# تقسیم فایل‌های بزرگ‌تر از سقف به چند بخش با کپی جریان (ffmpeg و ffprobe لازم است)
+SPLIT_OVERSIZED = getattr(config, 'SPLIT_OVERSIZED', False)
+SPLIT_MAX_PARTS = getattr(config, 'SPLIT_MAX_PARTS', 10)
+SPLIT_PARALLELISM = getattr(config, 'SPLIT_PARALLELISM', os.cpu_count() or 1)
+SPLIT_HEADROOM = 0.95  # جا برای سربار container هر بخش
+
+# تنظیمات محدودیت نرخ درخواست‌های Bot API
+API_GLOBAL_RATE = getattr(config, 'API_GLOBAL_RATE', 25)  # درخواست در ثانیه
+API_CHAT_RATE = getattr(config, 'API_CHAT_RATE', 1)
+API_CHAT_BURST = getattr(config, 'API_CHAT_BURST', 3)
+API_MAX_RETRIES = getattr(config, 'API_MAX_RETRIES', 3)
+API_CHAT_BUCKETS = getattr(config, 'API_CHAT_BUCKETS', 10000)
+
+# پردازش همزمان آپدیت‌ها و استخرهای اتصال جدا برای آپلود فایل و درخواست‌های کنترلی
+CONCURRENT_UPDATES = getattr(config, 'CONCURRENT_UPDATES', 64)
+CONTROL_POOL_SIZE = getattr(config, 'CONTROL_POOL_SIZE', 32)
+CONTROL_TIMEOUT = getattr(config, 'CONTROL_TIMEOUT', 10)
+CONTROL_CONNECT_TIMEOUT = getattr(config, 'CONTROL_CONNECT_TIMEOUT', 5)
+MEDIA_POOL_SIZE = getattr(config, 'MEDIA_POOL_SIZE', 8)
+# فقط ارسال و ویرایش پیام در یک چت مشمول محدودیت هر چت تلگرام است (نه مثلاً getChatMember روی کانال)
+CHAT_LIMITED_METHODS = ('send', 'edit', 'copyMessage', 'forwardMessage')
+MEDIA_METHODS = ('sendVideo', 'sendAudio', 'sendVoice', 'sendDocument', 'sendPhoto', 'sendMediaGroup')
+
+# محدودیت نرخ هر کاربر: (تعداد در دقیقه، حداکثر پشت سر هم) برای استعلام لینک، شروع دانلود
+# و ویدیوهای دانلود دسته‌ای (هر ویدیوی دسته یک توکن)
+USER_RATE_LIMITS = getattr(config, 'USER_RATE_LIMITS', {
+    'metadata': (10, 5), 'download': (6, 3), 'batch': (6, PLAYLIST_MAX_ITEMS),
+})
+USER_RATE_MAX_USERS = getattr(config, 'USER_RATE_MAX_USERS', 100000)
+RATE_LIMIT_EXEMPT = getattr(config, 'RATE_LIMIT_EXEMPT', [])
+
+# تنظیمات متریک‌ها (پورت 0 یعنی غیرفعال)
+METRICS_HOST = getattr(config, 'METRICS_HOST', '127.0.0.1')
+METRICS_PORT = getattr(config, 'METRICS_PORT', 9100)
+ADMIN_IDS = getattr(config, 'ADMIN_IDS', [])
+
+# تنظیمات حالت وب‌هوک (دریافت‌کننده فقط آپدیت‌ها را در صف SQLite ثبت می‌کند و چند پردازه آن‌ها را پردازش می‌کنند)
+RUN_MODE = getattr(config, 'RUN_MODE', 'polling')  # 'polling' یا 'webhook'
+WEBHOOK_URL = getattr(config, 'WEBHOOK_URL', '')
+WEBHOOK_PATH = getattr(config, 'WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = getattr(config, 'WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = getattr(config, 'WEBHOOK_PORT', 8443)
+WEBHOOK_SECRET = getattr(config, 'WEBHOOK_SECRET', '')
+UPDATE_QUEUE_DB = getattr(config, 'UPDATE_QUEUE_DB', 'updates.db')
+# آپدیت‌های هر کاربر همیشه به یک کارگر (user_id % UPDATE_WORKERS) می‌رسد تا محدودیت نرخ، سهم صف
+# و جلسه‌های انتخاب کیفیت کاربر در یک پردازه بمانند. بودجه‌های سراسری (نرخ Bot API، کارگرهای دانلود
+# و استخراج، ظرفیت صف) بین کارگرها تقسیم می‌شود؛ محدودیت: سهم کارگر بیکار به کارگر پرکار قرض داده
+# نمی‌شود و هر کارگر دست‌کم یک کارگر دانلود دارد، پس با کارگرهای بیشتر از بودجه، جمع کمی بیشتر می‌شود
+UPDATE_WORKERS = getattr(config, 'UPDATE_WORKERS', os.cpu_count() or 1)
+WORKER_CONCURRENT_UPDATES = getattr(config, 'WORKER_CONCURRENT_UPDATES', 8)
+UPDATE_POLL_INTERVAL = getattr(config, 'UPDATE_POLL_INTERVAL', 0.5)
+
+# الگوی لینک یوتیوب (گروه ۶ شناسه ۱۱ کاراکتری ویدیو است)
+YOUTUBE_PATTERN = r'(https?://)?(www\.)?(youtube|youtu)\.(com|be)/(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})'
+PLAYLIST_PATTERN = r'(https?://)?(www\.|m\.)?youtube\.com/playlist\?list=([\w-]+)'
+
+# تنظیمات yt-dlp برای استخراج اطلاعات
+INFO_YDL_OPTIONS = {
+    'quiet': True,
+    'no_warnings': True,
+    'extractor_args': {
+        'youtube': {
+            'player_client': ['android', 'web'],
+            'player_skip': ['configs', 'webpage']
+        }
+    },
+}
+
+# استخراج سطحی پلی‌لیست: فقط شناسه و عنوان ویدیوها بدون باز کردن تک‌تک آن‌ها
+PLAYLIST_YDL_OPTIONS = dict(INFO_YDL_OPTIONS, extract_flat='in_playlist', playlistend=PLAYLIST_MAX_ITEMS)
+
 # متغیرهای جهانی برای مدیریت وضعیت
 bot_application = None
 update_task = None
+webhook_runner = None
+update_workers = []
+worker_supervisor = None
+metrics_server = None
+worker_executors = {}
+download_pool = None
+stream_client = None
+yt_dlp = None
+yt_dlp_lock = threading.Lock()
+journal_task = None
+active_jobs = {}
+accepting_jobs = True
+checkpointing = False
+active_batches = {}
+
+class TTLCache:
+    """کش LRU با زمان انقضا و شمارنده hit/miss (امن برای چند thread)"""
+    
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def pop(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            return entry[1] if entry else None
+    
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+class FileIdStore:
+    """نگهداری file_id تلگرام در SQLite برای ارسال دوباره بدون دانلود و آپلود"""
+    
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids ("
+            "video_id TEXT NOT NULL, quality TEXT NOT NULL, format_id TEXT NOT NULL, "
+            "file_id TEXT NOT NULL, media_type TEXT NOT NULL, title TEXT, file_size INTEGER, "
+            "last_used REAL NOT NULL, PRIMARY KEY (video_id, quality, format_id))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS file_ids_last_used ON file_ids (last_used)")
+        self.db.commit()
+    
+    def get(self, video_id, quality, format_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT file_id, media_type, title, file_size FROM file_ids "
+                "WHERE video_id = ? AND quality = ? AND format_id = ?",
+                (video_id, quality, format_id)
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE file_ids SET last_used = ? WHERE video_id = ? AND quality = ? AND format_id = ?",
+                (time.time(), video_id, quality, format_id)
+            )
+            self.db.commit()
+        return {
+            'video_id': video_id, 'quality': quality, 'format_id': format_id,
+            'file_id': row[0], 'media_type': row[1], 'title': row[2] or 'Unknown', 'file_size': row[3] or 0,
+        }
+    
+    def put(self, video_id, quality, format_id, file_id, media_type, title, file_size):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO file_ids VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (video_id, quality, format_id, file_id, media_type, title, file_size, time.time())
+            )
+            # حذف قدیمی‌ترین رکوردها در صورت عبور از سقف
+            self.db.execute(
+                "DELETE FROM file_ids WHERE rowid IN (SELECT rowid FROM file_ids ORDER BY last_used "
+                "LIMIT max(0, (SELECT COUNT(*) FROM file_ids) - ?))",
+                (self.max_entries,)
+            )
+            self.db.commit()
+    
+    def invalidate(self, video_id, quality, format_id):
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM file_ids WHERE video_id = ? AND quality = ? AND format_id = ?",
+                (video_id, quality, format_id)
+            )
+            self.db.commit()
+
+class UpdateQueue:
+    """صف مشترک آپدیت‌ها در SQLite؛ هر آپدیت فقط یک‌بار ثبت و فقط توسط یک کارگر برداشته می‌شود"""
+    
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS updates ("
+            "update_id INTEGER PRIMARY KEY, payload TEXT NOT NULL, claimed_by TEXT, claimed_at REAL, "
+            "user_id INTEGER NOT NULL DEFAULT 0)"
+        )
+        # صف ساخته‌شده با نسخه قبلی ستون user_id ندارد
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(updates)")}
+        if 'user_id' not in columns:
+            self.db.execute("ALTER TABLE updates ADD COLUMN user_id INTEGER NOT NULL DEFAULT 0")
+        self.db.commit()
+    
+    def put(self, update_id, payload, user_id=0):
+        # تحویل دوباره یک آپدیت توسط تلگرام نادیده گرفته می‌شود
+        self.db.execute(
+            "INSERT OR IGNORE INTO updates (update_id, payload, user_id) VALUES (?, ?, ?)",
+            (update_id, payload, abs(user_id))
+        )
+        self.db.commit()
+    
+    def claim(self, worker_name, worker_id, workers):
+        """برداشتن قدیمی‌ترین آپدیت آزاد کاربران این کارگر
+        
+        هر کاربر فقط یک کارگر زنده دارد، پس آپدیتی که به نام کارگر دیگری برداشته شده مال پردازه‌ای است
+        که پیش از این کارگر از کار افتاده و فوراً دوباره برداشته می‌شود.
+        """
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            row = self.db.execute(
+                "SELECT update_id, payload FROM updates WHERE user_id % ? = ? "
+                "AND (claimed_by IS NULL OR claimed_by != ?) ORDER BY update_id LIMIT 1",
+                (workers, worker_id, worker_name)
+            ).fetchone()
+            if row is not None:
+                self.db.execute(
+                    "UPDATE updates SET claimed_by = ?, claimed_at = ? WHERE update_id = ?",
+                    (worker_name, time.time(), row[0])
+                )
+        return row
+    
+    def done(self, update_id):
+        self.db.execute("DELETE FROM updates WHERE update_id = ?", (update_id,))
+        self.db.commit()
+
+class JobJournal:
+    """دفتر کارهای دانلود در SQLite؛ هر درخواست تا پایان ارسال در آن می‌ماند تا پس از خاموش شدن
+    یا از کار افتادن ربات از همان مرحله (با ادامه فایل .part) ادامه پیدا کند"""
+    
+    COLUMNS = (
+        'job_id', 'user_id', 'chat_id', 'message_id', 'url', 'video_id', 'quality',
+        'title', 'state', 'part_path', 'resumes', 'updated_at'
+    )
+    
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, "
+            "message_id INTEGER NOT NULL, url TEXT NOT NULL, video_id TEXT NOT NULL, quality TEXT NOT NULL, "
+            "title TEXT, state TEXT NOT NULL, part_path TEXT, resumes INTEGER NOT NULL DEFAULT 0, "
+            "updated_at REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_video ON jobs (video_id, quality)")
+        self.db.commit()
+    
+    def record(self, job_id, user_id, chat_id, message_id, url, video_id, quality, title):
+        """ثبت کار در وضعیت queued (کار ادامه‌یافته شمارنده و مسیر .part خود را نگه می‌دارد)"""
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO jobs (job_id, user_id, chat_id, message_id, url, video_id, quality, title, state, "
+                "updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?) "
+                "ON CONFLICT(job_id) DO UPDATE SET title = excluded.title, updated_at = excluded.updated_at",
+                (job_id, user_id, chat_id, message_id, url, video_id, quality, title, time.time())
+            )
+            self.db.commit()
+    
+    def update(self, video_id, quality, state, part_path=None):
+        """تغییر وضعیت همه درخواست‌های یک دانلود مشترک (کار در حال آپلود به عقب برنمی‌گردد)"""
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET state = ?, part_path = COALESCE(?, part_path), updated_at = ? "
+                "WHERE video_id = ? AND quality = ? AND state != 'uploading'",
+                (state, part_path, time.time(), video_id, quality)
+            )
+            self.db.commit()
+    
+    def mark_resumed(self, job_id):
+        with self.lock:
+            self.db.execute("UPDATE jobs SET resumes = resumes + 1 WHERE job_id = ?", (job_id,))
+            self.db.commit()
+    
+    def finish(self, job_id):
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+            self.db.commit()
+    
+    def exists(self, job_id):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM jobs WHERE job_id = ?", (job_id,)).fetchone() is not None
+    
+    def pending(self):
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM jobs ORDER BY updated_at"
+            ).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+class TokenBucket:
+    """سطل توکن ساده برای محدودیت نرخ"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def wait_time(self, cost=1):
+        """زمان لازم تا آزاد شدن cost توکن (صفر یعنی توکن‌ها موجود است)"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+    
+    def take(self, cost=1):
+        self.tokens -= cost
+
+class UserRateLimiter:
+    """سطل توکن جداگانه برای هر کاربر و هر نوع کار (استعلام اطلاعات، دانلود، دسته) با حذف سطل‌های بیکار"""
+    
+    def __init__(self, limits, max_buckets, exempt):
+        self.limits = {kind: (per_minute / 60, burst) for kind, (per_minute, burst) in limits.items()}
+        self.max_buckets = max_buckets
+        self.exempt = set(exempt)
+        # سطلی که این مدت بیکار مانده دوباره پر شده و با سطل تازه فرقی ندارد، پس حذف آن چیزی را عوض نمی‌کند
+        self.idle_ttl = max(burst / rate for rate, burst in self.limits.values())
+        self.buckets = OrderedDict()
+    
+    def check(self, user_id, kind, cost=1):
+        """برداشتن cost توکن؛ (0, False) یعنی مجاز و در غیر این صورت (ثانیه انتظار، لزوم اطلاع به کاربر)"""
+        if user_id in self.exempt:
+            return 0, False
+        key = (user_id, kind)
+        entry = self.buckets.pop(key, None)
+        if entry is None:
+            entry = {'bucket': TokenBucket(*self.limits[kind]), 'notified_until': 0}
+        self.buckets[key] = entry
+        self.evict()
+        
+        # کاری بزرگ‌تر از ظرفیت سطل کل ظرفیت را مصرف می‌کند (وگرنه هیچ‌وقت مجاز نمی‌شد)
+        cost = min(cost, entry['bucket'].capacity)
+        wait = entry['bucket'].wait_time(cost)
+        if not wait:
+            entry['bucket'].take(cost)
+            return 0, False
+        # در هر دوره محدودیت فقط یک‌بار پاسخ داده می‌شود و بقیه درخواست‌ها بی‌صدا رد می‌شوند
+        now = time.monotonic()
+        notify = now >= entry['notified_until']
+        if notify:
+            entry['notified_until'] = now + wait
+        return wait, notify
+    
+    def evict(self):
+        """حذف سطل‌های بیکار از ابتدای ترتیب LRU (هزینه ثابت به ازای هر درخواست)"""
+        idle_before = time.monotonic() - self.idle_ttl
+        while self.buckets:
+            key, entry = next(iter(self.buckets.items()))
+            if len(self.buckets) <= self.max_buckets and entry['bucket'].updated > idle_before:
+                return
+            del self.buckets[key]
+
+class RoutedRequest(BaseRequest):
+    """درخواست‌های آپلود فایل از استخر اتصال جدا با timeout بلند و بقیه از استخر سریع با timeout کوتاه،
+    تا پیام‌های کوتاه پشت آپلودهای چنددقیقه‌ای منتظر نمانند"""
+    
+    def __init__(self, control, media):
+        self.control = control
+        self.media = media
+    
+    @property
+    def read_timeout(self):
+        return self.control.read_timeout
+    
+    async def initialize(self):
+        await self.control.initialize()
+        await self.media.initialize()
+    
+    async def shutdown(self):
+        await self.control.shutdown()
+        await self.media.shutdown()
+    
+    def route(self, url, request_data):
+        # در حالت Bot API محلی فقط مسیر فایل ارسال می‌شود ولی پاسخ تا پایان آپلود طول می‌کشد
+        if request_data is not None and request_data.contains_files:
+            return 'media'
+        if LOCAL_BOT_API and url.rsplit('/', 1)[-1] in MEDIA_METHODS:
+            return 'media'
+        return 'control'
+    
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        pool = self.route(url, request_data)
+        metrics.inc('api_requests_total', pool=pool)
+        backend = self.media if pool == 'media' else self.control
+        return await backend.do_request(url, method, request_data, **timeouts)
+
+def build_request():
+    """ساخت دو استخر اتصال Bot API با اندازه و timeout جداگانه"""
+    control = HTTPXRequest(
+        connection_pool_size=CONTROL_POOL_SIZE,
+        read_timeout=CONTROL_TIMEOUT,
+        write_timeout=CONTROL_TIMEOUT,
+        connect_timeout=CONTROL_CONNECT_TIMEOUT,
+        pool_timeout=CONTROL_CONNECT_TIMEOUT,
+    )
+    media = HTTPXRequest(
+        connection_pool_size=MEDIA_POOL_SIZE,
+        read_timeout=UPLOAD_TIMEOUT,
+        write_timeout=UPLOAD_TIMEOUT,
+        connect_timeout=UPLOAD_TIMEOUT,
+        pool_timeout=UPLOAD_TIMEOUT,
+    )
+    return RoutedRequest(control, media)
+
+class FloodControlLimiter(BaseRateLimiter):
+    """زمان‌بند درخواست‌های خروجی Bot API: سطل توکن سراسری و هر چت، ادغام ویرایش‌های
+    در انتظار یک پیام، رعایت retry_after و اولویت پایین برای کارهای غیرفوری"""
+    
+    def __init__(self):
+        self.global_bucket = TokenBucket(API_GLOBAL_RATE, API_GLOBAL_RATE)
+        self.chat_buckets = OrderedDict()
+        self.paused_until = {}
+        self.pending_edits = {}
+        self.urgent_waiting = 0
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.pop(chat_id, None) or TokenBucket(API_CHAT_RATE, API_CHAT_BURST)
+        self.chat_buckets[chat_id] = bucket
+        if len(self.chat_buckets) > API_CHAT_BUCKETS:
+            self.chat_buckets.popitem(last=False)
+        return bucket
+    
+    async def acquire(self, chat_id, low_priority):
+        """انتظار تا آزاد شدن توکن سراسری و توکن چت"""
+        if not low_priority:
+            self.urgent_waiting += 1
+        try:
+            while True:
+                buckets = [self.global_bucket]
+                if chat_id is not None:
+                    buckets.append(self.chat_bucket(chat_id))
+                wait = max(bucket.wait_time() for bucket in buckets)
+                paused = max(self.paused_until.get(None, 0), self.paused_until.get(chat_id, 0))
+                wait = max(wait, paused - time.monotonic())
+                # درخواست‌های کم‌اولویت تا خالی شدن صف درخواست‌های کاربران صبر می‌کنند
+                if low_priority and self.urgent_waiting:
+                    wait = max(wait, 1 / API_GLOBAL_RATE)
+                if wait <= 0:
+                    for bucket in buckets:
+                        bucket.take()
+                    return
+                await asyncio.sleep(wait)
+        finally:
+            if not low_priority:
+                self.urgent_waiting -= 1
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        # درخواست‌هایی که پیامی در چت نمی‌فرستند فقط از سطل سراسری توکن می‌گیرند
+        bucket_key = chat_id if endpoint.startswith(CHAT_LIMITED_METHODS) else None
+        low_priority = bool(rate_limit_args and rate_limit_args.get('priority') == 'low')
+        
+        # ویرایش‌های در انتظار یک پیام ادغام می‌شوند و فقط آخرین متن ارسال می‌شود
+        edit_key = None
+        if endpoint == 'editMessageText' and data.get('message_id') is not None:
+            edit_key = (chat_id, data.get('message_id'))
+            pending = self.pending_edits.get(edit_key)
+            if pending is not None:
+                pending['args'] = args
+                return await asyncio.shield(pending['future'])
+            pending = {'args': args, 'future': asyncio.get_running_loop().create_future()}
+            self.pending_edits[edit_key] = pending
+        
+        try:
+            for attempt in range(API_MAX_RETRIES + 1):
+                await self.acquire(bucket_key, low_priority)
+                if edit_key is not None:
+                    if self.pending_edits.get(edit_key) is pending:
+                        del self.pending_edits[edit_key]
+                    args = pending['args']
+                try:
+                    result = await callback(*args, **kwargs)
+                    break
+                except RetryAfter as e:
+                    retry_after = e.retry_after
+                    if isinstance(retry_after, datetime.timedelta):
+                        retry_after = retry_after.total_seconds()
+                    logger.warning(f"Flood control on {endpoint}, retrying in {retry_after}s")
+                    self.paused_until[bucket_key] = time.monotonic() + retry_after
+                    if attempt == API_MAX_RETRIES:
+                        raise
+                    if edit_key is not None:
+                        newer = self.pending_edits.get(edit_key)
+                        if newer is not None:
+                            # ویرایش جدیدتری در راه است؛ همان نتیجه استفاده می‌شود
+                            result = await asyncio.shield(newer['future'])
+                            break
+                        self.pending_edits[edit_key] = pending
+        except BaseException as e:
+            if edit_key is not None:
+                if self.pending_edits.get(edit_key) is pending:
+                    del self.pending_edits[edit_key]
+                if not pending['future'].done():
+                    pending['future'].set_exception(e)
+                    # جلوگیری از هشدار exception بازیابی‌نشده وقتی منتظر دیگری وجود ندارد
+                    pending['future'].exception()
+            raise
+        
+        if edit_key is not None and not pending['future'].done():
+            pending['future'].set_result(result)
+        return result
+
+class MediaStore:
+    """فایل‌های دانلودشده با کلید (video_id, format_id, پس‌پردازش)، سقف حجم، حذف LRU
+    و شمارش ارجاع در طول آپلود (فقط از thread لوپ استفاده می‌شود)"""
+    
+    def __init__(self, directory, budget_bytes):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def path_for(self, key, ext):
+        video_id, format_id, postprocess = key
+        name = f"{video_id}~{format_id}~{postprocess}{ext}".replace(os.sep, '_')
+        return os.path.join(self.directory, name)
+    
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry['doomed'] or not os.path.exists(entry['result']['file_path']):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return dict(entry['result'])
+    
+    def add(self, key, result):
+        """انتقال فایل دانلودشده به مخزن و ثبت آن"""
+        entry = self.entries.get(key)
+        if entry is not None and os.path.exists(entry['result']['file_path']):
+            # چند کیفیت ممکن است به یک فرمت برسند؛ فایل موجود (شاید در حال آپلود) جایگزین نمی‌شود
+            try:
+                os.remove(result['file_path'])
+            except OSError as e:
+                logger.error(f"Error deleting duplicate download: {e}")
+            self.entries.move_to_end(key)
+            return dict(entry['result'])
+        
+        # مدخلی که فایلش از دیسک رفته جایگزین می‌شود ولی ارجاع‌های آپلودهای در جریان حفظ می‌شود
+        refs = 0
+        if entry is not None:
+            refs = entry['refs']
+            self.total_bytes -= self.entries.pop(key)['result']['file_size']
+        path = self.path_for(key, os.path.splitext(result['file_path'])[1])
+        os.makedirs(self.directory, exist_ok=True)
+        os.replace(result['file_path'], path)
+        result = dict(result, file_path=path, media_key=key)
+        self.entries[key] = {'result': result, 'refs': refs, 'doomed': False}
+        self.total_bytes += result['file_size']
+        self.evict()
+        return dict(result)
+    
+    def acquire(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry['refs'] += 1
+    
+    def release(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        entry['refs'] -= 1
+        if entry['refs'] <= 0 and entry['doomed']:
+            self.remove(key)
+        else:
+            self.evict()
+    
+    def discard(self, key):
+        """حذف فایل (پس از پایان آپلودهای در جریان)"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        if entry['refs'] > 0:
+            entry['doomed'] = True
+        else:
+            self.remove(key)
+    
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry['result']['file_size']
+        try:
+            os.remove(entry['result']['file_path'])
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Error deleting stored media: {e}")
+    
+    def evict(self):
+        """حذف قدیمی‌ترین فایل‌های بدون آپلود در جریان تا رسیدن به سقف حجم"""
+        for key in list(self.entries):
+            if self.total_bytes <= self.budget_bytes:
+                return
+            if self.entries[key]['refs'] == 0:
+                self.remove(key)
+    
+    def adopt(self, path, job):
+        """ثبت دوباره فایل کامل یک کار نیمه‌تمام (از روی نام فایل مخزن) پس از راه‌اندازی"""
+        try:
+            video_id, format_id, postprocess = os.path.splitext(os.path.basename(path))[0].split('~')
+        except ValueError:
+            return False
+        key = (video_id, format_id, postprocess)
+        quality = 'audio' if postprocess != 'none' else job['quality']
+        result = {
+            'file_path': path,
+            'title': job['title'] or 'Unknown',
+            'file_size': os.path.getsize(path),
+            'actual_quality': quality,
+            'format_id': format_id,
+            'media_type': media_type_for(quality, path),
+            'timings': {},
+            'media_key': key,
+        }
+        self.entries[key] = {'result': result, 'refs': 0, 'doomed': False}
+        self.total_bytes += result['file_size']
+        return True
+    
+    def sweep(self, root, jobs=()):
+        """حذف فایل‌های یتیم (.part، موقت و دانلودهای ثبت‌نشده) هنگام راه‌اندازی؛ فایل‌های کارهای
+        دفتر کارها برای ادامه دانلود نگه داشته و فایل‌های کامل آن‌ها دوباره در مخزن ثبت می‌شوند"""
+        known = {entry['result']['file_path'] for entry in self.entries.values()}
+        part_paths = {job['part_path'] for job in jobs if job['part_path']}
+        # نام فایل‌های دانلود (و قطعه‌های .part) شامل -{video_id}-{quality}. است (outtmpl دانلود)
+        markers = [f"-{job['video_id']}-{job['quality']}." for job in jobs]
+        journaled = {job['video_id']: job for job in jobs}
+        removed = 0
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if path in known or path in part_paths or any(marker in filename for marker in markers):
+                    continue
+                job = journaled.get(filename.split('~', 1)[0])
+                if dirpath == self.directory and job is not None and self.adopt(path, job):
+                    continue
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError as e:
+                    logger.error(f"Error sweeping {path}: {e}")
+        logger.info(f"Startup sweep removed {removed} orphaned files from {root}")
+    
+    def stats(self):
+        return {
+            'files': len(self.entries), 'bytes': self.total_bytes,
+            'hits': self.hits, 'misses': self.misses,
+        }
+
+class Metrics:
+    """شمارنده‌ها و هیستوگرام‌های ساده با خروجی قالب Prometheus"""
+    
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+    
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = {'buckets': [0] * len(self.BUCKETS), 'count': 0, 'sum': 0.0}
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+        if name == 'stage_seconds':
+            stage = dict(labels).get('stage')
+            stage_logger.info(f"Stage {stage} took {seconds:.3f}s", extra={'stage': stage, 'seconds': round(seconds, 3)})
+    
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """اندازه‌گیری زمان یک مرحله از درخواست"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.monotonic() - started, stage=stage)
+    
+    def add_collector(self, collector):
+        """ثبت تابعی که هنگام خروجی گرفتن، مقادیر لحظه‌ای {(name, labels): value} را برمی‌گرداند"""
+        self.collectors.append(collector)
+    
+    def format_labels(self, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+    
+    def render(self):
+        """خروجی متنی قالب Prometheus؛ نمونه‌های هر خانواده (شمارنده و مقدار لحظه‌ای هم‌نام) پشت سر هم
+        و با خط TYPE، نام‌های *_total شمارنده و بقیه gauge"""
+        samples = dict(self.counters)
+        for collector in self.collectors:
+            samples.update(collector())
+        families = {}
+        for (name, labels), value in samples.items():
+            families.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in sorted(families):
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {full_name} {'counter' if name.endswith('_total') else 'gauge'}")
+            for labels, value in sorted(families[name]):
+                lines.append(f"{full_name}{self.format_labels(labels)} {value}")
+        histograms = {}
+        for (name, labels), histogram in self.histograms.items():
+            histograms.setdefault(name, []).append((labels, histogram))
+        for name in sorted(histograms):
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {full_name} histogram")
+            for labels, histogram in sorted(histograms[name], key=lambda item: item[0]):
+                for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                    lines.append(f"{full_name}_bucket{self.format_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{full_name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{full_name}_sum{self.format_labels(labels)} {histogram['sum']:.3f}")
+                lines.append(f"{full_name}_count{self.format_labels(labels)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+    
+    def summary(self):
+        """خلاصه خوانا برای دستور /stats"""
+        lines = ["⏱ زمان مراحل (تعداد / میانگین):"]
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            average = histogram['sum'] / histogram['count'] if histogram['count'] else 0
+            label_text = ','.join(str(value) for _, value in labels)
+            lines.append(f"• {label_text}: {histogram['count']} / {average:.2f}s")
+        lines.append("📊 شمارنده‌ها:")
+        for (name, labels), value in sorted(self.counters.items()):
+            label_text = ','.join(str(value) for _, value in labels)
+            lines.append(f"• {name}{'[' + label_text + ']' if label_text else ''}: {value}")
+        for collector in self.collectors:
+            for (name, labels), value in sorted(collector().items()):
+                label_text = ','.join(str(value) for _, value in labels)
+                lines.append(f"• {name}{'[' + label_text + ']' if label_text else ''}: {value}")
+        return '\n'.join(lines)
+
+class YoutubeDLPool:
+    """نمونه‌های ماندگار YoutubeDL برای هر پروفایل تنظیمات تا نشست HTTP، کوکی‌ها و استخراج‌کننده‌ها
+    بین درخواست‌ها حفظ شوند؛ هر نمونه در هر لحظه فقط در اختیار یک thread است"""
+    
+    def __init__(self, profiles, max_idle, max_uses):
+        self.profiles = profiles
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        self.idle = {name: [] for name in profiles}
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+    
+    def create(self, name):
+        ydl = load_yt_dlp().YoutubeDL(copy.deepcopy(self.profiles[name]))
+        with self.lock:
+            self.created += 1
+        return {'ydl': ydl, 'uses': 0}
+    
+    @contextlib.contextmanager
+    def instance(self, name):
+        """گرفتن یک نمونه آزاد (یا ساخت نمونه جدید) و برگرداندن آن پس از استفاده"""
+        with self.lock:
+            entry = self.idle[name].pop() if self.idle[name] else None
+            if entry is not None:
+                self.reused += 1
+        if entry is None:
+            entry = self.create(name)
+        try:
+            yield entry['ydl']
+        finally:
+            entry['uses'] += 1
+            # نمونه‌های پرمصرف بازسازی می‌شوند تا وضعیت داخلی yt-dlp بی‌حد رشد نکند
+            with self.lock:
+                keep = entry['uses'] < self.max_uses and len(self.idle[name]) < self.max_idle
+                if keep:
+                    self.idle[name].append(entry)
+            if not keep:
+                entry['ydl'].close()
+    
+    def warm(self):
+        """ساخت یک نمونه از هر پروفایل و بارگذاری استخراج‌کننده یوتیوب پیش از اولین درخواست"""
+        for name in self.profiles:
+            with self.instance(name) as ydl:
+                ydl.get_info_extractor('Youtube')
+    
+    def close(self):
+        with self.lock:
+            entries = [entry for idle in self.idle.values() for entry in idle]
+            for idle in self.idle.values():
+                idle.clear()
+        for entry in entries:
+            entry['ydl'].close()
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'created': self.created,
+                'reused': self.reused,
+                'idle': sum(len(idle) for idle in self.idle.values()),
+            }
+
+metrics = Metrics('ytbot')
+info_cache = TTLCache(INFO_CACHE_SIZE, INFO_CACHE_TTL)
+media_store = MediaStore(MEDIA_STORE_DIR, MEDIA_STORE_BYTES)
+file_id_store = FileIdStore(FILE_ID_DB, FILE_ID_CACHE_SIZE)
+job_journal = JobJournal(JOB_JOURNAL_DB)
+member_cache = TTLCache(MEMBER_CACHE_SIZE, MEMBER_POSITIVE_TTL)
+ydl_pool = YoutubeDLPool(
+    {'info': INFO_YDL_OPTIONS, 'playlist': PLAYLIST_YDL_OPTIONS}, EXTRACT_WORKERS, YDL_POOL_MAX_USES
+)
+batch_sessions = TTLCache(1000, BATCH_SESSION_TTL)
+selection_sessions = TTLCache(SESSION_MAX_ENTRIES, SESSION_TTL)
+user_limiter = UserRateLimiter(USER_RATE_LIMITS, USER_RATE_MAX_USERS, list(ADMIN_IDS) + list(RATE_LIMIT_EXEMPT))
 
 def convert_to_unicode_font(text):
     """تبدیل اعداد به فونت یونیکد"""
@@ -83,11 +1123,11 @@ async def update_bot_info_manually(application):
     try:
         # بروزرسانی نام بات با ساعت
         new_name = get_bot_name_with_clock()
-        await application.bot.set_my_name(new_name)
+        await application.bot.set_my_name(new_name, rate_limit_args={'priority': 'low'})
         
         # بروزرسانی بیو بات با شمارش معکوس
         new_bio = get_bio_text()
-        await application.bot.set_my_description(new_bio)
+        await application.bot.set_my_description(new_bio, rate_limit_args={'priority': 'low'})
         
         logger.info("Bot name and bio updated successfully")
         return True
@@ -103,6 +1143,12 @@ async def background_updater(application):
             success = await update_bot_info_manually(application)
             if not success:
                 logger.warning("Failed to update bot info, will retry in 60 seconds")
+            logger.info(
+                f"Info cache stats: {info_cache.stats()}, member cache stats: {member_cache.stats()}, "
+                f"download queue: {download_scheduler.stats()}, media store: {media_store.stats()}"
+            )
+            if download_pool is not None:
+                logger.info(f"Download workers: {download_pool.stats()}")
             await asyncio.sleep(60)  # هر 60 ثانیه
         except asyncio.CancelledError:
             logger.info("Background updater cancelled")
@@ -111,26 +1157,351 @@ async def background_updater(application):
             logger.error(f"Background updater error: {e}")
             await asyncio.sleep(60)
 
-async def is_user_member(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+def cache_membership(user_id, is_member):
+    """ذخیره وضعیت عضویت با TTL جداگانه برای عضو و غیرعضو"""
+    ttl = MEMBER_POSITIVE_TTL if is_member else MEMBER_NEGATIVE_TTL
+    member_cache.set(user_id, is_member, ttl=ttl)
+
+async def is_user_member(user_id: int, context: ContextTypes.DEFAULT_TYPE, refresh: bool = False) -> bool:
     """بررسی عضویت کاربر در کانال"""
+    if not refresh:
+        cached = member_cache.get(user_id)
+        if cached is not None:
+            return cached
     try:
         member = await context.bot.get_chat_member(chat_id=CHANNEL_USERNAME, user_id=user_id)
-        return member.status in ['member', 'administrator', 'creator']
+        is_member = member.status in MEMBER_STATUSES
+        cache_membership(user_id, is_member)
+        return is_member
     except Exception as e:
         logger.error(f"Error checking membership: {e}")
         return False
 
+async def handle_chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """به‌روزرسانی فوری کش عضویت با ورود و خروج کاربران کانال"""
+    chat_member = update.chat_member
+    if not chat_member or (chat_member.chat.username or '').lower() != CHANNEL_USERNAME.lstrip('@').lower():
+        return
+    new_member = chat_member.new_chat_member
+    cache_membership(new_member.user.id, new_member.status in MEMBER_STATUSES)
+
+def load_yt_dlp():
+    """import تنبل yt-dlp (فقط یک‌بار و امن برای چند thread) با ثبت زمان import"""
+    global yt_dlp
+    if yt_dlp is None:
+        with yt_dlp_lock:
+            if yt_dlp is None:
+                started = time.monotonic()
+                import yt_dlp as module
+                startup_timings['yt_dlp_import'] = time.monotonic() - started
+                yt_dlp = module
+    return yt_dlp
+
+def preload_yt_dlp():
+    """بارگذاری yt-dlp و گرم کردن نمونه‌های YoutubeDL در پس‌زمینه، هم‌زمان با اتصال به تلگرام"""
+    def preload():
+        try:
+            load_yt_dlp()
+            started = time.monotonic()
+            ydl_pool.warm()
+            startup_timings['yt_dlp_warm'] = time.monotonic() - started
+            logger.info(
+                f"yt-dlp loaded in {startup_timings['yt_dlp_import']:.2f}s, "
+                f"warmed in {startup_timings['yt_dlp_warm']:.2f}s"
+            )
+        except Exception as e:
+            logger.error(f"Error preloading yt-dlp: {e}")
+    
+    threading.Thread(target=preload, name='yt-dlp-preload', daemon=True).start()
+
+# جای رویداد لغو و دیکشنری پیشرفت در آرگومان‌های کار پردازه‌ای (خود آن اشیا از pipe رد نمی‌شوند)
+CANCEL_ARG = '__cancel_event__'
+PROGRESS_ARG = '__progress__'
+PROGRESS_SEND_INTERVAL = 0.5
+
+class PipeCancelEvent:
+    """رویداد لغو در پردازه کارگر: پیام {cancel: job_id} پردازه اصلی بدون انتظار از pipe خوانده می‌شود"""
+    
+    def __init__(self, conn, job_id):
+        self.conn = conn
+        self.job_id = job_id
+        self.cancelled = False
+    
+    def is_set(self):
+        while not self.cancelled and self.conn.poll():
+            # None یعنی خاموش شدن استخر که آن هم کار را متوقف می‌کند
+            message = self.conn.recv()
+            self.cancelled = message is None or message.get('cancel') == self.job_id
+        return self.cancelled
+
+class PipeProgress(dict):
+    """وضعیت پیشرفت در پردازه کارگر؛ تغییرها (حین دانلود حداکثر دو بار در ثانیه) به پردازه اصلی فرستاده می‌شود"""
+    
+    def __init__(self, conn, job_id):
+        super().__init__()
+        self.conn = conn
+        self.job_id = job_id
+        self.sent_at = 0
+    
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        now = time.monotonic()
+        if self.get('status') != 'downloading' or now - self.sent_at >= PROGRESS_SEND_INTERVAL:
+            self.sent_at = now
+            self.conn.send({'job_id': self.job_id, 'progress': dict(self)})
+
+def download_worker_main(conn):
+    """حلقه پردازه کارگر دانلود: دریافت کار {job_id, func, args} و ارسال {job_id, progress} و {job_id, result|error}"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # yt-dlp پیش از اولین کار بارگذاری می‌شود تا زمان آن به حساب دانلود نیاید
+    load_yt_dlp()
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            return
+        if job is None:
+            return
+        if 'cancel' in job:
+            # لغوی که پس از پایان کار رسیده
+            continue
+        args = [
+            PipeCancelEvent(conn, job['job_id']) if arg == CANCEL_ARG
+            else PipeProgress(conn, job['job_id']) if arg == PROGRESS_ARG
+            else arg
+            for arg in job['args']
+        ]
+        try:
+            result = globals()[job['func']](*args)
+            conn.send({'job_id': job['job_id'], 'result': result})
+        except Exception as e:
+            conn.send({'job_id': job['job_id'], 'error': repr(e)})
+
+class DownloadWorkerPool:
+    """پردازه‌های کارگر دانلود و تبدیل با راه‌اندازی دوباره کارگرهای ازکارافتاده و آمار بهره‌وری"""
+    
+    def __init__(self, size):
+        self.size = size
+        self.context = multiprocessing.get_context('spawn')
+        self.io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=size, thread_name_prefix='worker-io')
+        self.idle = asyncio.Queue()
+        self.workers = []
+        self.job_counter = 0
+        for worker_id in range(size):
+            worker = {'id': worker_id, 'restarts': -1, 'jobs': 0, 'busy_time': 0.0, 'busy_since': None}
+            self.spawn(worker)
+            self.workers.append(worker)
+            self.idle.put_nowait(worker)
+    
+    def spawn(self, worker):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=download_worker_main, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        worker.update({'process': process, 'conn': parent_conn, 'started': time.monotonic()})
+        worker['restarts'] += 1
+    
+    def restart(self, worker):
+        logger.warning(f"Download worker {worker['id']} crashed, restarting")
+        worker['conn'].close()
+        if worker['process'].is_alive():
+            worker['process'].kill()
+        worker['process'].join(timeout=5)
+        self.spawn(worker)
+    
+    async def execute(self, worker, job_id, func, args, progress):
+        loop = asyncio.get_running_loop()
+        worker['busy_since'] = time.monotonic()
+        try:
+            worker['conn'].send({'job_id': job_id, 'func': func.__name__, 'args': args})
+            while True:
+                reply = await loop.run_in_executor(self.io_executor, worker['conn'].recv)
+                if 'progress' not in reply:
+                    break
+                if progress is not None:
+                    progress.update(reply['progress'])
+        except (EOFError, OSError):
+            self.restart(worker)
+            raise RuntimeError(f"Download worker {worker['id']} died during job {job_id}")
+        finally:
+            worker['busy_time'] += time.monotonic() - worker['busy_since']
+            worker['busy_since'] = None
+            worker['jobs'] += 1
+            self.idle.put_nowait(worker)
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply['result']
+    
+    async def kill_if_stuck(self, worker, task):
+        """اگر کارگر پس از لغو هم کار را رها نکرد، پردازه آن کشته و دوباره ساخته می‌شود"""
+        try:
+            await asyncio.wait_for(asyncio.shield(task), WORKER_CANCEL_GRACE)
+        except asyncio.TimeoutError:
+            worker['process'].kill()
+        except Exception:
+            pass
+    
+    async def run(self, func, args, cancel_event=None, progress=None):
+        worker = await self.idle.get()
+        self.job_counter += 1
+        job_id = self.job_counter
+        args = tuple(
+            CANCEL_ARG if cancel_event is not None and arg is cancel_event
+            else PROGRESS_ARG if progress is not None and arg is progress
+            else arg
+            for arg in args
+        )
+        task = asyncio.ensure_future(self.execute(worker, job_id, func, args, progress))
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # لغو از pipe به کارگر می‌رسد و کار در پس‌زمینه تمام می‌شود تا پاسخ کارگر خوانده و کارگر آزاد شود
+            if cancel_event is not None:
+                try:
+                    worker['conn'].send({'cancel': job_id})
+                except OSError:
+                    pass
+            asyncio.ensure_future(self.kill_if_stuck(worker, task))
+            raise
+    
+    def stats(self):
+        """بهره‌وری هر کارگر (درصد زمان مشغول بودن از زمان راه‌اندازی)"""
+        now = time.monotonic()
+        stats = []
+        for worker in self.workers:
+            busy_time = worker['busy_time']
+            if worker['busy_since'] is not None:
+                busy_time += now - worker['busy_since']
+            uptime = max(now - worker['started'], 1e-6)
+            stats.append({
+                'id': worker['id'],
+                'jobs': worker['jobs'],
+                'restarts': worker['restarts'],
+                'busy': worker['busy_since'] is not None,
+                'utilization': round(min(busy_time / uptime, 1.0) * 100, 1),
+            })
+        return stats
+    
+    def shutdown(self):
+        for worker in self.workers:
+            try:
+                worker['conn'].send(None)
+            except OSError:
+                pass
+            worker['process'].join(timeout=1)
+            if worker['process'].is_alive():
+                worker['process'].kill()
+        self.io_executor.shutdown(wait=False, cancel_futures=True)
+
+def get_download_pool():
+    """دریافت (یا ساخت) استخر پردازه‌های کارگر دانلود"""
+    global download_pool
+    if download_pool is None:
+        download_pool = DownloadWorkerPool(DOWNLOAD_PROCESSES)
+    return download_pool
+
+def get_executor(kind):
+    """دریافت (یا ساخت) استخر کارگر برای استخراج یا دانلود"""
+    executor = worker_executors.get(kind)
+    if executor is None:
+        if kind == 'download':
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=DOWNLOAD_WORKERS, thread_name_prefix='download'
+            )
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=EXTRACT_WORKERS, thread_name_prefix='extract'
+            )
+        worker_executors[kind] = executor
+    return executor
+
+def make_progress_hook(cancel_event, progress=None, timings=None):
+    """progress hook که در صورت لغو، دانلود yt-dlp را متوقف و وضعیت پیشرفت را ثبت می‌کند"""
+    def hook(d):
+        if cancel_event is not None and cancel_event.is_set():
+            raise load_yt_dlp().utils.DownloadCancelled('Job cancelled')
+        if timings is not None and d.get('status') == 'finished':
+            timings['downloaded_at'] = time.monotonic()
+        if progress is not None:
+            progress.update({
+                'status': d.get('status'),
+                'filename': d.get('filename'),
+                'tmpfilename': d.get('tmpfilename') or d.get('filename'),
+                'downloaded_bytes': d.get('downloaded_bytes') or 0,
+                'speed': d.get('speed') or 0,
+            })
+    return hook
+
+async def run_in_worker(kind, stage, func, *args, cancel_event=None, progress=None):
+    """اجرای تابع مسدودکننده در استخر کارگر با timeout مرحله‌ای و لغو واقعی
+    
+    رویداد لغو و دیکشنری پیشرفت اشیای عادی همین پردازه‌اند؛ در کارگر پردازه‌ای، پیشرفت و لغو
+    به صورت پیام از pipe همان کار منتقل می‌شوند (بدون هیچ رفت‌وبرگشت IPC روی لوپ).
+    """
+    loop = asyncio.get_running_loop()
+    if kind == 'download' and DOWNLOAD_EXECUTOR == 'process':
+        future = asyncio.ensure_future(get_download_pool().run(func, args, cancel_event, progress))
+    else:
+        # مثل asyncio.to_thread، log_context (job_id و user_id) به thread کارگر هم می‌رسد
+        context = contextvars.copy_context()
+        future = loop.run_in_executor(get_executor(kind), functools.partial(context.run, func, *args))
+    try:
+        return await asyncio.wait_for(future, timeout=STAGE_TIMEOUTS.get(stage))
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        # کار در صف حذف می‌شود و کار در حال اجرا با رویداد لغو متوقف می‌شود
+        if cancel_event is not None:
+            cancel_event.set()
+        logger.warning(f"Stage '{stage}' cancelled or timed out")
+        raise
+
+def shutdown_executors():
+    """توقف استخرهای کارگر"""
+    global download_pool
+    for executor in worker_executors.values():
+        executor.shutdown(wait=False, cancel_futures=True)
+    worker_executors.clear()
+    if download_pool is not None:
+        download_pool.shutdown()
+        download_pool = None
+    ydl_pool.close()
+
+def extract_video_id(url):
+    """استخراج شناسه ۱۱ کاراکتری ویدیو از لینک یوتیوب"""
+    match = re.match(YOUTUBE_PATTERN, url)
+    return match.group(6) if match else None
+
+def extract_raw_info(url):
+    """استخراج اطلاعات خام ویدیو (فقط یک‌بار برای هر ویدیو، با کش مشترک)"""
+    cache_key = extract_video_id(url) or url
+    info = info_cache.get(cache_key)
+    if info is not None:
+        return info
+    
+    with ydl_pool.instance('info') as ydl:
+        info = strip_format_selection(ydl.sanitize_info(ydl.extract_info(url, download=False), remove_private_keys=True))
+    info_cache.set(cache_key, info)
+    return info
+
+# کلیدهایی که باید در اطلاعات ویدیو بمانند، حتی اگر در دیکشنری فرمت‌ها هم آمده باشند
+INFO_KEEP_KEYS = {'id', 'title', 'duration', 'formats', 'thumbnails', 'thumbnail', 'webpage_url', 'extractor', 'extractor_key', '_type'}
+
+def strip_format_selection(info):
+    """حذف انتخاب فرمت پیش‌فرض yt-dlp از اطلاعات کش‌شده
+    
+    extract_info فرمت پیش‌فرض (مثلاً 137+140) و requested_formats را در خود info می‌نویسد؛
+    اگر این کلیدها بمانند، process_ie_result با format دیگری هم همان فرمت‌ها را دانلود می‌کند.
+    """
+    selected = {'requested_formats', 'requested_downloads', 'requested_subtitles', 'format', 'format_id'}
+    for fmt in info.get('formats') or []:
+        selected.update(fmt)
+    for key in selected - INFO_KEEP_KEYS:
+        info.pop(key, None)
+    return info
+
 def get_available_formats(url):
     """دریافت لیست فرمت‌های موجود برای ویدیو"""
     try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'listformats': True,
-        }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            result = ydl.extract_info(url, download=False)
-            return result.get('formats', [])
+        return extract_raw_info(url).get('formats', [])
     except Exception as e:
         logger.error(f"Error getting available formats: {e}")
         return []
@@ -138,213 +1509,748 @@ def get_available_formats(url):
 def get_video_info(url):
     """دریافت اطلاعات ویدیو"""
     try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extractor_args': {
-                'youtube': {
-                    'player_client': ['android', 'web'],
-                    'player_skip': ['configs', 'webpage']
-                }
-            },
+        info = extract_raw_info(url)
+        return {
+            'title': info.get('title', 'Unknown'),
+            'duration': info.get('duration', 0),
+            'uploader': info.get('uploader', 'Unknown'),
+            'thumbnail': info.get('thumbnail', None),
+            'formats': info.get('formats', [])
         }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            return {
-                'title': info.get('title', 'Unknown'),
-                'duration': info.get('duration', 0),
-                'uploader': info.get('uploader', 'Unknown'),
-                'thumbnail': info.get('thumbnail', None),
-                'formats': info.get('formats', [])
-            }
     except Exception as e:
         logger.error(f"Error getting video info: {e}")
         return None
 
-def get_best_available_format(url, preferred_quality):
-    """پیدا کردن بهترین فرمت موجود بر اساس کیفیت مورد نظر"""
+def extract_playlist_entries(url):
+    """استخراج سطحی پلی‌لیست: لینک، شناسه و عنوان ویدیوها (حداکثر PLAYLIST_MAX_ITEMS مورد)"""
     try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extractor_args': {
-                'youtube': {
-                    'player_client': ['android', 'web'],
-                    'player_skip': ['configs', 'webpage']
-                }
-            },
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with ydl_pool.instance('playlist') as ydl:
             info = ydl.extract_info(url, download=False)
-            formats = info.get('formats', [])
-            
-            # فیلتر کردن فرمت‌های ویدیویی
-            video_formats = [f for f in formats if f.get('vcodec') != 'none' and f.get('acodec') != 'none']
-            audio_formats = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') != 'none']
-            
-            # اگر کاربر صدا خواست
-            if preferred_quality == 'audio':
-                best_audio = None
-                for fmt in audio_formats:
-                    if fmt.get('filesize') and fmt.get('filesize') < MAX_FILE_SIZE * 1024 * 1024:
-                        if not best_audio or fmt.get('abr', 0) > best_audio.get('abr', 0):
-                            best_audio = fmt
-                if best_audio:
-                    return best_audio['format_id']
-                # اگر فرمت صوتی با محدودیت حجم پیدا نشد، بهترین فرمت صوتی را برمی‌گرداند
-                if audio_formats:
-                    return audio_formats[0]['format_id']
-                return None
-            
-            # برای ویدیوها
-            quality_priority = []
-            if preferred_quality == '144':
-                quality_priority = ['144', '240', '360', '480', '720', 'best']
-            elif preferred_quality == '240':
-                quality_priority = ['240', '144', '360', '480', '720', 'best']
-            elif preferred_quality == '360':
-                quality_priority = ['360', '480', '240', '720', '144', 'best']
-            elif preferred_quality == '480':
-                quality_priority = ['480', '360', '720', '240', 'best', '144']
-            elif preferred_quality == '720':
-                quality_priority = ['720', '480', 'best', '360', '240', '144']
-            elif preferred_quality == 'best':
-                quality_priority = ['best', '720', '480', '360', '240', '144']
-            
-            # جستجو برای پیدا کردن بهترین فرمت موجود
-            for quality in quality_priority:
-                if quality == 'best':
-                    # پیدا کردن بهترین کیفیت با محدودیت حجم
-                    best_format = None
-                    for fmt in video_formats:
-                        if fmt.get('filesize') and fmt.get('filesize') < MAX_FILE_SIZE * 1024 * 1024:
-                            if not best_format or fmt.get('height', 0) > best_format.get('height', 0):
-                                best_format = fmt
-                    if best_format:
-                        return best_format['format_id']
-                else:
-                    target_height = int(quality.replace('p', ''))
-                    # پیدا کردن فرمت با ارتفاع مورد نظر
-                    for fmt in video_formats:
-                        if fmt.get('height') == target_height:
-                            if fmt.get('filesize') and fmt.get('filesize') < MAX_FILE_SIZE * 1024 * 1024:
-                                return fmt['format_id']
-            
-            # اگر هیچ فرمتی با محدودیت حجم پیدا نشد، بهترین فرمت بدون محدودیت حجم
-            if video_formats:
-                return video_formats[0]['format_id']
-            
-            return None
-            
+        entries = []
+        for entry in info.get('entries') or []:
+            if not entry or not entry.get('id'):
+                continue
+            entries.append({
+                'url': f"https://www.youtube.com/watch?v={entry['id']}",
+                'video_id': entry['id'],
+                'title': entry.get('title') or entry['id'],
+            })
+        return {'title': info.get('title') or 'Playlist', 'entries': entries[:PLAYLIST_MAX_ITEMS]}
+    except Exception as e:
+        logger.error(f"Error getting playlist entries: {e}")
+        return None
+
+def estimate_format_size(fmt, duration):
+    """تخمین حجم فرمت از filesize، filesize_approx یا bitrate × مدت زمان"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return size
+    if fmt.get('tbr') and duration:
+        return int(fmt['tbr'] * 1000 / 8 * duration)
+    return None
+
+def build_format_index(info, max_bytes):
+    """ساخت فهرست فرمت‌ها در یک گذر: بهترین فرمت جاشونده برای هر ارتفاع و بهترین فرمت صوتی"""
+    duration = info.get('duration') or 0
+    index = {'heights': {}, 'audio': None}
+    scores = {}
+    
+    for fmt in info.get('formats', []):
+        if fmt.get('acodec') == 'none':
+            continue
+        size = estimate_format_size(fmt, duration)
+        is_audio = fmt.get('vcodec') == 'none'
+        height = fmt.get('height')
+        if not is_audio and not height:
+            continue
+        
+        # فرمتی که حجمش معلوم نیست ممکن است از محدودیت بزرگ‌تر باشد، پس انتخاب نمی‌شود
+        if size is None or size > max_bytes:
+            continue
+        
+        if is_audio:
+            # در حالت remux صدای AAC ترجیح دارد چون بدون هیچ تبدیلی قابل ارسال است
+            codec_rank = 1 if AUDIO_MODE != 'mp3' and (fmt.get('acodec') or '').startswith('mp4a') else 0
+            score = (codec_rank, fmt.get('abr') or 0, size)
+            if index['audio'] is None or score > scores['audio']:
+                index['audio'] = fmt
+                scores['audio'] = score
+        else:
+            # در هر ارتفاع، H.264 (پخش مستقیم در تلگرام) و سپس حجم بیشتر (کیفیت بهتر) ترجیح دارد
+            codec_rank = 1 if (fmt.get('vcodec') or '').startswith(PREFERRED_VCODECS) else 0
+            score = (codec_rank, size)
+            if height not in index['heights'] or score > scores[height]:
+                index['heights'][height] = fmt
+                scores[height] = score
+    
+    return index
+
+def select_format(index, preferred_quality):
+    """انتخاب فرمت از روی فهرست با جدول اولویت کیفیت‌ها"""
+    if preferred_quality == 'audio':
+        return index['audio']['format_id'] if index['audio'] else None
+    
+    heights = index['heights']
+    for quality in QUALITY_PRIORITY.get(preferred_quality, QUALITY_PRIORITY['best']):
+        if quality == 'best':
+            if heights:
+                return heights[max(heights)]['format_id']
+        elif int(quality) in heights:
+            return heights[int(quality)]['format_id']
+    
+    # هیچ فرمتی با حجم مشخص در محدودیت جا نشد؛ درخواست پیش از دانلود رد می‌شود
+    return None
+
+def selection_limit_bytes():
+    """سقف حجم انتخاب فرمت: با تقسیم فایل‌های بزرگ، تا SPLIT_MAX_PARTS بخش در سقف هر فایل"""
+    return MAX_FILE_SIZE * 1024 * 1024 * (SPLIT_MAX_PARTS if SPLIT_OVERSIZED else 1)
+
+def no_format_text():
+    return (
+        f"❌ متأسفانه هیچ فرمتی با حجم مشخص و کمتر از {selection_limit_bytes() // 1024 // 1024}MB "
+        "برای این ویدیو پیدا نشد. لطفاً کیفیت پایین‌تر یا ویدیوی دیگری را امتحان کنید."
+    )
+
+def get_best_available_format(url, preferred_quality, info=None):
+    """پیدا کردن بهترین فرمت موجود بر اساس کیفیت مورد نظر (None یعنی هیچ فرمتی در محدودیت حجم جا نمی‌شود)"""
+    try:
+        if info is None:
+            info = extract_raw_info(url)
+        index = build_format_index(info, selection_limit_bytes())
+        return select_format(index, preferred_quality)
     except Exception as e:
         logger.error(f"Error finding best format: {e}")
         return None
 
-def download_video_robust(url, quality='best'):
-    """دانلود قوی ویدیو با مدیریت خودکار فرمت‌ها"""
+def audio_postprocessors(info, format_id):
+    """پس‌پردازش صدا: AAC بدون هیچ تبدیلی، بقیه با کپی جریان و MP3 فقط در صورت درخواست صریح"""
+    if AUDIO_MODE == 'mp3':
+        return [MP3_POSTPROCESSOR]
+    fmt = next((f for f in info.get('formats', []) if f.get('format_id') == format_id), {})
+    if (fmt.get('acodec') or '').startswith('mp4a') and fmt.get('ext') == 'm4a':
+        return []
+    return [REMUX_POSTPROCESSOR]
+
+def locate_audio_file(filename):
+    """پیدا کردن فایل صوتی نهایی با پسوند واقعی آن (پس از پس‌پردازش)"""
+    base_name = os.path.splitext(filename)[0]
+    preferred = '.mp3' if AUDIO_MODE == 'mp3' else os.path.splitext(filename)[1]
+    for ext in [preferred, '.m4a', '.opus', '.ogg', '.mp3', '.webm']:
+        if os.path.exists(base_name + ext):
+            return base_name + ext
+    return filename
+
+def media_type_for(quality, filename):
+    """نوع پیام تلگرام: صدای opus/ogg به صورت voice ارسال می‌شود"""
+    if quality != 'audio':
+        return 'video'
+    if os.path.splitext(filename)[1] in ('.opus', '.ogg'):
+        return 'voice'
+    return 'audio'
+
+def stage_timings(started, timings):
+    """تفکیک زمان دانلود از پس‌پردازش (ffmpeg) بر اساس زمان پایان آخرین دانلود"""
+    finished = time.monotonic()
+    downloaded_at = timings.get('downloaded_at', finished)
+    return {'download': downloaded_at - started, 'postprocess': finished - downloaded_at}
+
+def download_video_robust(url, quality='best', cancel_event=None, info=None, progress=None, tuning=None):
+    """دانلود قوی ویدیو با مدیریت خودکار فرمت‌ها (tuning: تعداد اتصال و اندازه chunk از DownloadTuner)"""
+    started = time.monotonic()
+    timings = {}
+    progress_hook = make_progress_hook(cancel_event, progress, timings)
     try:
+        # استفاده از اطلاعات استخراج‌شده قبلی به جای استخراج دوباره
+        if info is None:
+            info = extract_raw_info(url)
+        
         # پیدا کردن بهترین فرمت موجود
-        best_format = get_best_available_format(url, quality)
+        best_format = get_best_available_format(url, quality, info)
         
         if not best_format:
             logger.error("No suitable format found")
-            return None
+            return {'refused': 'no_format'}
 
         # کپی تنظیمات پایه
         ydl_opts = YT_DLP_OPTIONS.copy()
-        ydl_opts['outtmpl'] = f'{DOWNLOAD_DIR}/%(title).100s.%(ext)s'
+        ydl_opts['outtmpl'] = f'{DOWNLOAD_DIR}/%(title).100s-%(id)s-{quality}.%(ext)s'
         
         # استفاده از فرمت پیدا شده
         ydl_opts['format'] = best_format
+        ydl_opts['progress_hooks'] = [progress_hook]
+        ydl_opts.setdefault('logger', logging.getLogger('yt_dlp'))
+        ydl_opts.update(tuning or {})
         
         # تنظیمات postprocessor برای صدا
         if quality == 'audio':
-            ydl_opts.update({
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-            })
+            ydl_opts['postprocessors'] = audio_postprocessors(info, best_format)
         
         logger.info(f"Downloading with format: {best_format} for quality: {quality}")
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
+        # تنظیمات دانلود (فرمت، hook و پس‌پردازش) برای هر کار فرق دارد، پس نمونه جدید ساخته می‌شود
+        with load_yt_dlp().YoutubeDL(ydl_opts) as ydl:
+            result = ydl.process_ie_result(copy.deepcopy(info), download=True)
+            filename = ydl.prepare_filename(result)
             
             # برای فایل صوتی
             if quality == 'audio':
-                base_name = os.path.splitext(filename)[0]
-                filename = base_name + '.mp3'
-                if not os.path.exists(filename):
-                    for ext in ['.webm', '.m4a', '.opus', '.mp3']:
-                        temp_file = base_name + ext
-                        if os.path.exists(temp_file):
-                            if ext != '.mp3':
-                                os.rename(temp_file, filename)
-                            break
+                filename = locate_audio_file(filename)
             
             file_size = os.path.getsize(filename) if os.path.exists(filename) else 0
             
             return {
                 'file_path': filename,
-                'title': info.get('title', 'Unknown'),
+                'title': result.get('title', 'Unknown'),
                 'file_size': file_size,
-                'actual_quality': quality
+                'actual_quality': quality,
+                'format_id': best_format,
+                'media_type': media_type_for(quality, filename),
+                'timings': stage_timings(started, timings)
             }
             
     except Exception as e:
         logger.error(f"Download error: {str(e)}")
         
-        # تلاش با تنظیمات fallback
+        # در صورت لغو، fallback اجرا نمی‌شود
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        
+        # تلاش با تنظیمات fallback؛ فرمت بدون حجم مشخص یا بزرگ‌تر از سقف دانلود نمی‌شود
+        limit_mb = selection_limit_bytes() // 1024 // 1024
         try:
             logger.info("Trying fallback download...")
             ydl_opts_fallback = {
-                'outtmpl': f'{DOWNLOAD_DIR}/%(title).100s.%(ext)s',
-                'format': 'best[filesize<50M]/best',
+                'outtmpl': f'{DOWNLOAD_DIR}/%(title).100s-%(id)s-{quality}.%(ext)s',
+                'format': f'best[filesize<{limit_mb}M]/best[filesize_approx<{limit_mb}M]',
                 'quiet': False,
                 'no_warnings': False,
+                'progress_hooks': [progress_hook],
+                # خروجی yt-dlp از مسیر لاگ (با نمونه‌برداری) می‌گذرد، نه مستقیم روی کنسول
+                'logger': logging.getLogger('yt_dlp'),
             }
+            ydl_opts_fallback.update(tuning or {})
             
             if quality == 'audio':
                 ydl_opts_fallback.update({
-                    'format': 'bestaudio[filesize<50M]/bestaudio',
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '192',
-                    }],
+                    'format': f'bestaudio[filesize<{limit_mb}M]/bestaudio[filesize_approx<{limit_mb}M]',
+                    'postprocessors': [MP3_POSTPROCESSOR if AUDIO_MODE == 'mp3' else REMUX_POSTPROCESSOR],
                 })
             
-            with yt_dlp.YoutubeDL(ydl_opts_fallback) as ydl:
-                info = ydl.extract_info(url, download=True)
-                filename = ydl.prepare_filename(info)
+            with load_yt_dlp().YoutubeDL(ydl_opts_fallback) as ydl:
+                if info is not None:
+                    result = ydl.process_ie_result(copy.deepcopy(info), download=True)
+                else:
+                    result = ydl.extract_info(url, download=True)
+                filename = ydl.prepare_filename(result)
                 
                 if quality == 'audio':
-                    base_name = os.path.splitext(filename)[0]
-                    filename = base_name + '.mp3'
-                    if not os.path.exists(filename):
-                        for ext in ['.webm', '.m4a', '.opus', '.mp3']:
-                            temp_file = base_name + ext
-                            if os.path.exists(temp_file):
-                                if ext != '.mp3':
-                                    os.rename(temp_file, filename)
-                                break
+                    filename = locate_audio_file(filename)
                 
                 file_size = os.path.getsize(filename) if os.path.exists(filename) else 0
                 
                 return {
                     'file_path': filename,
-                    'title': info.get('title', 'Unknown'),
+                    'title': result.get('title', 'Unknown'),
                     'file_size': file_size,
-                    'actual_quality': 'best_available'
+                    'actual_quality': 'best_available',
+                    'format_id': result.get('format_id', 'fallback'),
+                    'media_type': media_type_for(quality, filename),
+                    'timings': stage_timings(started, timings)
                 }
                 
         except Exception as fallback_error:
             logger.error(f"Fallback download also failed: {fallback_error}")
+            if isinstance(fallback_error, load_yt_dlp().utils.ExtractorError) and \
+                    'Requested format is not available' in str(fallback_error):
+                return {'refused': 'no_format'}
+            return None
+
+class SingleFlight:
+    """اجرای یک‌باره کارهای همزمان یکسان؛ بقیه درخواست‌ها منتظر نتیجه همان کار می‌مانند"""
+    
+    def __init__(self):
+        self.flights = {}
+    
+    def join(self, key, job_factory):
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = {'task': asyncio.create_task(job_factory()), 'waiters': 0, 'lock': asyncio.Lock()}
+            self.flights[key] = flight
+        flight['waiters'] += 1
+        return flight
+    
+    def leave(self, key):
+        """کم کردن تعداد منتظرها؛ اگر آخرین منتظر بود True برمی‌گرداند"""
+        flight = self.flights[key]
+        flight['waiters'] -= 1
+        if flight['waiters'] > 0:
+            return False
+        del self.flights[key]
+        return True
+
+class QueueFullError(Exception):
+    """صف دانلود پر است؛ پیام خطا مستقیماً به کاربر نمایش داده می‌شود"""
+
+class DownloadScheduler:
+    """صف دانلود محدود با نوبت‌دهی چرخشی بین کاربران، سقف کار همزمان هر کاربر و اولویت کارهای سبک"""
+    
+    def __init__(self, max_active, max_queued, user_active, user_pending):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.user_active_limit = user_active
+        self.user_pending_limit = user_pending
+        self.active = 0
+        self.queued = 0
+        self.active_by_user = {}
+        self.queued_by_user = {}
+        # نوبت چرخشی: کاربری که دیرتر از همه نوبت گرفته جلوتر است
+        self.served_at = {}
+        self.serve_counter = 0
+        # سطح ۰ کارهای سبک (صدا، 144p) و سطح ۱ بقیه
+        self.levels = (OrderedDict(), OrderedDict())
+    
+    def enqueue(self, user_id, cheap):
+        """ثبت کار در صف؛ در صورت پر بودن صف فوراً QueueFullError می‌دهد"""
+        if self.queued >= self.max_queued:
+            raise QueueFullError("🚦 صف دانلود پر است. لطفاً چند دقیقه دیگر دوباره تلاش کنید.")
+        if self.queued_by_user.get(user_id, 0) >= self.user_pending_limit:
+            raise QueueFullError("🚦 شما چند درخواست در صف دارید. لطفاً تا پایان آن‌ها صبر کنید.")
+        
+        ticket = {
+            'user_id': user_id,
+            'level': 0 if cheap else 1,
+            'state': 'queued',
+            'granted': asyncio.get_running_loop().create_future(),
+        }
+        self.levels[ticket['level']].setdefault(user_id, deque()).append(ticket)
+        self.queued += 1
+        self.queued_by_user[user_id] = self.queued_by_user.get(user_id, 0) + 1
+        self.dispatch()
+        return ticket
+    
+    def dispatch(self):
+        """دادن نوبت به کارهای منتظر تا پر شدن ظرفیت"""
+        while self.active < self.max_active:
+            ticket = self.pop_next()
+            if ticket is None:
+                return
+            user_id = ticket['user_id']
+            self.dequeued(ticket)
+            ticket['state'] = 'active'
+            self.active += 1
+            self.active_by_user[user_id] = self.active_by_user.get(user_id, 0) + 1
+            self.serve_counter += 1
+            self.served_at[user_id] = self.serve_counter
+            ticket['granted'].set_result(True)
+    
+    def user_order(self, level):
+        return sorted(level, key=lambda user_id: self.served_at.get(user_id, 0))
+    
+    def pop_next(self):
+        for level in self.levels:
+            for user_id in self.user_order(level):
+                if self.active_by_user.get(user_id, 0) >= self.user_active_limit:
+                    continue
+                tickets = level[user_id]
+                ticket = tickets.popleft()
+                if not tickets:
+                    del level[user_id]
+                return ticket
+        return None
+    
+    def dequeued(self, ticket):
+        user_id = ticket['user_id']
+        self.queued -= 1
+        self.queued_by_user[user_id] -= 1
+        if not self.queued_by_user[user_id]:
+            del self.queued_by_user[user_id]
+    
+    def position(self, ticket):
+        """جایگاه تقریبی کار در صف (با همان ترتیب نوبت‌دهی)"""
+        if ticket['state'] != 'queued':
+            return 0
+        position = 1
+        for level_index, level in enumerate(self.levels):
+            if level_index < ticket['level']:
+                position += sum(len(tickets) for tickets in level.values())
+                continue
+            if level_index > ticket['level']:
+                break
+            own_tickets = level[ticket['user_id']]
+            own_index = own_tickets.index(ticket)
+            before_own = True
+            for user_id in self.user_order(level):
+                tickets = level[user_id]
+                if user_id == ticket['user_id']:
+                    before_own = False
+                    position += own_index
+                else:
+                    position += min(len(tickets), own_index + (1 if before_own else 0))
+        return position
+    
+    async def wait_turn(self, ticket, on_position):
+        """انتظار برای نوبت با اطلاع‌رسانی تغییر جایگاه"""
+        last_position = None
+        while not ticket['granted'].done():
+            position = self.position(ticket)
+            if position != last_position:
+                last_position = position
+                try:
+                    await on_position(position)
+                except Exception as e:
+                    logger.warning(f"Error reporting queue position: {e}")
+            try:
+                await asyncio.wait_for(asyncio.shield(ticket['granted']), QUEUE_POSITION_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    
+    def release(self, ticket):
+        """آزاد کردن ظرفیت (یا حذف کار لغوشده از صف)"""
+        user_id = ticket['user_id']
+        if ticket['state'] == 'active':
+            self.active -= 1
+            self.active_by_user[user_id] -= 1
+            if not self.active_by_user[user_id]:
+                del self.active_by_user[user_id]
+        elif ticket['state'] == 'queued':
+            level = self.levels[ticket['level']]
+            level[user_id].remove(ticket)
+            if not level[user_id]:
+                del level[user_id]
+            self.dequeued(ticket)
+        ticket['state'] = 'done'
+        if user_id not in self.active_by_user and user_id not in self.queued_by_user:
+            self.served_at.pop(user_id, None)
+        self.dispatch()
+    
+    def stats(self):
+        return {'active': self.active, 'queued': self.queued}
+
+class DownloadTuner:
+    """تعیین اتصال‌های هم‌زمان قطعه‌ها و اندازه chunk هر دانلود بر اساس سرعت اندازه‌گیری‌شده و بار فعلی"""
+    
+    def __init__(self, connection_budget, max_fragments, min_chunk, max_chunk, chunk_seconds):
+        self.connection_budget = connection_budget
+        self.max_fragments = max_fragments
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.chunk_seconds = chunk_seconds
+        self.jobs = {}
+        self.job_counter = 0
+        # میانگین نمایی سرعت هر اتصال (بایت بر ثانیه)؛ تا اولین اندازه‌گیری نامشخص است
+        self.connection_throughput = None
+        self.recent = deque(maxlen=20)
+    
+    def start(self, video_id, progress):
+        """ثبت دانلود جدید و تنظیمات yt-dlp آن؛ سهم اتصال هر کار با زیاد شدن کارهای هم‌زمان کم می‌شود"""
+        self.job_counter += 1
+        job_id = self.job_counter
+        connections = max(1, min(self.max_fragments, self.connection_budget // (len(self.jobs) + 1)))
+        if self.connection_throughput:
+            chunk_size = int(self.connection_throughput * self.chunk_seconds)
+        else:
+            chunk_size = self.max_chunk
+        chunk_size = max(self.min_chunk, min(self.max_chunk, chunk_size))
+        tuning = {'concurrent_fragment_downloads': connections, 'http_chunk_size': chunk_size}
+        self.jobs[job_id] = {'video_id': video_id, 'progress': progress, 'tuning': tuning}
+        return job_id, tuning
+    
+    def finish(self, job_id, file_size=0, seconds=0):
+        """پایان دانلود؛ سرعت کارهای موفق در میانگین سرعت هر اتصال اثر داده می‌شود"""
+        job = self.jobs.pop(job_id, None)
+        if job is None or not file_size or not seconds or seconds <= 0:
             return None
+        throughput = file_size / seconds
+        per_connection = throughput / job['tuning']['concurrent_fragment_downloads']
+        if self.connection_throughput is None:
+            self.connection_throughput = per_connection
+        else:
+            self.connection_throughput = 0.7 * self.connection_throughput + 0.3 * per_connection
+        self.recent.append({'video_id': job['video_id'], 'throughput': throughput, **job['tuning']})
+        logger.info(
+            f"Download {job['video_id']} finished at {throughput / 1024 / 1024:.2f}MB/s "
+            f"with {job['tuning']['concurrent_fragment_downloads']} connections, "
+            f"chunk {job['tuning']['http_chunk_size'] // 1024}KB"
+        )
+        return throughput
+    
+    def stats(self):
+        """سرعت لحظه‌ای کارهای در حال اجرا و میانگین سرعت هر اتصال"""
+        values = {('download_connection_throughput_bytes', ()): int(self.connection_throughput or 0)}
+        for job_id, job in self.jobs.items():
+            progress = job['progress']
+            speed = progress.get('speed', 0) if progress is not None else 0
+            labels = (('job', job_id), ('video_id', job['video_id']))
+            values[('download_job_throughput_bytes', labels)] = int(speed or 0)
+            values[('download_job_connections', labels)] = job['tuning']['concurrent_fragment_downloads']
+        return values
+
+download_flights = SingleFlight()
+download_scheduler = DownloadScheduler(DOWNLOAD_CAPACITY, QUEUE_MAX_JOBS, QUEUE_USER_ACTIVE, QUEUE_USER_PENDING)
+download_tuner = DownloadTuner(
+    DOWNLOAD_CONNECTIONS, FRAGMENT_CONCURRENCY_MAX, HTTP_CHUNK_MIN, HTTP_CHUNK_MAX, HTTP_CHUNK_SECONDS
+)
+
+async def run_download_job(url, quality, video_id, ticket, status_message, progress=None):
+    """انتظار برای نوبت در صف و اجرای دانلود در استخر کارگر"""
+    async def report_position(position):
+        if status_message is not None:
+            await status_message.edit_text(f"⏳ در صف دانلود هستید؛ جایگاه {position} در صف...")
+    
+    job_id = None
+    result = None
+    try:
+        await download_scheduler.wait_turn(ticket, report_position)
+        job_journal.update(video_id, quality, 'downloading')
+        if status_message is not None:
+            await status_message.edit_text("⏳ در حال دانلود با بهترین کیفیت موجود...")
+        
+        # اطلاعات کش‌شده به کارگر داده می‌شود تا استخراج تکرار نشود
+        raw_info = info_cache.get(video_id)
+        cancel_event = threading.Event()
+        tuning = None
+        if ADAPTIVE_DOWNLOADS:
+            job_id, tuning = download_tuner.start(video_id, progress)
+        result = await run_in_worker(
+            'download', 'download', download_video_robust, url, quality, cancel_event, raw_info, progress, tuning,
+            cancel_event=cancel_event, progress=progress
+        )
+    except BaseException:
+        # فایل .part کار ثبت‌شده هنگام خاموش شدن برای ادامه دانلود می‌ماند
+        if not checkpointing:
+            discard_partial_download(progress)
+        raise
+    finally:
+        download_scheduler.release(ticket)
+        if job_id is not None:
+            # زمان پس‌پردازش در سرعت دانلود حساب نمی‌شود
+            download_tuner.finish(
+                job_id, result.get('file_size', 0) if result else 0,
+                result.get('timings', {}).get('download', 0) if result else 0
+            )
+    
+    if not result:
+        metrics.inc('failures_total', type='download_failed')
+        discard_partial_download(progress)
+        return None
+    if result.get('refused'):
+        metrics.inc('failures_total', type=result['refused'])
+        return result
+    for stage, seconds in result.get('timings', {}).items():
+        metrics.observe('stage_seconds', seconds, stage=stage)
+    if result['actual_quality'] == 'best_available':
+        metrics.inc('download_fallbacks_total')
+    metrics.inc('downloaded_bytes_total', result['file_size'])
+    if not os.path.exists(result['file_path']):
+        return result
+    media_key = (video_id, result['format_id'], media_postprocess(quality))
+    return media_store.add(media_key, result)
+
+async def stored_download(result):
+    """نتیجه آماده از مخزن فایل‌ها (بدون صف و دانلود)"""
+    return result
+
+def media_postprocess(quality):
+    """برچسب پس‌پردازش برای کلید مخزن فایل‌ها"""
+    return AUDIO_MODE if quality == 'audio' else 'none'
+
+def discard_partial_download(progress):
+    """حذف فایل .part یک دانلود ناموفق یا لغوشده"""
+    tmpfilename = progress.get('tmpfilename') if progress is not None else None
+    if tmpfilename and tmpfilename.endswith('.part') and os.path.exists(tmpfilename):
+        try:
+            os.remove(tmpfilename)
+        except OSError as e:
+            logger.error(f"Error deleting partial download: {e}")
+
+def can_stream_upload(quality, format_id, info):
+    """فقط فرمت‌های تک‌فایلی http بدون ادغام و پس‌پردازش هم‌زمان با دانلود آپلود می‌شوند
+    
+    فرمتی که برای تقسیم انتخاب شده (بزرگ‌تر از سقف یک فایل) جریانی آپلود نمی‌شود، چون آپلود
+    پس از سقف قطع می‌شد و کل فایل دوباره به صورت بخش‌بخش ارسال می‌شد.
+    """
+    if not STREAM_UPLOADS or LOCAL_BOT_API or quality == 'audio' or not info or '+' in format_id:
+        return False
+    fmt = next((f for f in info.get('formats', []) if f.get('format_id') == format_id), None)
+    if fmt is None or fmt.get('protocol') not in ('http', 'https'):
+        return False
+    size = estimate_format_size(fmt, info.get('duration'))
+    return size is not None and STREAM_MIN_SIZE * 1024 * 1024 <= size <= MAX_FILE_SIZE * 1024 * 1024
+
+async def read_growing_file(progress, download_task, quality, max_bytes):
+    """خواندن تکه‌تکه فایل در حال دانلود؛ حافظه مصرفی به اندازه یک تکه محدود است"""
+    path = progress.get('tmpfilename')
+    try:
+        file = open(path, 'rb')
+    except OSError:
+        # دانلود تمام شده و فایل .part تغییر نام داده یا (در انتظار نوبت زمان‌بند) به مخزن منتقل شده است
+        try:
+            file = open(progress.get('filename') or path, 'rb')
+        except OSError:
+            result = download_task.result() if download_task.done() else None
+            if not result or not result.get('file_path'):
+                raise
+            file = open(result['file_path'], 'rb')
+    
+    with file:
+        sent_bytes = 0
+        while True:
+            finished = download_task.done()
+            chunk = file.read(STREAM_CHUNK_SIZE)
+            if chunk:
+                sent_bytes += len(chunk)
+                if sent_bytes > max_bytes:
+                    raise ValueError("Streamed file exceeds the size limit")
+                yield chunk
+                continue
+            if finished:
+                break
+            await asyncio.sleep(STREAM_POLL_INTERVAL)
+    
+    # اگر دانلود شکست خورد یا به مسیر fallback رفت، آپلود نیمه‌کاره باطل می‌شود
+    result = download_task.result()
+    if not result or result.get('actual_quality') != quality:
+        raise ValueError("Download did not finish with the streamed format")
+
+async def multipart_body(fields, file_field, file_name, chunks, boundary):
+    """ساخت بدنه multipart به صورت جریانی"""
+    for name, value in fields.items():
+        yield (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+        ).encode('utf-8')
+    yield (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{file_name}"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode('utf-8')
+    async for chunk in chunks:
+        yield chunk
+    yield f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+def get_stream_client():
+    """کلاینت HTTP مشترک آپلودهای جریانی (هم‌اندازه استخر اتصال media)"""
+    global stream_client
+    if stream_client is None:
+        stream_client = httpx.AsyncClient(
+            timeout=UPLOAD_TIMEOUT, limits=httpx.Limits(max_connections=MEDIA_POOL_SIZE)
+        )
+    return stream_client
+
+async def close_stream_client():
+    global stream_client
+    if stream_client is not None:
+        await stream_client.aclose()
+        stream_client = None
+
+async def stream_upload_video(bot, chat_id, caption, open_chunks):
+    """ارسال sendVideo با بدنه chunked بدون خواندن کل فایل در حافظه
+    
+    درخواست از همان زمان‌بند بقیه درخواست‌ها (سطل سراسری و چت، retry_after) می‌گذرد؛ open_chunks
+    در هر تلاش از نو صدا زده می‌شود تا پس از 429 فایل از ابتدا خوانده شود.
+    """
+    fields = {'chat_id': chat_id, 'caption': caption, 'supports_streaming': 'true'}
+    
+    async def post():
+        boundary = secrets.token_hex(16)
+        metrics.inc('api_requests_total', pool='media')
+        response = await get_stream_client().post(
+            f"{BOT_API_URL}/bot{BOT_TOKEN}/sendVideo",
+            content=multipart_body(fields, 'video', 'video.mp4', open_chunks(), boundary),
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}'},
+        )
+        data = response.json()
+        if not data.get('ok'):
+            retry_after = (data.get('parameters') or {}).get('retry_after')
+            if retry_after is not None:
+                raise RetryAfter(retry_after)
+            raise BadRequest(data.get('description', 'Upload failed'))
+        return data['result']
+    
+    if bot.rate_limiter is None:
+        result = await post()
+    else:
+        result = await bot.rate_limiter.process_request(post, (), {}, 'sendVideo', {'chat_id': chat_id}, None)
+    return Message.de_json(result, bot)
+
+async def upload_while_downloading(message, flight, video_id, quality):
+    """آپلود هم‌زمان با دانلود؛ در صورت خطا None برمی‌گرداند تا مسیر عادی اجرا شود"""
+    progress = flight['progress']
+    
+    # پیش از باز کردن اتصال آپلود، منتظر شروع نوشتن فایل می‌مانیم (ممکن است کار هنوز در صف باشد)
+    while not progress.get('tmpfilename') and not flight['task'].done():
+        await asyncio.sleep(STREAM_POLL_INTERVAL)
+    if not progress.get('tmpfilename'):
+        return None
+    
+    title = (info_cache.get(video_id) or {}).get('title', 'Unknown')
+    try:
+        await message.edit_text("📥📤 در حال دانلود و آپلود هم‌زمان...")
+        with metrics.timer('stream_upload'):
+            sent_message = await stream_upload_video(
+                message.get_bot(), message.chat_id, f"🎬 {title[:60]}",
+                lambda: read_growing_file(progress, flight['task'], quality, MAX_FILE_SIZE * 1024 * 1024)
+            )
+    except Exception as e:
+        logger.warning(f"Streaming upload failed, falling back to regular upload: {e}")
+        return None
+    
+    download_result = await asyncio.shield(flight['task'])
+    metrics.inc('uploaded_bytes_total', download_result['file_size'])
+    remember_file_id(sent_message, video_id, quality, download_result)
+    return download_result
+
+def finish_flight(flight):
+    """لغو دانلود مشترکی که دیگر منتظری ندارد (فایل‌های کامل در مخزن می‌مانند)"""
+    if not flight['task'].done():
+        flight['task'].cancel()
+    if flight.get('split'):
+        discard_split(flight['split']['dir'])
+
+def media_input(file_path):
+    """ورودی فایل برای آپلود: در حالت Bot API محلی فقط مسیر فایل (بدون عبور بایت‌ها از پایتون)"""
+    if LOCAL_BOT_API:
+        return Path(file_path).resolve()
+    return open(file_path, 'rb')
+
+async def send_cached_media(message, cached):
+    """ارسال فایل با file_id ذخیره‌شده؛ اگر تلگرام آن را رد کند از کش حذف می‌شود"""
+    try:
+        if cached['media_type'] == 'audio':
+            await message.reply_audio(
+                audio=cached['file_id'],
+                caption=f"🎵 {cached['title'][:60]}",
+                title=cached['title'][:30]
+            )
+        elif cached['media_type'] == 'voice':
+            await message.reply_voice(
+                voice=cached['file_id'],
+                caption=f"🎵 {cached['title'][:60]}"
+            )
+        else:
+            await message.reply_video(
+                video=cached['file_id'],
+                caption=f"🎬 {cached['title'][:60]}",
+                supports_streaming=True
+            )
+        return True
+    except BadRequest as e:
+        logger.warning(f"Stale file_id for {cached['video_id']}: {e}")
+        file_id_store.invalidate(cached['video_id'], cached['quality'], cached['format_id'])
+        return False
+
+def remember_file_id(sent_message, video_id, quality, download_result):
+    """ذخیره file_id برگشتی تلگرام پس از اولین آپلود"""
+    if sent_message is None:
+        return
+    media = sent_message.audio or sent_message.voice or sent_message.video or sent_message.document
+    if media is None:
+        return
+    try:
+        file_id_store.put(
+            video_id, quality, download_result['format_id'], media.file_id, download_result['media_type'],
+            download_result['title'], download_result['file_size']
+        )
+    except sqlite3.Error as e:
+        logger.error(f"Error storing file_id: {e}")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """دستور شروع"""
@@ -367,14 +2273,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 ⚡ **قابلیت‌ها:**
 • دانلود با کیفیت‌های مختلف (144p تا 720p)
-• دانلود صدا (MP3)
+• دانلود صدا ({AUDIO_LABEL})
 • پشتیبانی از اکثر لینک‌های یوتیوب
+• دانلود پلی‌لیست یا چند لینک در یک پیام (حداکثر {PLAYLIST_MAX_ITEMS} ویدیو)
 • مدیریت خودکار فرمت‌های در دسترس
 • دانلود سریع و پایدار
 
 ⚠️ **نکات مهم:**
 • حداکثر حجم فایل: {MAX_FILE_SIZE}MB 
-• پلی‌لیست پشتیبانی نمی‌شود
 • در صورت عدم وجود کیفیت مورد نظر، بهترین کیفیت موجود دانلود می‌شود
 
 🔧 **کیفیت‌های موجود:**
@@ -383,14 +2289,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 - 360p (خوب)
 - 480p (عالی)
 - 720p (HD)
-- صدا (MP3)
+- صدا ({AUDIO_LABEL})
     """
     
     await update.message.reply_text(welcome_text, parse_mode='Markdown')
 
+def rate_limit_text(wait):
+    return f"⏳ درخواست‌های شما زیاد است. لطفاً {int(wait) + 1} ثانیه دیگر دوباره تلاش کنید."
+
 async def handle_youtube_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """پردازش لینک یوتیوب"""
     user_id = update.effective_user.id
+    log_context.set({'user_id': user_id})
+    
+    # محدودیت نرخ پیش از هر درخواست به تلگرام یا yt-dlp بررسی می‌شود
+    wait, notify = user_limiter.check(user_id, 'metadata')
+    if wait:
+        metrics.inc('rate_limited_total', kind='metadata')
+        if notify:
+            await update.message.reply_text(rate_limit_text(wait))
+        return
     
     if not await is_user_member(user_id, context):
         message_text = "لطفاً اول در کانال ما عضو شوید! 🎯"
@@ -404,16 +2322,28 @@ async def handle_youtube_url(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     url = update.message.text.strip()
     
+    # پلی‌لیست یا چند لینک در یک پیام به صورت دسته‌ای دانلود می‌شود
+    batch_request = parse_batch_request(url)
+    if batch_request:
+        await handle_batch_request(update, batch_request)
+        return
+    
     # بررسی معتبر بودن لینک
-    youtube_pattern = r'(https?://)?(www\.)?(youtube|youtu)\.(com|be)/(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})'
-    if not re.match(youtube_pattern, url):
+    with metrics.timer('validate'):
+        valid_url = re.match(YOUTUBE_PATTERN, url)
+    if not valid_url:
         await update.message.reply_text("❌ لطفاً یک لینک معتبر یوتیوب ارسال کنید.")
         return
     
     processing_msg = await update.message.reply_text("🔍 در حال دریافت اطلاعات ویدیو...")
     
-    video_info = get_video_info(url)
+    try:
+        with metrics.timer('extract'):
+            video_info = await run_in_worker('extract', 'extract', get_video_info, url)
+    except asyncio.TimeoutError:
+        video_info = None
     if not video_info:
+        metrics.inc('failures_total', type='extract_failed')
         await processing_msg.edit_text("❌ خطا در دریافت اطلاعات ویدیو. لطفاً از معتبر بودن لینک اطمینان حاصل کنید.")
         return
     
@@ -431,13 +2361,27 @@ async def handle_youtube_url(update: Update, context: ContextTypes.DEFAULT_TYPE)
 💡 *در صورت عدم وجود کیفیت مورد نظر، بهترین کیفیت موجود دانلود می‌شود*
     """
     
+    # فرمت هر دکمه همین حالا از اطلاعات استخراج‌شده انتخاب و در جلسه نگه داشته می‌شود؛
+    # خود اطلاعات ویدیو فقط در info_cache (با سقف تعداد) می‌ماند تا جلسه‌ها چند بایت بیشتر نباشند
+    video_id = extract_video_id(url)
+    raw_info = info_cache.get(video_id)
+    formats = {}
+    if raw_info is not None:
+        index = build_format_index(raw_info, selection_limit_bytes())
+        formats = {quality: select_format(index, quality) for quality in QUALITY_NAMES}
+    token = secrets.token_urlsafe(6)
+    selection_sessions.set(token, {
+        'user_id': user_id, 'url': url, 'video_id': video_id, 'formats': formats,
+    })
+    
+    # callback_data: {کیفیت}_{شناسه ۱۱ کاراکتری ویدیو}{توکن} (همیشه زیر سقف ۶۴ بایت)
     keyboard = [
-        [InlineKeyboardButton("144p (سریع)", callback_data=f"144_{url}")],
-        [InlineKeyboardButton("240p (متوسط)", callback_data=f"240_{url}")],
-        [InlineKeyboardButton("360p (خوب)", callback_data=f"360_{url}")],
-        [InlineKeyboardButton("480p (عالی)", callback_data=f"480_{url}")],
-        [InlineKeyboardButton("720p (HD)", callback_data=f"720_{url}")],
-        [InlineKeyboardButton("🎵 صدا (MP3)", callback_data=f"audio_{url}")],
+        [InlineKeyboardButton("144p (سریع)", callback_data=f"144_{video_id}{token}")],
+        [InlineKeyboardButton("240p (متوسط)", callback_data=f"240_{video_id}{token}")],
+        [InlineKeyboardButton("360p (خوب)", callback_data=f"360_{video_id}{token}")],
+        [InlineKeyboardButton("480p (عالی)", callback_data=f"480_{video_id}{token}")],
+        [InlineKeyboardButton("720p (HD)", callback_data=f"720_{video_id}{token}")],
+        [InlineKeyboardButton(f"🎵 صدا ({AUDIO_LABEL})", callback_data=f"audio_{video_id}{token}")],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -446,117 +2390,863 @@ async def handle_youtube_url(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def handle_quality_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """پردازش انتخاب کیفیت"""
     query = update.callback_query
-    await query.answer()
-    
     user_id = query.from_user.id
     
-    if not await is_user_member(user_id, context):
-        message_text = "لطفاً اول در کانال ما عضو شوید! 🎯"
-        await query.message.edit_text(message_text)
-        return
+    # پاسخ رد محدودیت نرخ همان answer دکمه است (تنها درخواست به تلگرام)
+    if query.data != "check_membership":
+        wait, notify = user_limiter.check(user_id, 'download')
+        if wait:
+            metrics.inc('rate_limited_total', kind='download')
+            await query.answer(rate_limit_text(wait) if notify else None, show_alert=notify)
+            return
+    await query.answer()
     
+    # دکمه بررسی عضویت همیشه کش را دور می‌زند
     if query.data == "check_membership":
-        if await is_user_member(user_id, context):
+        if await is_user_member(user_id, context, refresh=True):
             await query.message.edit_text("✅ شما در کانال عضو هستید! لطفا دوباره /start را ارسال کنید.")
         else:
             await query.message.edit_text("❌ شما هنوز در کانال عضو نشده‌اید. لطفاً ابتدا در کانال عضو شوید.")
         return
     
+    if not await is_user_member(user_id, context):
+        message_text = "لطفاً اول در کانال ما عضو شوید! 🎯"
+        await query.message.edit_text(message_text)
+        return
+    
     parts = query.data.split('_', 1)
     if len(parts) != 2:
         await query.message.edit_text("❌ خطا در پردازش درخواست.")
         return
     
-    quality, url = parts
+    quality, selection = parts
+    best_format = None
+    if re.match(YOUTUBE_PATTERN, selection):
+        # دکمه‌های قدیمی که خود لینک را داشتند
+        url = selection
+    else:
+        video_id, token = selection[:11], selection[11:]
+        session = selection_sessions.get(token)
+        if session is not None and session['video_id'] == video_id and session['user_id'] == user_id:
+            url = session['url']
+            best_format = session['formats'].get(quality)
+        else:
+            # جلسه منقضی شده، در پردازه دیگری ساخته شده یا مال کاربر دیگری است (دکمه فورواردشده)؛
+            # مسیر عادی با استخراج دوباره
+            url = f"https://www.youtube.com/watch?v={video_id}"
     
-    quality_names = {
-        '144': '144p', '240': '240p', '360': '360p', 
-        '480': '480p', '720': '720p', 'audio': 'صدا (MP3)'
-    }
+    if not accepting_jobs:
+        await query.message.edit_text("🔄 ربات در حال راه‌اندازی مجدد است. لطفاً چند دقیقه دیگر دوباره تلاش کنید.")
+        return
     
+    await process_download_request(query.message, user_id, url, quality, best_format=best_format)
+
+async def process_download_request(message, user_id, url, quality, job_id=None, best_format=None):
+    """اجرای یک درخواست دانلود (از دکمه کیفیت یا ادامه کار ثبت‌شده در دفتر کارها)"""
+    if job_id is None:
+        job_id = f"{message.chat_id}:{message.message_id}:{quality}"
+        # تحویل دوباره همان دکمه (مثلاً آپدیت کارگری که از کار افتاده) کاری را که در دفتر کارها
+        # ثبت شده و ادامه پیدا می‌کند دوباره اجرا نمی‌کند
+        if job_id in active_jobs or job_journal.exists(job_id):
+            logger.info(f"Ignoring repeated request for job {job_id}")
+            return
+    log_context.set({'job_id': job_id, 'user_id': user_id})
+    active_jobs[job_id] = asyncio.current_task()
+    try:
+        await run_download_request(message, user_id, url, quality, job_id, best_format)
+    except asyncio.CancelledError:
+        if checkpointing:
+            try:
+                await message.edit_text("🔄 ربات در حال راه‌اندازی مجدد است؛ دانلود پس از راه‌اندازی ادامه پیدا می‌کند.")
+            except Exception as e:
+                logger.warning(f"Error reporting checkpointed job: {e}")
+        raise
+    finally:
+        active_jobs.pop(job_id, None)
+        # کارهای ثبت‌شده هنگام خاموش شدن برای اجرای بعدی در دفتر می‌مانند
+        if not checkpointing:
+            job_journal.finish(job_id)
+
+async def run_download_request(message, user_id, url, quality, job_id, best_format=None):
+    """بررسی فرمت، کش‌ها، صف و دانلود مشترک و ارسال نتیجه (best_format از جلسه انتخاب کیفیت)"""
+    quality_names = QUALITY_NAMES
     quality_name = quality_names.get(quality, 'نامشخص')
     
-    await query.message.edit_text(f"⏳ در حال بررسی فرمت‌های موجود برای کیفیت {quality_name}...")
-    
-    # بررسی فرمت‌های موجود
-    best_format = get_best_available_format(url, quality)
+    # بررسی فرمت‌های موجود (فقط اگر از جلسه انتخاب کیفیت معلوم نباشد)
+    if best_format is None:
+        await message.edit_text(f"⏳ در حال بررسی فرمت‌های موجود برای کیفیت {quality_name}...")
+        try:
+            with metrics.timer('format'):
+                best_format = await run_in_worker('extract', 'format', get_best_available_format, url, quality)
+        except asyncio.TimeoutError:
+            best_format = None
     if not best_format:
-        await query.message.edit_text("❌ متأسفانه هیچ فرمت مناسبی برای این ویدیو پیدا نشد. لطفاً ویدیوی دیگری را امتحان کنید.")
+        metrics.inc('failures_total', type='no_format')
+        await message.edit_text(no_format_text())
+        return
+    
+    # اگر این فایل قبلاً آپلود شده، همان file_id دوباره ارسال می‌شود
+    video_id = extract_video_id(url) or url
+    cached = file_id_store.get(video_id, quality, best_format)
+    if cached and await send_cached_media(message, cached):
+        metrics.inc('cache_hits_total', cache='file_id')
+        file_size_mb = cached['file_size'] / 1024 / 1024
+        await message.edit_text(f"✅ دانلود با موفقیت انجام شد!\n📁 حجم فایل: {file_size_mb:.1f}MB")
         return
     
-    await query.message.edit_text(f"⏳ در حال دانلود با بهترین کیفیت موجود...")
+    # از این‌جا به بعد کار در دفتر کارها ثبت می‌شود تا پس از راه‌اندازی دوباره ادامه پیدا کند
+    title = (info_cache.get(video_id) or {}).get('title')
+    job_journal.record(job_id, user_id, message.chat_id, message.message_id, url, video_id, quality, title)
+    
+    # درخواست‌های همزمان یکسان فقط یک دانلود مشترک اجرا می‌کنند
+    flight_key = (video_id, quality)
+    leader = flight_key not in download_flights.flights
+    stored = None
+    if leader:
+        # فایل کامل همین فرمت اگر هنوز روی دیسک باشد دوباره دانلود نمی‌شود
+        stored = media_store.lookup((video_id, best_format, media_postprocess(quality)))
+    if leader and not stored:
+        try:
+            ticket = download_scheduler.enqueue(user_id, quality in CHEAP_QUALITIES)
+        except QueueFullError as e:
+            metrics.inc('failures_total', type='queue_full')
+            await message.edit_text(str(e))
+            return
+    progress = {}
+    if stored:
+        metrics.inc('cache_hits_total', cache='media_store')
+        job_factory = lambda: stored_download(stored)
+    else:
+        job_factory = lambda: run_download_job(url, quality, video_id, ticket, message, progress)
+    flight = download_flights.join(flight_key, job_factory)
+    if leader:
+        flight['progress'] = progress
+        flight['stream'] = not stored and can_stream_upload(quality, best_format, info_cache.get(video_id))
+    try:
+        await deliver_download(message, flight, video_id, quality, quality_names, leader)
+    finally:
+        if download_flights.leave(flight_key):
+            finish_flight(flight)
+
+async def deliver_download(message, flight, video_id, quality, quality_names, leader):
+    """انتظار برای دانلود مشترک و ارسال نتیجه به کاربر"""
+    # پیام وضعیت شروع‌کننده دانلود را خود کار دانلود (جایگاه صف) به‌روز می‌کند
+    if not leader:
+        await message.edit_text(f"⏳ در حال دانلود با بهترین کیفیت موجود...")
+    
+    # حالت جریانی: آپلود هم‌زمان با دانلود برای شروع‌کننده دانلود
+    if leader and flight.get('stream'):
+        async with flight['lock']:
+            download_result = await upload_while_downloading(message, flight, video_id, quality)
+        if download_result:
+            file_size_mb = download_result['file_size'] / 1024 / 1024
+            await message.edit_text(f"✅ دانلود با موفقیت انجام شد!\n📁 حجم فایل: {file_size_mb:.1f}MB")
+            return
     
-    # دانلود فایل
-    download_result = download_video_robust(url, quality)
+    try:
+        download_result = await asyncio.shield(flight['task'])
+    except asyncio.TimeoutError:
+        metrics.inc('failures_total', type='download_timeout')
+        await message.edit_text("⏰ زمان دانلود به پایان رسید. لطفاً کیفیت پایین‌تری انتخاب کنید.")
+        return
     
     if not download_result:
-        await query.message.edit_text("❌ خطا در دانلود ویدیو. لطفاً دوباره تلاش کنید یا ویدیوی دیگری را امتحان کنید.")
+        await message.edit_text("❌ خطا در دانلود ویدیو. لطفاً دوباره تلاش کنید یا ویدیوی دیگری را امتحان کنید.")
+        return
+    
+    if download_result.get('refused'):
+        await message.edit_text(no_format_text())
         return
     
     if not os.path.exists(download_result['file_path']):
-        await query.message.edit_text("❌ فایل دانلود شده یافت نشد.")
+        await message.edit_text("❌ فایل دانلود شده یافت نشد.")
         return
     
     file_size_mb = download_result['file_size'] / 1024 / 1024
+    media_key = download_result.get('media_key')
+    job_journal.update(video_id, quality, 'uploading')
     
-    # محدودیت حجم به 50MB
-    if file_size_mb > MAX_FILE_SIZE:
+    # محدودیت حجم (50MB یا سقف Bot API محلی)؛ در حالت تقسیم، فایل به چند بخش ارسال می‌شود
+    if file_size_mb > MAX_FILE_SIZE and can_split(download_result):
+        media_store.acquire(media_key)
         try:
-            os.remove(download_result['file_path'])
-        except:
-            pass
-        await query.message.edit_text(
+            sent = await send_split_result(message, flight, download_result, video_id, quality, message)
+        except asyncio.TimeoutError:
+            metrics.inc('failures_total', type='upload_timeout')
+            await message.edit_text("⏰ زمان آپلود به پایان رسید. لطفاً کیفیت پایین‌تری انتخاب کنید.")
+            return
+        except Exception as e:
+            metrics.inc('failures_total', type='upload_error')
+            logger.error(f"Error sending split file: {str(e)}")
+            await message.edit_text("❌ خطا در ارسال فایل. لطفاً دوباره تلاش کنید.")
+            return
+        finally:
+            media_store.release(media_key)
+        if sent:
+            await message.edit_text(
+                f"✅ دانلود با موفقیت انجام شد!\n📁 حجم فایل: {file_size_mb:.1f}MB "
+                f"(در {len(flight['split']['parts'])} بخش)"
+            )
+            return
+    if file_size_mb > MAX_FILE_SIZE:
+        metrics.inc('failures_total', type='too_large')
+        media_store.discard(media_key)
+        await message.edit_text(
             f"❌ حجم فایل ({file_size_mb:.1f}MB) بیش از حد مجاز ({MAX_FILE_SIZE}MB) است.\n"
             "لطفاً کیفیت پایین‌تری انتخاب کنید."
         )
         return
     
-    # ارسال فایل با timeout افزایش یافته
+    # فایل تا پایان آپلود از حذف LRU در امان است
+    media_store.acquire(media_key)
     try:
-        actual_quality = download_result.get('actual_quality', quality)
-        quality_display = quality_names.get(actual_quality, actual_quality)
-        
-        await query.message.edit_text(f"📤 در حال آپلود فایل ({file_size_mb:.1f}MB) با کیفیت {quality_display}...")
-        
-        if quality == 'audio':
-            await query.message.reply_audio(
-                audio=open(download_result['file_path'], 'rb'),
-                caption=f"🎵 {download_result['title'][:60]}",
-                title=download_result['title'][:30],
-                read_timeout=UPLOAD_TIMEOUT,
-                write_timeout=UPLOAD_TIMEOUT,
-                connect_timeout=UPLOAD_TIMEOUT,
-                pool_timeout=UPLOAD_TIMEOUT
-            )
-        else:
-            await query.message.reply_video(
-                video=open(download_result['file_path'], 'rb'),
-                caption=f"🎬 {download_result['title'][:60]}",
-                supports_streaming=True,
-                read_timeout=UPLOAD_TIMEOUT,
-                write_timeout=UPLOAD_TIMEOUT,
-                connect_timeout=UPLOAD_TIMEOUT,
-                pool_timeout=UPLOAD_TIMEOUT
-            )
-        
-        success_message = f"✅ دانلود با موفقیت انجام شد!\n📁 حجم فایل: {file_size_mb:.1f}MB"
-        if actual_quality != quality:
-            success_message += f"\n🎯 کیفیت واقعی: {quality_display} (بهترین کیفیت موجود)"
-        
-        await query.message.edit_text(success_message)
+        await send_download_result(message, flight, download_result, video_id, quality, quality_names)
+    finally:
+        media_store.release(media_key)
+
+async def upload_media(message, download_result, quality):
+    """آپلود فایل دانلودشده به صورت پاسخ به پیام با timeout افزایش یافته"""
+    upload_started = time.monotonic()
+    
+    if download_result['media_type'] == 'voice':
+        sent_message = await message.reply_voice(
+            voice=media_input(download_result['file_path']),
+            caption=f"🎵 {download_result['title'][:60]}",
+            read_timeout=UPLOAD_TIMEOUT,
+            write_timeout=UPLOAD_TIMEOUT,
+            connect_timeout=UPLOAD_TIMEOUT,
+            pool_timeout=UPLOAD_TIMEOUT
+        )
+    elif quality == 'audio':
+        sent_message = await message.reply_audio(
+            audio=media_input(download_result['file_path']),
+            caption=f"🎵 {download_result['title'][:60]}",
+            title=download_result['title'][:30],
+            read_timeout=UPLOAD_TIMEOUT,
+            write_timeout=UPLOAD_TIMEOUT,
+            connect_timeout=UPLOAD_TIMEOUT,
+            pool_timeout=UPLOAD_TIMEOUT
+        )
+    else:
+        sent_message = await message.reply_video(
+            video=media_input(download_result['file_path']),
+            caption=f"🎬 {download_result['title'][:60]}",
+            supports_streaming=True,
+            read_timeout=UPLOAD_TIMEOUT,
+            write_timeout=UPLOAD_TIMEOUT,
+            connect_timeout=UPLOAD_TIMEOUT,
+            pool_timeout=UPLOAD_TIMEOUT
+        )
+    metrics.observe('stage_seconds', time.monotonic() - upload_started, stage='upload')
+    metrics.inc('uploaded_bytes_total', download_result['file_size'])
+    return sent_message
+
+async def run_media_tool(*args):
+    """اجرای ffmpeg/ffprobe در پردازه جدا بدون مسدود کردن حلقه رویداد (خروجی استاندارد برگردانده می‌شود)"""
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(f"{args[0]} failed: {stderr.decode(errors='replace')[-300:]}")
+    return stdout.decode(errors='replace')
+
+async def probe_keyframes(file_path):
+    """زمان فریم‌های کلیدی (فقط از روی بسته‌ها، بدون رمزگشایی) و مدت فایل"""
+    duration = float((await run_media_tool(
+        'ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', file_path
+    )).strip() or 0)
+    # فایل صوتی جریان تصویر ندارد و همه بسته‌های صدا کلیدی هستند
+    for stream in ('v:0', 'a:0'):
+        output = await run_media_tool(
+            'ffprobe', '-v', 'error', '-select_streams', stream,
+            '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', file_path
+        )
+        keyframes = []
+        for line in output.splitlines():
+            pts_time, _, flags = line.partition(',')
+            if 'K' in flags and pts_time not in ('', 'N/A'):
+                keyframes.append(float(pts_time))
+        if keyframes:
+            return sorted(keyframes), duration
+    return [], duration
+
+def plan_segments(keyframes, duration, file_size, max_bytes):
+    """تقسیم فایل در مرز فریم‌های کلیدی به بخش‌هایی که با نرخ بیت میانگین زیر سقف حجم بمانند"""
+    max_seconds = max_bytes / (file_size / duration)
+    segments = []
+    start = 0.0
+    candidate = None
+    # پایان فایل هم مرزی است که باید بررسی شود تا بخش آخر از سقف بیشتر نشود
+    for keyframe in [*keyframes, duration]:
+        if keyframe <= start:
+            continue
+        if keyframe - start > max_seconds and candidate is not None:
+            segments.append((start, candidate))
+            start = candidate
+        candidate = keyframe
+    segments.append((start, duration))
+    return segments
+
+async def cut_segment(file_path, start, end, output_path, is_last):
+    """برش یک بخش با کپی جریان (بدون رمزگذاری دوباره)"""
+    # -ss پیش از ورودی با کپی جریان از فریم کلیدی قبل از زمان داده‌شده شروع می‌کند
+    args = ['ffmpeg', '-v', 'error', '-y', '-ss', f"{start + 0.001:.3f}", '-i', file_path]
+    if not is_last:
+        args += ['-t', f"{end - start:.3f}"]
+    args += ['-map', '0', '-c', 'copy', '-avoid_negative_ts', 'make_zero']
+    if os.path.splitext(output_path)[1] in ('.mp4', '.m4a', '.mov'):
+        args += ['-movflags', '+faststart']
+    await run_media_tool(*args, output_path)
+    return output_path
+
+async def split_media(download_result):
+    """تقسیم فایل بزرگ به بخش‌های زیر سقف حجم با برش‌های موازی؛ None یعنی تقسیم ممکن نشد"""
+    file_path = download_result['file_path']
+    max_bytes = MAX_FILE_SIZE * 1024 * 1024 * SPLIT_HEADROOM
+    keyframes, duration = await probe_keyframes(file_path)
+    if not duration:
+        return None
+    
+    split_dir = os.path.join(DOWNLOAD_DIR, f"split-{secrets.token_hex(4)}")
+    os.makedirs(split_dir, exist_ok=True)
+    ext = os.path.splitext(file_path)[1]
+    semaphore = asyncio.Semaphore(SPLIT_PARALLELISM)
+    
+    async def cut(index, segment, is_last):
+        async with semaphore:
+            output_path = os.path.join(split_dir, f"part{index + 1:02d}{ext}")
+            return await cut_segment(file_path, segment[0], segment[1], output_path, is_last)
+    
+    try:
+        # نرخ بیت متغیر ممکن است بخشی را از سقف بزرگ‌تر کند؛ در این صورت با هدف کوچک‌تر دوباره برش داده می‌شود
+        for _ in range(3):
+            segments = plan_segments(keyframes, duration, download_result['file_size'], max_bytes)
+            if len(segments) > SPLIT_MAX_PARTS:
+                return None
+            for filename in os.listdir(split_dir):
+                os.remove(os.path.join(split_dir, filename))
+            parts = await asyncio.gather(*(
+                cut(index, segment, index == len(segments) - 1) for index, segment in enumerate(segments)
+            ))
+            if all(os.path.getsize(part) <= MAX_FILE_SIZE * 1024 * 1024 for part in parts):
+                return {'dir': split_dir, 'parts': parts, 'file_ids': [None] * len(parts)}
+            max_bytes *= 0.85
+        return None
+    except BaseException:
+        discard_split(split_dir)
+        raise
+
+def discard_split(split_dir):
+    """حذف پوشه بخش‌های یک فایل تقسیم‌شده"""
+    shutil.rmtree(split_dir, ignore_errors=True)
+
+def can_split(download_result):
+    return SPLIT_OVERSIZED and download_result['file_size'] <= selection_limit_bytes()
+
+async def send_split_result(message, flight, download_result, video_id, quality, status_message=None):
+    """تقسیم فایل بزرگ‌تر از سقف و ارسال بخش‌ها به ترتیب؛ بخش‌ها و file_id آن‌ها برای بقیه منتظرهای
+    همین دانلود مشترک نگه داشته می‌شوند. در صورت ناموفق بودن تقسیم False برمی‌گرداند"""
+    async def report(text):
+        if status_message is not None:
+            await status_message.edit_text(text)
+    
+    started = time.monotonic()
+    async with flight['lock']:
+        if 'split' not in flight:
+            await report("✂️ حجم فایل بیش از حد مجاز است؛ در حال تقسیم فایل به چند بخش...")
+            split_started = time.monotonic()
+            try:
+                flight['split'] = await split_media(download_result)
+            except (OSError, RuntimeError) as e:
+                logger.error(f"Error splitting {video_id}: {e}")
+                flight['split'] = None
+            metrics.observe('stage_seconds', time.monotonic() - split_started, stage='split')
+        split = flight['split']
+        if not split:
+            metrics.inc('failures_total', type='split_failed')
+            return False
         
+        parts = split['parts']
+        for index, part in enumerate(parts):
+            title = f"{download_result['title'][:50]} ({index + 1}/{len(parts)})"
+            if split['file_ids'][index]:
+                cached = {
+                    'file_id': split['file_ids'][index], 'media_type': download_result['media_type'],
+                    'title': title, 'video_id': video_id, 'quality': quality,
+                    'format_id': f"{download_result['format_id']}#part{index + 1}",
+                }
+                if await send_cached_media(message, cached):
+                    continue
+            await report(f"📤 در حال آپلود بخش {index + 1} از {len(parts)}...")
+            part_result = dict(download_result, file_path=part, file_size=os.path.getsize(part), title=title)
+            sent_message = await upload_media(message, part_result, quality)
+            media = sent_message.audio or sent_message.voice or sent_message.video or sent_message.document
+            if media is not None:
+                split['file_ids'][index] = media.file_id
+        metrics.inc('split_parts_total', len(parts))
+    metrics.observe('stage_seconds', time.monotonic() - started, stage='split_upload')
+    return True
+
+async def send_download_result(message, flight, download_result, video_id, quality, quality_names):
+    """ارسال فایل دانلودشده (یا file_id آپلود قبلی) به کاربر"""
+    file_size_mb = download_result['file_size'] / 1024 / 1024
+    
+    # ارسال فایل با timeout افزایش یافته (آپلودهای یک دانلود مشترک به ترتیب انجام می‌شوند
+    # تا بقیه منتظرها از file_id اولین آپلود استفاده کنند)
+    async with flight['lock']:
+        try:
+            actual_quality = download_result.get('actual_quality', quality)
+            quality_display = quality_names.get(actual_quality, actual_quality)
+            
+            cached = file_id_store.get(video_id, quality, download_result['format_id'])
+            if cached and await send_cached_media(message, cached):
+                metrics.inc('cache_hits_total', cache='file_id')
+                sent_message = None
+            else:
+                await message.edit_text(f"📤 در حال آپلود فایل ({file_size_mb:.1f}MB) با کیفیت {quality_display}...")
+                sent_message = await upload_media(message, download_result, quality)
+                remember_file_id(sent_message, video_id, quality, download_result)
+            
+            success_message = f"✅ دانلود با موفقیت انجام شد!\n📁 حجم فایل: {file_size_mb:.1f}MB"
+            if actual_quality != quality:
+                success_message += f"\n🎯 کیفیت واقعی: {quality_display} (بهترین کیفیت موجود)"
+            
+            await message.edit_text(success_message)
+            
+        except asyncio.TimeoutError:
+            metrics.inc('failures_total', type='upload_timeout')
+            await message.edit_text("⏰ زمان آپلود به پایان رسید. لطفاً کیفیت پایین‌تری انتخاب کنید.")
+        except Exception as e:
+            metrics.inc('failures_total', type='upload_error')
+            logger.error(f"Error sending file: {str(e)}")
+            await message.edit_text("❌ خطا در ارسال فایل. لطفاً دوباره تلاش کنید.")
+
+def parse_batch_request(text):
+    """تشخیص درخواست دسته‌ای: لینک پلی‌لیست یا چند لینک ویدیو در یک پیام"""
+    playlist = re.search(PLAYLIST_PATTERN, text)
+    if playlist:
+        return {'playlist_url': f"https://www.youtube.com/playlist?list={playlist.group(3)}"}
+    
+    entries = []
+    seen = set()
+    for word in text.split():
+        video_id = extract_video_id(word)
+        if video_id and video_id not in seen:
+            seen.add(video_id)
+            entries.append({'url': word, 'video_id': video_id, 'title': video_id})
+    if len(entries) > 1:
+        return {'title': f"{len(entries)} لینک", 'entries': entries[:PLAYLIST_MAX_ITEMS]}
+    return None
+
+async def handle_batch_request(update: Update, request):
+    """دریافت فهرست ویدیوهای دسته و نمایش یک انتخاب کیفیت برای همه"""
+    processing_msg = await update.message.reply_text("🔍 در حال دریافت لیست ویدیوها...")
+    
+    if 'playlist_url' in request:
+        try:
+            with metrics.timer('extract'):
+                request = await run_in_worker('extract', 'extract', extract_playlist_entries, request['playlist_url'])
+        except asyncio.TimeoutError:
+            request = None
+    if not request or not request['entries']:
+        metrics.inc('failures_total', type='playlist_failed')
+        await processing_msg.edit_text("❌ خطا در دریافت لیست ویدیوها. لطفاً از معتبر بودن لینک اطمینان حاصل کنید.")
+        return
+    
+    # دکمه‌ها فقط توکن کوتاه دسته را دارند تا از سقف ۶۴ بایتی callback_data عبور نکنند
+    token = secrets.token_urlsafe(8)
+    batch_sessions.set(token, {
+        'user_id': update.effective_user.id,
+        'title': request['title'],
+        'entries': request['entries'],
+    })
+    
+    keyboard = [
+        [InlineKeyboardButton(name, callback_data=f"batch:{quality}:{token}")]
+        for quality, name in QUALITY_NAMES.items()
+    ]
+    keyboard.append([InlineKeyboardButton("❌ لغو", callback_data=f"batch:cancel:{token}")])
+    await processing_msg.edit_text(
+        f"📦 {request['title'][:80]}\n"
+        f"🎬 تعداد ویدیوها: {len(request['entries'])} (حداکثر {PLAYLIST_MAX_ITEMS})\n\n"
+        "📥 لطفاً کیفیت همه ویدیوها را انتخاب کنید:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def handle_batch_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """شروع یا لغو دانلود دسته‌ای"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    parts = query.data.split(':', 2)
+    
+    # شروع دسته به ازای هر ویدیو یک توکن از بودجه دسته‌ای مصرف می‌کند؛ لغو، جلسه نامعتبر و دسته‌ای
+    # که به خاطر دسته در حال اجرا رد می‌شود هزینه‌ای ندارد
+    session = batch_sessions.get(parts[2]) if len(parts) == 3 and parts[1] != 'cancel' else None
+    running = sum(1 for batch in active_batches.values() if batch['user_id'] == user_id)
+    if session is not None and session['user_id'] == user_id and running < BATCH_USER_LIMIT:
+        wait, notify = user_limiter.check(user_id, 'batch', len(session['entries']))
+        if wait:
+            metrics.inc('rate_limited_total', kind='batch')
+            await query.answer(rate_limit_text(wait) if notify else None, show_alert=notify)
+            return
+    await query.answer()
+    
+    if len(parts) != 3:
+        await query.message.edit_text("❌ خطا در پردازش درخواست.")
+        return
+    _, choice, token = parts
+    
+    if choice == 'cancel':
+        batch = active_batches.get(token)
+        if batch and batch['user_id'] == user_id:
+            batch['task'].cancel()
+        elif batch_sessions.get(token):
+            batch_sessions.pop(token)
+            await query.message.edit_text("🛑 دانلود دسته‌ای لغو شد.")
+        return
+    
+    if not await is_user_member(user_id, context):
+        await query.message.edit_text("لطفاً اول در کانال ما عضو شوید! 🎯")
+        return
+    
+    if not accepting_jobs:
+        await query.message.edit_text("🔄 ربات در حال راه‌اندازی مجدد است. لطفاً چند دقیقه دیگر دوباره تلاش کنید.")
+        return
+    
+    if not session or session['user_id'] != user_id or choice not in QUALITY_NAMES:
+        await query.message.edit_text("⌛ این درخواست منقضی شده است. لطفاً لینک را دوباره ارسال کنید.")
+        return
+    
+    running = sum(1 for batch in active_batches.values() if batch['user_id'] == user_id)
+    if running >= BATCH_USER_LIMIT:
+        await query.message.reply_text("🚦 شما یک دانلود دسته‌ای در حال اجرا دارید. لطفاً تا پایان آن صبر کنید.")
+        return
+    
+    batch_sessions.pop(token)
+    batch = {
+        'token': token,
+        'user_id': user_id,
+        'title': session['title'],
+        'quality': choice,
+        'items': [dict(entry, state='queued') for entry in session['entries']],
+    }
+    active_batches[token] = batch
+    metrics.inc('batches_total')
+    # خط لوله در پس‌زمینه اجرا می‌شود تا دکمه لغو همچنان پاسخ بگیرد
+    batch['task'] = asyncio.create_task(run_batch(batch, query.message))
+
+def render_batch_progress(batch):
+    """متن پیام پیشرفت دسته"""
+    items = batch['items']
+    sent = sum(1 for item in items if item['state'] == 'done')
+    failed = sum(1 for item in items if item['state'] == 'failed')
+    lines = [
+        f"📦 {batch['title'][:60]}",
+        f"🎯 کیفیت: {QUALITY_NAMES[batch['quality']]}",
+        f"✅ {sent} از {len(items)} ارسال شد | ❌ {failed} ناموفق",
+    ]
+    for item in items:
+        if item['state'] == 'downloading':
+            downloaded_mb = (item.get('progress') or {}).get('downloaded_bytes', 0) / 1024 / 1024
+            lines.append(f"⏳ در حال دانلود: {item['title'][:40]} ({downloaded_mb:.1f}MB)")
+        elif item['state'] == 'uploading':
+            lines.append(f"📤 در حال آپلود: {item['title'][:40]}")
+    return "\n".join(lines)
+
+async def batch_progress_ticker(batch, message):
+    """به‌روزرسانی دوره‌ای همان یک پیام پیشرفت (فقط وقتی متن تغییر کرده باشد)"""
+    reply_markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("❌ لغو دانلود دسته‌ای", callback_data=f"batch:cancel:{batch['token']}")
+    ]])
+    last_text = None
+    while True:
+        text = render_batch_progress(batch)
+        if text != last_text:
+            try:
+                await message.edit_text(text, reply_markup=reply_markup, rate_limit_args={'priority': 'low'})
+                last_text = text
+            except Exception as e:
+                logger.warning(f"Error reporting batch progress: {e}")
+        await asyncio.sleep(BATCH_PROGRESS_INTERVAL)
+
+def leave_batch_flight(item):
+    """جدا شدن ویدیوی دسته از دانلود مشترک (فقط یک‌بار)"""
+    flight_key = item.pop('flight_key', None)
+    if flight_key is not None and download_flights.leave(flight_key):
+        finish_flight(item['flight'])
+
+async def fetch_batch_item(batch, item):
+    """دانلود یک ویدیوی دسته با همان صف، کش‌ها و دانلود مشترک درخواست‌های تکی؛ در صورت خطا نوع خطا برمی‌گردد"""
+    url, video_id, quality = item['url'], item['video_id'], batch['quality']
+    item['state'] = 'downloading'
+    
+    try:
+        info = await run_in_worker('extract', 'extract', extract_raw_info, url)
+    except asyncio.TimeoutError:
+        info = None
+    except Exception as e:
+        logger.error(f"Error getting batch item info: {e}")
+        info = None
+    if not info:
+        return 'extract_failed'
+    item['title'] = info.get('title') or item['title']
+    
+    best_format = get_best_available_format(url, quality, info)
+    if not best_format:
+        return 'no_format'
+    item['format_id'] = best_format
+    cached = file_id_store.get(video_id, quality, best_format)
+    if cached:
+        item['cached'] = cached
+        return None
+    
+    # نوبت صف تا آزاد شدن جا صبر می‌کند؛ بررسی شروع‌کننده و ثبت در صف بدون await بین آن‌ها انجام می‌شود
+    flight_key = (video_id, quality)
+    while True:
+        leader = flight_key not in download_flights.flights
+        stored = media_store.lookup((video_id, best_format, media_postprocess(quality))) if leader else None
+        if not leader or stored:
+            break
+        try:
+            ticket = download_scheduler.enqueue(batch['user_id'], quality in CHEAP_QUALITIES)
+            break
+        except QueueFullError:
+            await asyncio.sleep(QUEUE_POSITION_INTERVAL)
+    
+    progress = {}
+    if stored:
+        metrics.inc('cache_hits_total', cache='media_store')
+        job_factory = lambda: stored_download(stored)
+    else:
+        job_factory = lambda: run_download_job(url, quality, video_id, ticket, None, progress)
+    flight = download_flights.join(flight_key, job_factory)
+    item['flight_key'] = flight_key
+    item['flight'] = flight
+    if leader:
+        flight['progress'] = progress
+    item['progress'] = flight.get('progress')
+    
+    try:
+        download_result = await asyncio.shield(flight['task'])
+    except asyncio.TimeoutError:
+        return 'download_timeout'
+    if download_result and download_result.get('refused'):
+        return download_result['refused']
+    if not download_result or not os.path.exists(download_result['file_path']):
+        return 'download_failed'
+    if download_result['file_size'] / 1024 / 1024 > MAX_FILE_SIZE and not can_split(download_result):
+        media_store.discard(download_result.get('media_key'))
+        return 'too_large'
+    item['result'] = download_result
+    return None
+
+async def upload_batch_item(message, batch, item):
+    """ارسال یک ویدیوی آماده دسته؛ در صورت خطا نوع خطا برمی‌گردد"""
+    video_id, quality = item['video_id'], batch['quality']
+    if 'cached' in item:
+        if await send_cached_media(message, item['cached']):
+            metrics.inc('cache_hits_total', cache='file_id')
+            return None
+        return 'upload_error'
+    
+    download_result = item['result']
+    media_key = download_result.get('media_key')
+    media_store.acquire(media_key)
+    try:
+        if download_result['file_size'] / 1024 / 1024 > MAX_FILE_SIZE:
+            sent = await send_split_result(message, item['flight'], download_result, video_id, quality)
+            return None if sent else 'too_large'
+        async with item['flight']['lock']:
+            cached = file_id_store.get(video_id, quality, download_result['format_id'])
+            if cached and await send_cached_media(message, cached):
+                metrics.inc('cache_hits_total', cache='file_id')
+                return None
+            sent_message = await upload_media(message, download_result, quality)
+            remember_file_id(sent_message, video_id, quality, download_result)
+            return None
     except asyncio.TimeoutError:
-        await query.message.edit_text("⏰ زمان آپلود به پایان رسید. لطفاً کیفیت پایین‌تری انتخاب کنید.")
+        return 'upload_timeout'
+    except Exception as e:
+        logger.error(f"Error sending batch item: {str(e)}")
+        return 'upload_error'
+    finally:
+        media_store.release(media_key)
+
+async def run_batch(batch, message):
+    """خط لوله دسته: دانلود ویدیوهای بعدی هم‌زمان با آپلود ویدیوی فعلی، به ترتیب فهرست"""
+    items = batch['items']
+    fetches = []
+    started = time.monotonic()
+    log_context.set({'job_id': f"batch:{batch['token']}", 'user_id': batch['user_id']})
+    ticker = asyncio.create_task(batch_progress_ticker(batch, message))
+    try:
+        for index, item in enumerate(items):
+            # حداکثر BATCH_PREFETCH ویدیو جلوتر از آپلود فعلی دانلود می‌شوند
+            while len(fetches) < min(index + 1 + BATCH_PREFETCH, len(items)):
+                fetches.append(asyncio.create_task(fetch_batch_item(batch, items[len(fetches)])))
+            
+            try:
+                failure = await fetches[index]
+            except Exception as e:
+                logger.error(f"Batch item failed: {e}")
+                failure = 'download_failed'
+            if failure is None:
+                item['state'] = 'uploading'
+                failure = await upload_batch_item(message, batch, item)
+            leave_batch_flight(item)
+            
+            if failure:
+                metrics.inc('failures_total', type=failure)
+                item['state'] = 'failed'
+            else:
+                item['state'] = 'done'
+        batch['state'] = 'done'
+    except asyncio.CancelledError:
+        batch['state'] = 'cancelled'
+    finally:
+        ticker.cancel()
+        for task in fetches:
+            task.cancel()
+        await asyncio.gather(*fetches, return_exceptions=True)
+        for item in items:
+            leave_batch_flight(item)
+        active_batches.pop(batch['token'], None)
+        metrics.observe('stage_seconds', time.monotonic() - started, stage='batch')
+    
+    sent = sum(1 for item in items if item['state'] == 'done')
+    if batch['state'] == 'cancelled':
+        final_text = f"🛑 دانلود دسته‌ای لغو شد. {sent} از {len(items)} ویدیو ارسال شده بود."
+    else:
+        final_text = f"✅ دانلود دسته‌ای تمام شد! {sent} از {len(items)} ویدیو ارسال شد."
+    try:
+        await message.edit_text(final_text)
     except Exception as e:
-        logger.error(f"Error sending file: {str(e)}")
-        await query.message.edit_text("❌ خطا در ارسال فایل. لطفاً دوباره تلاش کنید.")
+        logger.warning(f"Error reporting batch result: {e}")
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """نمایش آمار عملکرد (فقط برای ادمین‌ها)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    await update.message.reply_text(metrics.summary()[:4000])
+
+def collect_runtime_metrics():
+    """مقادیر لحظه‌ای صف، کارگرها و کش‌ها برای خروجی متریک‌ها"""
+    values = {
+        ('queue_depth', ()): download_scheduler.queued,
+        ('active_downloads', ()): download_scheduler.active,
+        ('media_store_bytes', ()): media_store.total_bytes,
+    }
+    for name, cache in (('info', info_cache), ('member', member_cache), ('session', selection_sessions)):
+        stats = cache.stats()
+        values[('cache_hits_total', (('cache', name),))] = stats['hits']
+        values[('cache_misses_total', (('cache', name),))] = stats['misses']
+    values.update(download_tuner.stats())
+    values[('rate_limit_buckets', ())] = len(user_limiter.buckets)
+    for phase, seconds in startup_timings.items():
+        values[('startup_seconds', (('phase', phase),))] = round(seconds, 3)
+    for name, value in ydl_pool.stats().items():
+        values[('ydl_pool_instances', (('state', name),))] = value
+    if download_pool is not None:
+        values[('active_workers', ())] = sum(1 for worker in download_pool.stats() if worker['busy'])
+    return values
+
+async def start_metrics_server():
+    """سرور HTTP محلی برای خروجی Prometheus"""
+    async def serve_metrics(reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = metrics.render().encode('utf-8')
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    
+    server = await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+    logger.info(f"Metrics endpoint listening on {METRICS_HOST}:{METRICS_PORT}")
+    return server
+
+def checkpoint_jobs():
+    """ثبت مسیر .part و مرحله دانلودهای در جریان در دفتر کارها"""
+    for (video_id, quality), flight in list(download_flights.flights.items()):
+        progress = flight.get('progress')
+        try:
+            part_path = progress.get('tmpfilename') if progress is not None else None
+            status = progress.get('status') if progress is not None else None
+        except Exception as e:
+            logger.warning(f"Error reading download progress: {e}")
+            continue
+        if not part_path:
+            continue
+        state = 'postprocessing' if status == 'finished' else 'downloading'
+        job_journal.update(video_id, quality, state, part_path)
+
+async def journal_checkpointer():
+    """ثبت دوره‌ای وضعیت دانلودها تا پس از از کار افتادن ناگهانی هم قابل ادامه باشند"""
+    while True:
+        await asyncio.sleep(JOURNAL_CHECKPOINT_INTERVAL)
+        try:
+            checkpoint_jobs()
+        except sqlite3.Error as e:
+            logger.error(f"Error checkpointing jobs: {e}")
+
+async def drain_jobs(timeout):
+    """توقف پذیرش کار جدید، انتظار برای پایان کارهای در جریان و ثبت بقیه برای اجرای بعدی"""
+    global accepting_jobs, checkpointing
+    accepting_jobs = False
+    # ثبت پیش از انتظار، تا اگر پردازه در میانه مهلت کشته شد هم وضعیت دانلودها ذخیره شده باشد
+    checkpoint_jobs()
+    tasks = list(active_jobs.values())
+    if tasks:
+        logger.info(f"Draining {len(tasks)} jobs for up to {timeout}s...")
+        await asyncio.wait(tasks, timeout=timeout)
     
-    # حذف فایل موقت
+    checkpointing = True
+    checkpoint_jobs()
+    remaining = [task for task in active_jobs.values() if not task.done()]
+    for task in remaining:
+        task.cancel()
+    await asyncio.gather(*remaining, return_exceptions=True)
+    logger.info(f"Checkpointed {len(remaining)} unfinished jobs")
+
+async def resume_jobs(application, worker_id=None):
+    """ادامه کارهای نیمه‌تمام اجرای قبلی از روی دفتر کارها (در حالت وب‌هوک فقط کاربران همین کارگر)"""
+    for job in job_journal.pending():
+        if worker_id is not None and job['user_id'] % UPDATE_WORKERS != worker_id:
+            continue
+        # کاری که چند بار پشت سر هم به خاموشی خورده (یا باعث آن شده) کنار گذاشته می‌شود
+        if job['resumes'] >= JOURNAL_MAX_RESUMES:
+            logger.warning(f"Dropping job {job['job_id']} after {job['resumes']} resumes")
+            job_journal.finish(job['job_id'])
+            continue
+        job_journal.mark_resumed(job['job_id'])
+        metrics.inc('jobs_resumed_total', state=job['state'])
+        logger.info(f"Resuming job {job['job_id']} from state '{job['state']}'")
+        
+        message = Message(
+            job['message_id'], datetime.datetime.now(datetime.timezone.utc), Chat(job['chat_id'], Chat.PRIVATE)
+        )
+        message.set_bot(application.bot)
+        asyncio.create_task(resume_job(message, job))
+
+async def resume_job(message, job):
+    try:
+        await message.edit_text("♻️ ربات دوباره راه‌اندازی شد؛ دانلود از همان‌جا ادامه پیدا می‌کند...")
+    except Exception as e:
+        logger.warning(f"Error reporting resumed job: {e}")
     try:
-        if os.path.exists(download_result['file_path']):
-            os.remove(download_result['file_path'])
+        await process_download_request(message, job['user_id'], job['url'], job['quality'], job['job_id'])
     except Exception as e:
-        logger.error(f"Error deleting temp file: {str(e)}")
+        logger.error(f"Resumed job {job['job_id']} failed: {e}")
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """مدیریت خطاها"""
@@ -573,6 +3263,21 @@ async def shutdown(signal, loop):
     
     global update_task, bot_application
     
+    # در حالت polling دریافت آپدیت پیش از تخلیه متوقف می‌شود
+    if bot_application and bot_application.updater and bot_application.updater.running:
+        await bot_application.updater.stop()
+    
+    # کارگرهای آپدیت با SIGTERM کارهای خود را هم‌زمان با این پردازه تخلیه و ثبت می‌کنند
+    if worker_supervisor:
+        worker_supervisor.cancel()
+    for process in update_workers:
+        process.terminate()
+    
+    # پایان یا ثبت کارهای در جریان پیش از توقف کارگرها
+    await drain_jobs(DRAIN_TIMEOUT)
+    if journal_task:
+        journal_task.cancel()
+    
     # توقف بروزرسانی پس‌زمینه
     if update_task:
         update_task.cancel()
@@ -581,9 +3286,29 @@ async def shutdown(signal, loop):
         except asyncio.CancelledError:
             pass
     
+    # لغو دانلودهای دسته‌ای در حال اجرا
+    for batch in list(active_batches.values()):
+        batch['task'].cancel()
+    
+    # توقف استخرهای کارگر
+    shutdown_executors()
+    await close_stream_client()
+    
+    # توقف سرور متریک‌ها، سرور وب‌هوک و پردازه‌های کارگر آپدیت
+    if metrics_server:
+        metrics_server.close()
+    if webhook_runner:
+        await webhook_runner.cleanup()
+    for process in update_workers:
+        await asyncio.to_thread(process.join, DRAIN_TIMEOUT + 10)
+        if process.is_alive():
+            logger.warning(f"Update worker {process.pid} did not drain in time, killing it")
+            process.kill()
+    
     # توقف بات
     if bot_application:
-        await bot_application.stop()
+        if bot_application.running:
+            await bot_application.stop()
         await bot_application.shutdown()
     
     # توقف لوپ
@@ -592,7 +3317,20 @@ async def shutdown(signal, loop):
 
 async def initialize_bot(application):
     """مقداردهی اولیه بات"""
-    global update_task
+    global update_task, metrics_server, journal_task
+    
+    # ادامه کارهای نیمه‌تمام اجرای قبلی (در حالت وب‌هوک هر کارگر کارهای کاربران خودش را ادامه می‌دهد)
+    if RUN_MODE != 'webhook':
+        journal_task = asyncio.create_task(journal_checkpointer())
+        await resume_jobs(application)
+    
+    # راه‌اندازی خروجی متریک‌ها
+    metrics.add_collector(collect_runtime_metrics)
+    if METRICS_PORT:
+        try:
+            metrics_server = await start_metrics_server()
+        except OSError as e:
+            logger.error(f"Error starting metrics endpoint: {e}")
     
     try:
         # بروزرسانی اولیه نام و بیو
@@ -604,12 +3342,191 @@ async def initialize_bot(application):
         logger.info("Background updater started")
     except Exception as e:
         logger.error(f"Error initializing bot: {e}")
+    
+    startup_timings['ready'] = time.monotonic() - STARTUP_STARTED
+    logger.info(f"Startup: imports {startup_timings['imports']:.2f}s, ready {startup_timings['ready']:.2f}s")
+
+def build_application(with_updater=True):
+    """ساخت Application همراه با هندلرها"""
+    builder = (
+        Application.builder().token(BOT_TOKEN).rate_limiter(FloodControlLimiter())
+        .base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+        .request(build_request()).concurrent_updates(CONCURRENT_UPDATES)
+    )
+    if LOCAL_BOT_API:
+        builder = builder.local_mode(True)
+    if not with_updater:
+        builder = builder.updater(None)
+    application = builder.build()
+    
+    # اضافه کردن هندلرها
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(MessageHandler(
+        filters.TEXT & ~filters.COMMAND, 
+        handle_youtube_url
+    ))
+    application.add_handler(CallbackQueryHandler(handle_batch_selection, pattern=r'^batch:'))
+    application.add_handler(CallbackQueryHandler(handle_quality_selection))
+    if MEMBER_UPDATES:
+        application.add_handler(ChatMemberHandler(handle_chat_member_update, ChatMemberHandler.CHAT_MEMBER))
+    application.add_error_handler(error_handler)
+    return application
+
+async def start_webhook_front(application):
+    """راه‌اندازی سرور وب‌هوک که آپدیت‌ها را فقط در صف مشترک ثبت می‌کند"""
+    from aiohttp import web
+    
+    update_queue = UpdateQueue(UPDATE_QUEUE_DB)
+    
+    async def receive_update(request):
+        if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        payload = await request.text()
+        try:
+            update = json.loads(payload)
+            update_queue.put(update['update_id'], payload, update_sender_id(update))
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+        return web.Response()
+    
+    web_app = web.Application()
+    web_app.router.add_post(WEBHOOK_PATH, receive_update)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+    
+    await application.initialize()
+    await application.start()
+    await application.bot.set_webhook(
+        WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=Update.ALL_TYPES if MEMBER_UPDATES else None
+    )
+    logger.info(f"Webhook front listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    return runner
+
+def update_sender_id(update):
+    """شناسه کاربر (یا چت) آپدیت برای فرستادن همه آپدیت‌های یک کاربر به یک کارگر"""
+    # تغییر عضویت به کارگر همان عضو می‌رسد (نه مدیری که آن را انجام داده) تا کش عضویت او باطل شود
+    member = (update.get('chat_member') or {}).get('new_chat_member', {}).get('user', {})
+    if 'id' in member:
+        return member['id']
+    for value in update.values():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('chat') or {}
+            if 'id' in sender:
+                return sender['id']
+    return 0
+
+def apply_worker_share():
+    """تقسیم بودجه‌های سراسری بین کارگرهای آپدیت (پیش از ساخت هر استخر یا Application در کارگر)"""
+    global API_GLOBAL_RATE, DOWNLOAD_PROCESSES, DOWNLOAD_WORKERS, EXTRACT_WORKERS, DOWNLOAD_CAPACITY
+    API_GLOBAL_RATE = max(API_GLOBAL_RATE / UPDATE_WORKERS, 1)
+    DOWNLOAD_PROCESSES = max(DOWNLOAD_PROCESSES // UPDATE_WORKERS, 1)
+    DOWNLOAD_WORKERS = max(DOWNLOAD_WORKERS // UPDATE_WORKERS, 1)
+    EXTRACT_WORKERS = max(EXTRACT_WORKERS // UPDATE_WORKERS, 1)
+    DOWNLOAD_CAPACITY = DOWNLOAD_PROCESSES if DOWNLOAD_EXECUTOR == 'process' else DOWNLOAD_WORKERS
+    download_scheduler.max_active = DOWNLOAD_CAPACITY
+    download_scheduler.max_queued = max(QUEUE_MAX_JOBS // UPDATE_WORKERS, 1)
+
+def run_update_worker(worker_id):
+    """نقطه ورود پردازه کارگر آپدیت‌ها"""
+    apply_worker_share()
+    if PRELOAD_YT_DLP:
+        preload_yt_dlp()
+    asyncio.run(consume_updates(worker_id))
+
+async def consume_updates(worker_id):
+    """برداشتن آپدیت‌ها از صف مشترک و پردازش همزمان آن‌ها"""
+    worker_name = f"worker-{worker_id}-{os.getpid()}"
+    update_queue = UpdateQueue(UPDATE_QUEUE_DB)
+    semaphore = asyncio.Semaphore(WORKER_CONCURRENT_UPDATES)
+    application = build_application(with_updater=False)
+    claimed_tasks = set()
+    
+    # SIGTERM از پردازه اصلی (و SIGINT از Ctrl+C که به کل گروه می‌رسد) تخلیه کارها را شروع می‌کند
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+    
+    async def process_claimed(update_id, payload):
+        try:
+            await application.process_update(Update.de_json(json.loads(payload), application.bot))
+        except Exception as e:
+            logger.error(f"{worker_name} failed to process update {update_id}: {e}")
+        finally:
+            update_queue.done(update_id)
+            semaphore.release()
+    
+    async def claim_updates():
+        while True:
+            await semaphore.acquire()
+            claimed = update_queue.claim(worker_name, worker_id, UPDATE_WORKERS)
+            if claimed is None:
+                semaphore.release()
+                await asyncio.sleep(UPDATE_POLL_INTERVAL)
+                continue
+            task = asyncio.create_task(process_claimed(*claimed))
+            claimed_tasks.add(task)
+            task.add_done_callback(claimed_tasks.discard)
+    
+    async with application:
+        await application.start()
+        journal = asyncio.create_task(journal_checkpointer())
+        # کارهای ثبت‌شده پیش از برداشتن آپدیت‌ها ادامه پیدا می‌کنند تا تحویل دوباره دکمه‌ها تکراری شناخته شود
+        await resume_jobs(application, worker_id)
+        claimer = asyncio.create_task(claim_updates())
+        logger.info(f"{worker_name} started")
+        await stopping.wait()
+        
+        claimer.cancel()
+        await drain_jobs(DRAIN_TIMEOUT)
+        journal.cancel()
+        for task in list(claimed_tasks):
+            task.cancel()
+        await asyncio.gather(*claimed_tasks, return_exceptions=True)
+        await application.stop()
+    shutdown_executors()
+    await close_stream_client()
+    logger.info(f"{worker_name} stopped")
+
+def start_update_worker(worker_id, target=run_update_worker):
+    """اجرای پردازه کارگر (spawn تا اتصال‌های SQLite و لوپ والد به ارث نرسند)
+    
+    کارگر daemon نیست تا بتواند استخر دانلود پردازه‌ای خودش را بسازد؛ توقف و راه‌اندازی دوباره
+    آن با shutdown و supervise_update_workers است.
+    """
+    process = multiprocessing.get_context('spawn').Process(target=target, args=(worker_id,))
+    process.start()
+    return process
+
+def start_update_workers():
+    for worker_id in range(UPDATE_WORKERS):
+        update_workers.append(start_update_worker(worker_id))
+
+async def supervise_update_workers():
+    """راه‌اندازی دوباره کارگری که از کار افتاده؛ آپدیت‌های کاربران هر کارگر فقط به همان می‌رسد"""
+    while True:
+        await asyncio.sleep(5)
+        for worker_id, process in enumerate(update_workers):
+            if not process.is_alive():
+                logger.warning(f"Update worker {worker_id} exited with code {process.exitcode}, restarting")
+                update_workers[worker_id] = start_update_worker(worker_id)
 
 def main():
     """تابع اصلی"""
-    global bot_application
+    global bot_application, webhook_runner, worker_supervisor
     
     try:
+        # حذف فایل‌های نیمه‌کاره و موقت اجرای قبلی (به جز فایل‌های کارهای دفتر کارها)
+        media_store.sweep(DOWNLOAD_DIR, job_journal.pending())
+        
+        # yt-dlp هم‌زمان با اتصال به تلگرام در پس‌زمینه بارگذاری می‌شود
+        if PRELOAD_YT_DLP:
+            preload_yt_dlp()
+        
         # تنظیم signal handlers برای خاموش کردن مناسب
         loop = asyncio.get_event_loop()
         signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
@@ -618,29 +3535,31 @@ def main():
                 s, lambda s=s: asyncio.create_task(shutdown(s, loop))
             )
         
-        application = Application.builder().token(BOT_TOKEN).build()
+        application = build_application(with_updater=RUN_MODE != 'webhook')
         bot_application = application
         
-        # اضافه کردن هندلرها
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(MessageHandler(
-            filters.TEXT & ~filters.COMMAND, 
-            handle_youtube_url
-        ))
-        application.add_handler(CallbackQueryHandler(handle_quality_selection))
-        application.add_error_handler(error_handler)
-        
         print("🤖 ربات YouTube Downloader در حال اجرا است...")
         print(f"📍 حداکثر حجم مجاز: {MAX_FILE_SIZE}MB")
         print("📍 سیستم مدیریت خودکار فرمت‌ها فعال است")
         print("📍 سیستم ساعت زنده و شمارش معکوس فعال است")
         print("📍 برای متوقف کردن: Ctrl+C")
-        print("📍 لاگ‌ها در فایل bot.log ذخیره می‌شوند")
+        print(f"📍 لاگ‌ها در فایل {LOG_FILE} ذخیره می‌شوند")
         
         # راه‌اندازی بات و شروع بروزرسانی
         loop.create_task(initialize_bot(application))
         
-        application.run_polling()
+        if RUN_MODE == 'webhook':
+            start_update_workers()
+            worker_supervisor = loop.create_task(supervise_update_workers())
+            webhook_runner = loop.run_until_complete(start_webhook_front(application))
+            loop.run_forever()
+            return
+        
+        # آپدیت‌های chat_member فقط با درخواست صریح ارسال می‌شوند؛ سیگنال‌ها به shutdown بالا می‌رسند
+        # (سیگنال‌های پیش‌فرض PTB جای آن را می‌گیرند و کارها بدون مهلت و ثبت متوقف می‌شوند)
+        application.run_polling(
+            allowed_updates=Update.ALL_TYPES if MEMBER_UPDATES else None, stop_signals=None
+        )
         
     except Exception as e:
         logger.error(f"Fatal error: {e}")
@@ -0,0 +1,28 @@
+"""پیکربندی آزمون‌ها: فایل config موقت پیش از import ربات (پردازه‌های کارگر spawn هم همان را می‌بینند)"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='ytbot-tests-')
+
+CONFIG = f"""
+BOT_TOKEN = '123456:TEST'
+CHANNEL_USERNAME = '@test_channel'
+CHANNEL_LINK = 'https://t.me/test_channel'
+DOWNLOAD_DIR = {os.path.join(WORKDIR, 'downloads')!r}
+UPLOAD_TIMEOUT = 30
+MAX_FILE_SIZE = 50
+YT_DLP_OPTIONS = {{'quiet': True}}
+FILE_ID_DB = {os.path.join(WORKDIR, 'file_ids.db')!r}
+JOB_JOURNAL_DB = {os.path.join(WORKDIR, 'jobs.db')!r}
+UPDATE_QUEUE_DB = {os.path.join(WORKDIR, 'updates.db')!r}
+LOG_FILE = {os.path.join(WORKDIR, 'bot.log')!r}
+METRICS_PORT = 0
+PRELOAD_YT_DLP = False
+DOWNLOAD_PROCESSES = 1
+"""
+
+with open(os.path.join(WORKDIR, 'config.py'), 'w') as f:
+    f.write(CONFIG)
+sys.path[:0] = [WORKDIR, ROOT]
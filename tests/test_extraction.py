@@ -0,0 +1,98 @@
+import copy
+
+import pytest
+
+yt_dlp = pytest.importorskip('yt_dlp')
+
+import new2
+
+VIDEO_URL = 'https://www.youtube.com/watch?v=abcdefghijk'
+
+FORMATS = [
+    {'format_id': '140', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a.40.2', 'abr': 129.5,
+     'filesize': 9721000, 'url': 'https://example.invalid/140', 'protocol': 'https'},
+    {'format_id': '18', 'ext': 'mp4', 'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2', 'height': 360, 'width': 640,
+     'tbr': 512.6, 'filesize_approx': 38445000, 'url': 'https://example.invalid/18', 'protocol': 'https'},
+    {'format_id': '137', 'ext': 'mp4', 'vcodec': 'avc1.640028', 'acodec': 'none', 'height': 1080, 'width': 1920,
+     'filesize': 210000000, 'url': 'https://example.invalid/137', 'protocol': 'https'},
+]
+
+def fake_extract_info(self, url, download=False):
+    """مانند extract_info(download=False) با ffmpeg نصب‌شده: انتخاب پیش‌فرض bestvideo*+bestaudio در info نوشته می‌شود"""
+    info = {
+        'id': 'abcdefghijk', 'title': 'Test video', 'duration': 600, 'formats': copy.deepcopy(FORMATS),
+        'extractor': 'youtube', 'extractor_key': 'Youtube', 'webpage_url': url,
+    }
+    with yt_dlp.YoutubeDL({'quiet': True, 'format': 'bestvideo*+bestaudio', 'simulate': True}) as ydl:
+        info = ydl.process_ie_result(info, download=False)
+    assert [f['format_id'] for f in info['requested_formats']] == ['137', '140']
+    return info
+
+def test_replay_downloads_only_requested_format(tmp_path, monkeypatch):
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'extract_info', fake_extract_info)
+    processed = []
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'process_info', lambda self, info_dict: processed.append(info_dict))
+    monkeypatch.setattr(new2, 'DOWNLOAD_DIR', str(tmp_path))
+    new2.info_cache.entries.clear()
+
+    cached = new2.extract_raw_info(VIDEO_URL)
+    assert 'requested_formats' not in cached and 'format_id' not in cached
+
+    result = new2.download_video_robust(VIDEO_URL, '360', info=cached)
+    assert result['format_id'] == '18'
+    assert [info_dict['format_id'] for info_dict in processed] == ['18']
+    assert 'requested_formats' not in processed[0]
+
+def test_strip_keeps_video_fields():
+    info = {'id': 'x', 'title': 'T', 'duration': 10, 'format_id': '137+140', 'url': 'u', 'ext': 'mp4',
+            'height': 1080, 'requested_formats': [{}], 'formats': [{'format_id': '18', 'url': 'v', 'ext': 'mp4', 'height': 360}]}
+    stripped = new2.strip_format_selection(info)
+    assert set(stripped) == {'id', 'title', 'duration', 'formats'}
+    assert stripped['formats'][0]['format_id'] == '18'
+
+MUXED = [
+    {'format_id': '18', 'ext': 'mp4', 'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2', 'height': 360, 'width': 640,
+     'filesize_approx': 38445000, 'url': 'https://example.invalid/18', 'protocol': 'https'},
+    {'format_id': '22', 'ext': 'mp4', 'vcodec': 'avc1.64001F', 'acodec': 'mp4a.40.2', 'height': 720, 'width': 1280,
+     'filesize': 89205000, 'url': 'https://example.invalid/22', 'protocol': 'https'},
+]
+
+def failing_first_download(processed):
+    """process_info که بار اول (دانلود اصلی) خطای شبکه می‌دهد تا مسیر fallback اجرا شود"""
+    def process_info(self, info_dict):
+        processed.append(info_dict['format_id'])
+        if len(processed) == 1:
+            raise yt_dlp.utils.DownloadError('network error')
+    return process_info
+
+def muxed_info(formats):
+    return {'id': 'abcdefghijk', 'title': 'Test video', 'duration': 600, 'formats': copy.deepcopy(formats),
+            'extractor': 'youtube', 'extractor_key': 'Youtube', 'webpage_url': VIDEO_URL}
+
+def test_fallback_skips_oversized_format(tmp_path, monkeypatch):
+    processed = []
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'process_info', failing_first_download(processed))
+    monkeypatch.setattr(new2, 'DOWNLOAD_DIR', str(tmp_path))
+
+    result = new2.download_video_robust(VIDEO_URL, '720', info=muxed_info(MUXED))
+    assert result['actual_quality'] == 'best_available'
+    assert processed == ['18', '18']
+
+def test_fallback_refuses_when_nothing_fits(tmp_path, monkeypatch):
+    processed = []
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'process_info', failing_first_download(processed))
+    monkeypatch.setattr(new2, 'DOWNLOAD_DIR', str(tmp_path))
+    # انتخاب اولیه با تخمین اشتباه حجم، فرمتی را داده که واقعاً بزرگ‌تر از سقف است
+    monkeypatch.setattr(new2, 'get_best_available_format', lambda url, quality, info=None: '22')
+
+    result = new2.download_video_robust(VIDEO_URL, '720', info=muxed_info(MUXED[1:]))
+    assert result == {'refused': 'no_format'}
+    assert processed == ['22']
+
+def test_no_fitting_format_is_refused_before_download(tmp_path, monkeypatch):
+    processed = []
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'process_info', failing_first_download(processed))
+    monkeypatch.setattr(new2, 'DOWNLOAD_DIR', str(tmp_path))
+
+    assert new2.download_video_robust(VIDEO_URL, '720', info=muxed_info(MUXED[1:])) == {'refused': 'no_format'}
+    assert processed == []
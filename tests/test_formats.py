@@ -0,0 +1,70 @@
+import pytest
+
+import new2
+from benchmark import RECORDED_FORMATS
+
+LIMIT = 50 * 1024 * 1024
+
+def recorded_info(**extra):
+    return dict({'id': 'abcdefghijk', 'duration': 600, 'formats': [dict(f) for f in RECORDED_FORMATS]}, **extra)
+
+def select(info, quality, limit=LIMIT):
+    return new2.select_format(new2.build_format_index(info, limit), quality)
+
+def test_size_estimated_from_bitrate_and_duration():
+    fmt = next(f for f in RECORDED_FORMATS if f['format_id'] == '17')
+    assert 'filesize' not in fmt and 'filesize_approx' not in fmt
+    assert new2.estimate_format_size(fmt, 600) == int(78.3 * 1000 / 8 * 600)
+
+def test_filesize_approx_used_when_filesize_missing():
+    fmt = next(f for f in RECORDED_FORMATS if f['format_id'] == '18')
+    assert new2.estimate_format_size(fmt, 600) == 38445000
+
+def test_unknown_size_is_not_selected():
+    # بدون مدت زمان، حجم 17 (فقط tbr) قابل تخمین نیست
+    info = recorded_info(duration=None)
+    index = new2.build_format_index(info, LIMIT)
+    assert 144 not in index['heights']
+    assert select(info, '144') == '18'
+
+def test_exact_height():
+    assert select(recorded_info(), '144') == '17'
+    assert select(recorded_info(), '360') == '18'
+
+@pytest.mark.parametrize('quality', ['480', '720', 'best'])
+def test_fallback_height_when_requested_does_not_fit(quality):
+    # 22 (720p، حدود 89MB) از محدودیت بزرگ‌تر است و فرمت‌های بی‌صدا کنار گذاشته می‌شوند
+    assert select(recorded_info(), quality) == '18'
+
+def test_audio_prefers_aac_in_remux_mode(monkeypatch):
+    monkeypatch.setattr(new2, 'AUDIO_MODE', 'remux')
+    assert select(recorded_info(), 'audio') == '140'
+
+def test_audio_prefers_bitrate_in_mp3_mode(monkeypatch):
+    monkeypatch.setattr(new2, 'AUDIO_MODE', 'mp3')
+    assert select(recorded_info(), 'audio') == '251'
+
+@pytest.mark.parametrize('quality', ['144', '360', '720', 'best', 'audio'])
+def test_refuses_when_nothing_fits(quality):
+    assert select(recorded_info(), quality, limit=1024 * 1024) is None
+
+def test_refuses_when_no_size_is_known():
+    info = {'duration': None, 'formats': [
+        {'format_id': '18', 'vcodec': 'avc1', 'acodec': 'mp4a.40.2', 'height': 360},
+        {'format_id': '140', 'vcodec': 'none', 'acodec': 'mp4a.40.2', 'abr': 128},
+    ]}
+    assert select(info, '360') is None
+    assert select(info, 'audio') is None
+
+def test_split_mode_selects_formats_above_single_file_limit(monkeypatch):
+    monkeypatch.setattr(new2, 'SPLIT_OVERSIZED', True)
+    monkeypatch.setattr(new2, 'SPLIT_MAX_PARTS', 10)
+    assert new2.get_best_available_format(None, '720', recorded_info()) == '22'
+    monkeypatch.setattr(new2, 'SPLIT_OVERSIZED', False)
+    assert new2.get_best_available_format(None, '720', recorded_info()) == '18'
+
+def test_format_chosen_for_splitting_is_not_streamed(monkeypatch):
+    monkeypatch.setattr(new2, 'STREAM_UPLOADS', True)
+    monkeypatch.setattr(new2, 'SPLIT_OVERSIZED', True)
+    assert new2.can_stream_upload('360', '18', recorded_info())
+    assert not new2.can_stream_upload('720', '22', recorded_info())
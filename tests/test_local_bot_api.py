@@ -0,0 +1,42 @@
+import os
+import sys
+import subprocess
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+import new2
+from conftest import ROOT
+
+def run_benchmark(tmp_path, *extra):
+    """اجرای بنچمارک در پردازه جدا، چون LOCAL_BOT_API و سقف حجم هنگام import خوانده می‌شوند"""
+    # ویدیوی ۷۲۰p ضبط‌شده حدود ۸۹MB است و فایل ۶۰MB از سقف ۵۰MB حالت عادی بزرگ‌تر است
+    command = [sys.executable, os.path.join(ROOT, 'benchmark.py'), '--users', '2', '--quality', '720',
+               '--file-size-mb', '60', '--extract-delay', '0', '--download-delay', '0.2', *extra]
+    return subprocess.run(command, cwd=tmp_path, capture_output=True, text=True, timeout=300)
+
+def test_local_mode_uploads_paths_above_cloud_limit(tmp_path):
+    result = run_benchmark(tmp_path, '--local-bot-api')
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'local path uploads: 2 (125829120 bytes)' in result.stdout
+
+def test_cloud_mode_refuses_the_same_download(tmp_path):
+    result = run_benchmark(tmp_path)
+    assert result.returncode == 1
+    assert "'too_large': 2" in result.stdout
+
+def test_media_input_is_a_path_in_local_mode(tmp_path, monkeypatch):
+    media = tmp_path / 'video.mp4'
+    media.write_bytes(b'\0')
+    monkeypatch.setattr(new2, 'LOCAL_BOT_API', True)
+    assert new2.media_input(str(media)) == Path(media).resolve()
+
+def test_local_mode_routes_path_uploads_to_media_pool(monkeypatch):
+    request = new2.RoutedRequest(None, None)
+    url = 'http://127.0.0.1/bot123:TEST/sendVideo'
+    assert request.route(url, None) == 'control'
+    monkeypatch.setattr(new2, 'LOCAL_BOT_API', True)
+    assert request.route(url, None) == 'media'
+    assert request.route('http://127.0.0.1/bot123:TEST/sendMessage', None) == 'control'
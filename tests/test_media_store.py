@@ -0,0 +1,36 @@
+import new2
+
+def download(tmp_path, name, size=100):
+    path = tmp_path / name
+    path.write_bytes(b'\0' * size)
+    return {'file_path': str(path), 'file_size': size, 'format_id': '18', 'title': 'T'}
+
+def test_add_keeps_file_in_use(tmp_path):
+    store = new2.MediaStore(str(tmp_path / 'media'), 10 ** 6)
+    key = ('abcdefghijk', '18', 'none')
+    first = store.add(key, download(tmp_path, 'a-360.mp4'))
+    store.acquire(key)
+
+    # کیفیت دیگری که به همان فرمت رسیده فایل در حال آپلود را حذف نمی‌کند
+    duplicate = download(tmp_path, 'a-480.mp4')
+    second = store.add(key, duplicate)
+    assert second['file_path'] == first['file_path']
+    assert (tmp_path / 'media').joinpath(first['file_path'].rsplit('/', 1)[1]).exists()
+    assert not (tmp_path / 'a-480.mp4').exists()
+    assert store.total_bytes == 100
+
+    store.release(key)
+    assert store.entries[key]['refs'] == 0
+
+def test_evict_after_release(tmp_path):
+    store = new2.MediaStore(str(tmp_path / 'media'), 150)
+    first_key = ('aaaaaaaaaaa', '18', 'none')
+    store.add(first_key, download(tmp_path, 'a.mp4'))
+    store.acquire(first_key)
+    store.add(first_key, download(tmp_path, 'b.mp4'))
+    store.release(first_key)
+    # پس از پایان آپلود، فایل قدیمی‌تر دوباره قابل حذف LRU است
+    second_key = ('bbbbbbbbbbb', '18', 'none')
+    store.add(second_key, download(tmp_path, 'c.mp4'))
+    assert list(store.entries) == [second_key]
+    assert store.total_bytes == 100
@@ -0,0 +1,18 @@
+import new2
+
+def test_render_groups_families_with_type_lines():
+    metrics = new2.Metrics('bot')
+    metrics.inc('cache_hits_total', cache='file_id')
+    metrics.inc('failures_total', type='no_format')
+    metrics.observe('stage_seconds', 0.2, stage='extract')
+    metrics.add_collector(lambda: {('cache_hits_total', (('cache', 'info'),)): 3, ('queue_depth', ()): 1})
+    lines = metrics.render().splitlines()
+
+    assert '# TYPE bot_cache_hits_total counter' in lines
+    assert '# TYPE bot_queue_depth gauge' in lines
+    assert '# TYPE bot_stage_seconds histogram' in lines
+    # نمونه‌های شمارنده و collector هم‌نام یک گروه پیوسته زیر یک خط TYPE هستند
+    start = lines.index('# TYPE bot_cache_hits_total counter')
+    assert lines[start + 1:start + 3] == ['bot_cache_hits_total{cache="file_id"} 1', 'bot_cache_hits_total{cache="info"} 3']
+    assert sum(line.startswith('bot_cache_hits_total') for line in lines) == 2
+    assert lines.index('# TYPE bot_stage_seconds histogram') < lines.index('bot_stage_seconds_count{stage="extract"} 1')
@@ -0,0 +1,32 @@
+import new2
+
+def limiter(**kwargs):
+    limits = {'metadata': (10, 5), 'download': (6, 3), 'batch': (6, 25)}
+    return new2.UserRateLimiter(limits, kwargs.get('max_buckets', 100), kwargs.get('exempt', ()))
+
+def test_burst_then_reject_with_single_notification():
+    users = limiter()
+    assert [users.check(1, 'download')[0] for _ in range(3)] == [0, 0, 0]
+    wait, notify = users.check(1, 'download')
+    assert wait > 0 and notify
+    wait, notify = users.check(1, 'download')
+    assert wait > 0 and not notify
+
+def test_batch_is_charged_per_item():
+    users = limiter()
+    assert users.check(1, 'batch', 20) == (0, False)
+    wait, _ = users.check(1, 'batch', 20)
+    # 15 توکن کم است با نرخ ۶ در دقیقه
+    assert 140 < wait <= 150
+    # بودجه دسته جدا از دانلود تکی است
+    assert users.check(1, 'download') == (0, False)
+
+def test_exempt_users_are_not_limited():
+    users = limiter(exempt=[7])
+    assert all(users.check(7, 'batch', 25) == (0, False) for _ in range(10))
+
+def test_bucket_count_is_bounded():
+    users = limiter(max_buckets=3)
+    for user_id in range(10):
+        users.check(user_id, 'metadata')
+    assert len(users.buckets) == 3
@@ -0,0 +1,39 @@
+import asyncio
+import types
+
+import new2
+
+async def answer(*args, **kwargs):
+    pass
+
+def press(monkeypatch, user_id, data):
+    """فشردن دکمه کیفیت و برگرداندن آرگومان‌های process_download_request"""
+    calls = []
+
+    async def process_download_request(message, user_id, url, quality, job_id=None, best_format=None):
+        calls.append({'user_id': user_id, 'url': url, 'quality': quality, 'best_format': best_format})
+
+    async def is_user_member(user_id, context, refresh=False):
+        return True
+
+    monkeypatch.setattr(new2, 'process_download_request', process_download_request)
+    monkeypatch.setattr(new2, 'is_user_member', is_user_member)
+    query = types.SimpleNamespace(from_user=types.SimpleNamespace(id=user_id), data=data, answer=answer,
+                                  message=object())
+    asyncio.run(new2.handle_quality_selection(types.SimpleNamespace(callback_query=query), None))
+    return calls[0]
+
+def test_session_formats_used_by_its_owner(monkeypatch):
+    url = 'https://www.youtube.com/watch?v=abcdefghijk&list=x'
+    new2.selection_sessions.set('tok1', {'user_id': 1, 'url': url, 'video_id': 'abcdefghijk',
+                                         'formats': {'360': '18'}})
+    call = press(monkeypatch, 1, '360_abcdefghijktok1')
+    assert call['url'] == url and call['best_format'] == '18'
+
+def test_other_user_does_not_reuse_session(monkeypatch):
+    url = 'https://www.youtube.com/watch?v=abcdefghijk&list=x'
+    new2.selection_sessions.set('tok2', {'user_id': 1, 'url': url, 'video_id': 'abcdefghijk',
+                                         'formats': {'360': '18'}})
+    call = press(monkeypatch, 2, '360_abcdefghijktok2')
+    assert call['url'] == 'https://www.youtube.com/watch?v=abcdefghijk'
+    assert call['best_format'] is None
@@ -0,0 +1,73 @@
+import sys
+import time
+import signal
+import sqlite3
+import asyncio
+import threading
+import subprocess
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+import benchmark
+from conftest import ROOT
+
+# ربات در حالت polling با یک کار نیمه‌تمام در دفتر کارها بالا می‌آید و دانلود کند آن ادامه پیدا می‌کند
+CHILD = """
+import sys, types
+sys.path.insert(0, {root!r})
+import benchmark
+
+args = types.SimpleNamespace(users=1, download_workers=1, chat_rate=30, stream=False, local_bot_api=False,
+                             extract_delay=0, download_delay=60, file_size_mb=50)
+config = benchmark.install_fake_config(args, {workdir!r}, {port})
+config.RUN_MODE = 'polling'
+config.JOB_JOURNAL_DB = {journal!r}
+config.LOG_FILE = {log!r}
+config.DRAIN_TIMEOUT = 1
+config.JOURNAL_CHECKPOINT_INTERVAL = 3600
+config.PRELOAD_YT_DLP = False
+
+import new2
+new2.load_yt_dlp().YoutubeDL = benchmark.make_fake_youtube_dl(args)
+url = 'https://www.youtube.com/watch?v=benchVideo0'
+new2.job_journal.record('job-1', 100000, 100000, 5, url, 'benchVideo0', '360', 'Benchmark video')
+new2.main()
+"""
+
+@pytest.fixture
+def fake_api():
+    port = benchmark.free_port()
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    runner, _ = asyncio.run_coroutine_threadsafe(benchmark.start_fake_bot_api(port), loop).result(10)
+    yield port
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result(10)
+    loop.call_soon_threadsafe(loop.stop)
+
+def test_sigterm_in_polling_mode_checkpoints_running_job(tmp_path, fake_api):
+    journal = str(tmp_path / 'jobs.db')
+    script = CHILD.format(root=ROOT, workdir=str(tmp_path), port=fake_api, journal=journal,
+                          log=str(tmp_path / 'bot.log'))
+    process = subprocess.Popen([sys.executable, '-c', script], cwd=tmp_path,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        downloads = tmp_path / 'downloads'
+        deadline = time.monotonic() + 60
+        # دو تکه نوشته‌شده یعنی progress hook دست‌کم یک بار مسیر .part را گزارش کرده است
+        while not any(path.stat().st_size >= 512 * 1024 for path in downloads.glob('*.part')):
+            assert process.poll() is None and time.monotonic() < deadline
+            time.sleep(0.2)
+        process.send_signal(signal.SIGTERM)
+        # مهلت تخلیه یک ثانیه است، نه ۶۰ ثانیه دانلود
+        assert process.wait(timeout=30) is not None
+    finally:
+        if process.poll() is None:
+            process.kill()
+
+    with sqlite3.connect(journal) as db:
+        state, part_path = db.execute("SELECT state, part_path FROM jobs WHERE job_id = 'job-1'").fetchone()
+    assert state == 'downloading'
+    assert part_path and part_path.endswith('.part')
@@ -0,0 +1,16 @@
+import new2
+
+def test_last_segment_is_split_at_keyframe():
+    # ۱۰ بایت در ثانیه و سقف ۴۰ بایت: هیچ بخشی نباید بیش از ۴ ثانیه باشد
+    segments = new2.plan_segments(list(range(0, 13, 2)), 13, 130, 40)
+    assert segments == [(0.0, 4), (4, 8), (8, 12), (12, 13)]
+
+def test_segments_cover_file_without_gaps():
+    keyframes = [i * 2.5 for i in range(40)]
+    segments = new2.plan_segments(keyframes, 99, 99 * 1000, 20 * 1000)
+    assert segments[0][0] == 0 and segments[-1][1] == 99
+    assert all(end == next_start for (_, end), (next_start, _) in zip(segments, segments[1:]))
+    assert all(end - start <= 20 for start, end in segments)
+
+def test_short_file_is_one_segment():
+    assert new2.plan_segments([0, 2, 4], 5, 50, 100) == [(0.0, 5)]
@@ -0,0 +1,46 @@
+import types
+import asyncio
+
+import httpx
+
+import new2
+from benchmark import RECORDED_FORMATS
+
+async def chunks():
+    for _ in range(3):
+        yield b'x' * 1000
+
+def test_stream_upload_honours_retry_after(monkeypatch):
+    bodies = []
+
+    async def handler(request):
+        bodies.append(await request.aread())
+        if len(bodies) == 1:
+            return httpx.Response(429, json={'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                                             'parameters': {'retry_after': 0}})
+        return httpx.Response(200, json={'ok': True, 'result': {
+            'message_id': 7, 'date': 0, 'chat': {'id': 42, 'type': 'private'},
+            'video': {'file_id': 'v', 'file_unique_id': 'u', 'width': 1, 'height': 1, 'duration': 1}}})
+
+    limiter = new2.FloodControlLimiter()
+    bot = types.SimpleNamespace(rate_limiter=limiter, defaults=None)
+
+    async def scenario():
+        monkeypatch.setattr(new2, 'stream_client', httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        try:
+            return await new2.stream_upload_video(bot, 42, 'caption', chunks)
+        finally:
+            await new2.close_stream_client()
+
+    message = asyncio.run(scenario())
+    assert message.video.file_id == 'v'
+    # پس از 429 کل فایل دوباره از ابتدا فرستاده می‌شود و چت در زمان‌بند مکث خورده است
+    assert len(bodies) == 2 and bodies[0].count(b'x') == bodies[1].count(b'x') == 3000
+    assert 42 in limiter.paused_until
+
+def test_small_files_are_not_streamed(monkeypatch):
+    monkeypatch.setattr(new2, 'STREAM_UPLOADS', True)
+    info = {'duration': 600, 'formats': [dict(f) for f in RECORDED_FORMATS]}
+    assert new2.can_stream_upload('360', '18', info)
+    info['formats'][5]['filesize_approx'] = 5 * 1024 * 1024
+    assert not new2.can_stream_upload('360', '18', info)
@@ -0,0 +1,42 @@
+import sqlite3
+
+import new2
+
+def test_updates_of_a_user_go_to_one_worker(tmp_path):
+    queue = new2.UpdateQueue(str(tmp_path / 'updates.db'))
+    for update_id, user_id in enumerate([10, 11, 12, -13], start=1):
+        queue.put(update_id, '{}', user_id)
+
+    claimed = [queue.claim('worker-0-1', 0, 2)[0] for _ in range(2)]
+    assert claimed == [1, 3]
+    assert queue.claim('worker-0-1', 0, 2) is None
+    assert [queue.claim('worker-1-2', 1, 2)[0] for _ in range(2)] == [2, 4]
+
+def test_claim_of_dead_worker_is_taken_over(tmp_path):
+    queue = new2.UpdateQueue(str(tmp_path / 'updates.db'))
+    queue.put(1, '{}', 10)
+    assert queue.claim('worker-0-100', 0, 1)[0] == 1
+    # همان کارگر پس از راه‌اندازی دوباره (pid دیگر) آپدیت نیمه‌کاره را فوراً برمی‌دارد
+    assert queue.claim('worker-0-200', 0, 1)[0] == 1
+    queue.done(1)
+    assert queue.claim('worker-0-200', 0, 1) is None
+
+def test_queue_from_previous_version_is_migrated(tmp_path):
+    path = str(tmp_path / 'updates.db')
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE updates (update_id INTEGER PRIMARY KEY, payload TEXT NOT NULL, claimed_by TEXT, claimed_at REAL)")
+    db.execute("INSERT INTO updates (update_id, payload) VALUES (1, '{}')")
+    db.commit()
+    db.close()
+    queue = new2.UpdateQueue(path)
+    assert queue.claim('worker-0-1', 0, 4)[0] == 1
+
+def test_update_sender_id():
+    assert new2.update_sender_id({'update_id': 1, 'message': {'from': {'id': 42}, 'chat': {'id': 42}}}) == 42
+    assert new2.update_sender_id({'update_id': 1, 'callback_query': {'from': {'id': 7}}}) == 7
+    assert new2.update_sender_id({'update_id': 1, 'channel_post': {'chat': {'id': -100}}}) == -100
+    # عضویتی که مدیر (5) تغییر داده به کارگر خود عضو (9) می‌رسد
+    assert new2.update_sender_id({'update_id': 1, 'chat_member': {
+        'chat': {'id': -100}, 'from': {'id': 5},
+        'old_chat_member': {'status': 'member', 'user': {'id': 9}},
+        'new_chat_member': {'status': 'kicked', 'user': {'id': 9}}}}) == 9
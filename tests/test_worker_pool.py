@@ -0,0 +1,119 @@
+import sys
+import time
+import asyncio
+import threading
+import http.server
+
+import pytest
+
+pytest.importorskip('yt_dlp')
+
+import new2
+
+SIZE = 2 * 1024 * 1024
+
+class SlowHandler(http.server.BaseHTTPRequestHandler):
+    """فایل آزمایشی در تکه‌های ۶۴KB با مکث، تا پیشرفت و لغو در میانه دانلود دیده شوند"""
+    delay = 0
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(SIZE))
+        self.end_headers()
+        chunk = b'\0' * (64 * 1024)
+        try:
+            for _ in range(SIZE // len(chunk)):
+                self.wfile.write(chunk)
+                time.sleep(self.delay)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+
+def video_info(port, video_id):
+    return {
+        'id': video_id, 'title': 'Pool test', 'duration': 10, 'extractor': 'generic', 'extractor_key': 'Generic',
+        'webpage_url': f'https://www.youtube.com/watch?v={video_id}',
+        'formats': [{
+            'format_id': '18', 'url': f'http://127.0.0.1:{port}/video.mp4', 'ext': 'mp4', 'protocol': 'http',
+            'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2', 'height': 360, 'filesize': SIZE,
+        }],
+    }
+
+async def download(info, cancel_event, progress):
+    return await new2.run_in_worker(
+        'download', 'download', new2.download_video_robust, info['webpage_url'], '360', cancel_event, info,
+        progress, None, cancel_event=cancel_event, progress=progress
+    )
+
+def test_progress_and_cancel_over_worker_pipe(server, monkeypatch):
+    monkeypatch.setattr(new2, 'DOWNLOAD_EXECUTOR', 'process')
+
+    async def scenario():
+        # دانلود کامل: نتیجه و وضعیت پایانی پیشرفت از pipe به پردازه اصلی می‌رسد
+        SlowHandler.delay = 0
+        progress = {}
+        result = await download(video_info(server.server_port, 'aaaaaaaaaaa'), threading.Event(), progress)
+        assert result['file_size'] == SIZE
+        assert progress['status'] == 'finished'
+
+        # دانلود کند: پیشرفت حین دانلود دیده می‌شود و لغو بدون کشتن کارگر آن را متوقف می‌کند
+        SlowHandler.delay = 0.2
+        progress = {}
+        task = asyncio.create_task(download(video_info(server.server_port, 'bbbbbbbbbbb'), threading.Event(), progress))
+        for _ in range(100):
+            await asyncio.sleep(0.1)
+            if progress.get('downloaded_bytes'):
+                break
+        assert 0 < progress['downloaded_bytes'] < SIZE
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        pool = new2.get_download_pool()
+        for _ in range(50):
+            if pool.idle.qsize() == pool.size:
+                break
+            await asyncio.sleep(0.1)
+        assert pool.idle.qsize() == pool.size
+        assert all(worker['restarts'] == 0 for worker in pool.workers)
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        new2.shutdown_executors()
+
+def download_in_update_worker(worker_id):
+    """بدنه کارگر آپدیت آزمایشی: یک کار در استخر دانلود پردازه‌ای خود کارگر"""
+    async def probe():
+        url = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+        return await new2.run_in_worker('download', 'download', new2.extract_video_id, url)
+    try:
+        video_id = asyncio.run(probe())
+    finally:
+        new2.shutdown_executors()
+    sys.exit(0 if video_id == 'dQw4w9WgXcQ' else 1)
+
+def test_update_worker_can_start_download_processes(monkeypatch):
+    monkeypatch.setattr(new2, 'DOWNLOAD_EXECUTOR', 'process')
+    process = new2.start_update_worker(0, target=download_in_update_worker)
+    process.join(60)
+    assert process.exitcode == 0
+
+def test_thread_workers_see_log_context():
+    async def scenario():
+        new2.log_context.set({'job_id': 'job-7', 'user_id': 7})
+        return await new2.run_in_worker('extract', 'extract', new2.log_context.get)
+    try:
+        assert asyncio.run(scenario()) == {'job_id': 'job-7', 'user_id': 7}
+    finally:
+        new2.shutdown_executors()